@@ -0,0 +1,152 @@
+"""
+Offline benchmarks of aws-lambda-scheduler, against the in-process eventbridge_emulator.
+
+Schedules the same workload with each of the target adding strategies and reports:
+    - EventBridge API calls per scheduled job
+    - p50/p99 lambda_handler latency
+    - EventBridge rule quota utilisation
+
+usage:
+    python benchmarks.py --jobs 1000 --minutes 120 --batch-size 50 --latency-ms 20 --max-tps 1000
+"""
+import argparse
+import datetime
+import random
+import time
+import lambda_function
+from bulk_executor import BulkExecutor
+from eventbridge_emulator import FakeEventBridgeClient, FakeLambdaClient
+from job_stores import SQLiteJobStore
+from lambda_invoker import LambdaInvoker
+
+# name -> (RULE_TARGET_ADDING_STRATEGY, INPUT_CONCATENATOR_CLASS_NAME, ALLOWED_T_MINUS_MINUTES)
+STRATEGIES = {
+    'concurrent': ('CONCURRENT_LAMBDA_TARGETS', False, False),
+    'concurrent+t_minus': ('CONCURRENT_LAMBDA_TARGETS', False, '10'),
+    'concatenator': ('INPUT_CONCATENATOR', 'EventBridgeSingleArrayInput', False),
+    'concatenator+t_minus': ('INPUT_CONCATENATOR', 'EventBridgeCompactArrayInput', '10'),
+    'dispatcher': ('DISPATCHER', False, False),
+    'dispatcher+t_minus': ('DISPATCHER', False, '10'),
+}
+SCHEDULER_FUNCTION_ARN = 'arn:aws:lambda:us-east-1:123456789012:function:aws-lambda-scheduler'
+
+
+class FakeContext:
+    """stand-in for the lambda context"""
+
+    def __init__(self, remaining_time_in_millis=60000) -> None:
+        self.remaining_time_in_millis = remaining_time_in_millis
+        self.invoked_function_arn = SCHEDULER_FUNCTION_ARN
+
+    def get_remaining_time_in_millis(self):
+        return self.remaining_time_in_millis
+
+
+def configure(strategy, client, max_tps):
+    """points lambda_function to the strategy's configuration and a fresh EventBridge with the client."""
+    rule_target_adding_strategy, input_concatenator_class_name, allowed_t_minus_minutes = STRATEGIES[
+        strategy]
+    lambda_function.RULE_TARGET_ADDING_STRATEGY = rule_target_adding_strategy
+    lambda_function.INPUT_CONCATENATOR_CLASS_NAME = input_concatenator_class_name
+    lambda_function.ALLOWED_T_MINUS_MINUTES = allowed_t_minus_minutes
+    lambda_function.EMIT_METRICS = False
+    lambda_function._input_concatenator = None
+    lambda_function.RULE_INDEX_SNAPSHOT_PATH = ''
+    invoker = LambdaInvoker(FakeLambdaClient(), executor=BulkExecutor(
+        max_workers=lambda_function.DISPATCH_MAX_WORKERS, max_rate=max_tps))
+    lambda_function._eventbridge = lambda_function.EventBridge(client, executor=BulkExecutor(
+        max_workers=lambda_function.BULK_MAX_WORKERS, max_rate=max_tps, max_retries=lambda_function.THROTTLE_MAX_RETRIES),
+        job_store=SQLiteJobStore(':memory:'), invoker=invoker)
+
+
+def generate_jobs(n_jobs, n_minutes, n_lambdas, seed):
+    rng = random.Random(seed)
+    start = datetime.datetime.now(
+        datetime.timezone.utc).replace(second=0, microsecond=0) + datetime.timedelta(days=1)
+    lambda_arns = [f'arn:aws:lambda:us-east-1:123456789012:function:benchmark-{i}'
+                   for i in range(n_lambdas)]
+    return [{
+        'datetime_utc': (start + datetime.timedelta(minutes=rng.randrange(n_minutes))).strftime('%Y-%m-%d %H:%M:%S'),
+        'lambda_function': rng.choice(lambda_arns),
+        'data': {'ids': [str(i)]},
+    } for i in range(n_jobs)]
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[int(round(p * (len(values) - 1)))] if values else 0.0
+
+
+def run(strategy, jobs, batch_size, latency, throttle_rate, quota_tps, max_tps):
+    client = FakeEventBridgeClient(
+        latency=latency, throttle_rate=throttle_rate, max_tps=quota_tps)
+    configure(strategy, client, max_tps)
+    context = FakeContext()
+
+    latencies = []
+    scheduled = 0
+    for i in range(0, len(jobs), batch_size):
+        batch = [dict(job) for job in jobs[i:i + batch_size]]
+        event = batch if batch_size > 1 else batch[0]
+        started_at = time.perf_counter()
+        response = lambda_function.lambda_handler(event, context)
+        latencies.append(time.perf_counter() - started_at)
+        if batch_size > 1:
+            scheduled += sum(result.get('success', False)
+                             for result in response.get('results', []))
+        else:
+            scheduled += response.get('success', False)
+
+    return {
+        'strategy': strategy,
+        'jobs': len(jobs),
+        'scheduled': scheduled,
+        'api_calls_per_job': client.total_calls / max(1, len(jobs)),
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'rules': len(client.rules),
+        'quota_utilisation': client.quota_utilisation(),
+        'throttled': sum(client.throttled_calls.values()),
+    }
+
+
+def print_results(results):
+    columns = ('strategy', 'jobs', 'scheduled', 'api_calls_per_job', 'p50_ms', 'p99_ms',
+               'rules', 'quota_utilisation', 'throttled')
+    print(' | '.join(f'{column:>20}' for column in columns))
+    for result in results:
+        print(' | '.join(f'{result[column]:>20.3f}' if isinstance(result[column], float)
+                         else f'{result[column]:>20}' for column in columns))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--jobs', type=int, default=500)
+    parser.add_argument('--minutes', type=int, default=120,
+                        help='jobs are spread over this many minutes')
+    parser.add_argument('--lambdas', type=int, default=3,
+                        help='number of distinct target lambdas')
+    parser.add_argument('--batch-size', type=int, default=1,
+                        help='jobs per lambda_handler call, 1 sends single events')
+    parser.add_argument('--latency-ms', type=float, default=0.0,
+                        help='injected latency of every EventBridge call')
+    parser.add_argument('--throttle-rate', type=float, default=0.0,
+                        help='probability of an EventBridge call being throttled')
+    parser.add_argument('--quota-tps', type=int, default=None,
+                        help='EventBridge calls over this rate are throttled by the emulator')
+    parser.add_argument('--max-tps', type=float, default=lambda_function.EVENTBRIDGE_MAX_TPS,
+                        help='client side rate limit of the scheduler, see EVENTBRIDGE_MAX_TPS')
+    parser.add_argument('--strategies', nargs='+',
+                        default=list(STRATEGIES), choices=list(STRATEGIES))
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    jobs = generate_jobs(args.jobs, args.minutes, args.lambdas, args.seed)
+    results = [run(strategy, jobs, args.batch_size, args.latency_ms / 1000, args.throttle_rate,
+                   args.quota_tps, args.max_tps) for strategy in args.strategies]
+    print_results(results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+import abc # abstract base classes
+
+class EventBridgeBucketSelector(metaclass=abc.ABCMeta):
+
+    @abc.abstractmethod
+    def select_rule(self, rules, date, lambda_function_arn, slots_needed=1, concatenate=False, max_targets=5):
+        """
+        select the rule to add the new target(s) on, from the rules close to the date.
+        every rule has its 'cron_datetime', 'targets' and 'target_count' keys set.
+        targets and target_count are None if they couldn't be listed.
+        slots_needed is the number of new targets, if they can't be concatenated into an existing target.
+        concatenate is True if the new data can be concatenated into a target with the same lambda_function_arn.
+        return None to create a new rule.
+        """
+
+class FirstRuleBucketSelector(EventBridgeBucketSelector):
+    """
+    Selects the first rule close to the date, regardless of its targets.
+    This is how aws-lambda-scheduler used to select the rules.
+    """
+    def select_rule(self, rules, date, lambda_function_arn, slots_needed=1, concatenate=False, max_targets=5):
+        return rules[0] if rules else None
+
+class BestFitBucketSelector(EventBridgeBucketSelector):
+    """
+    Packs the targets densely into the existing rules, to delay hitting the 300 rules quota.
+
+    Prefers the rules in the following order:
+        1. a rule with a target of the same lambda to concatenate the data into, no new target is needed.
+        2. the fullest rule that still has enough free target slots.
+        3. the rule nearest to the date, between the equally full rules.
+    Rules with unknown targets are never selected.
+    """
+    def select_rule(self, rules, date, lambda_function_arn, slots_needed=1, concatenate=False, max_targets=5):
+        rules = [rule for rule in rules if rule.get('targets') is not None]
+        if concatenate:
+            same_lambda_rules = [rule for rule in rules if any(
+                target.get('Arn') == lambda_function_arn for target in rule['targets'])]
+            if same_lambda_rules:
+                return max(same_lambda_rules, key=lambda rule: rule['cron_datetime'])
+
+        fitting_rules = [rule for rule in rules
+                         if rule['target_count'] + slots_needed <= max_targets]
+        if not fitting_rules:
+            return None
+        return max(fitting_rules, key=lambda rule: (rule['target_count'], rule['cron_datetime']))
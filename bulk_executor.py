@@ -0,0 +1,131 @@
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from utils import get_boto3_error_code
+
+# error codes AWS returns when the request rate is over the account's quota
+THROTTLING_ERROR_CODES = ('ThrottlingException', 'Throttling', 'TooManyRequestsException',
+                          'RequestLimitExceeded', 'ProvisionedThroughputExceededException')
+
+
+def is_throttling_exception(exception):
+    """whether the exception is a botocore ClientError caused by throttling."""
+    return get_boto3_error_code(exception) in THROTTLING_ERROR_CODES
+
+
+class AdaptiveTokenBucket:
+    """
+    Token bucket rate limiter that adapts its rate to the throttling of the API.
+
+    The rate is halved on every throttled call, and increased by one request per second
+    on every successful call, up to max_rate. (additive increase, multiplicative decrease)
+    """
+
+    def __init__(self, max_rate, min_rate=1.0) -> None:
+        self.max_rate = float(max_rate)
+        self.min_rate = min(float(min_rate), self.max_rate)
+        self.rate = self.max_rate
+        self._tokens = self.max_rate
+        self._refilled_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """blocks until a token is available."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.rate, self._tokens +
+                                   (now - self._refilled_at) * self.rate)
+                self._refilled_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def on_throttle(self):
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self._tokens = min(self._tokens, self.rate)
+
+    def on_success(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + 1)
+
+
+class BulkExecutor:
+    """
+    Shared execution layer for the EventBridge API calls.
+
+    call() runs a single API call through the rate limiter and retries it with jittered
+    exponential backoff when it's throttled. map() fans out a function over many items
+    with a bounded thread pool and reports the outcome of every item.
+    if a metrics.Metrics is given, every attempt of call() is recorded with the name of the called function.
+    """
+
+    def __init__(self, max_workers=8, max_rate=50, max_retries=5, base_delay=0.1, max_delay=5.0, metrics=None) -> None:
+        self.max_workers = max(1, int(max_workers))
+        self.rate_limiter = AdaptiveTokenBucket(max_rate)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.metrics = metrics
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._worker = threading.local()  # marks the threads of the pool
+
+    def call(self, fn, *args, **kwargs):
+        attempt = 0
+        while True:
+            self.rate_limiter.acquire()
+            started_at = time.perf_counter()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                throttled = is_throttling_exception(e)
+                self._record_call(fn, started_at, throttled=throttled, failed=True)
+                if not throttled or attempt >= self.max_retries:
+                    raise
+                self.rate_limiter.on_throttle()
+                # full jitter backoff
+                time.sleep(random.uniform(0, min(self.max_delay,
+                                                 self.base_delay * 2 ** attempt)))
+                attempt += 1
+                continue
+            self._record_call(fn, started_at)
+            self.rate_limiter.on_success()
+            return result
+
+    def _record_call(self, fn, started_at, throttled=False, failed=False):
+        if self.metrics is not None:
+            self.metrics.record_call(getattr(fn, '__name__', 'call'), time.perf_counter() - started_at,
+                                     throttled=throttled, failed=failed)
+
+    def get_pool(self) -> ThreadPoolExecutor:
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                initializer=self._mark_worker)
+            return self._pool
+
+    def _mark_worker(self):
+        self._worker.active = True
+
+    def map(self, fn, items):
+        """runs fn(item) concurrently for every item.
+        returns [{'success': bool, 'result': ..., 'exception': ...}] in the same order with the items.
+        a map called from a worker of the pool runs inline, waiting on the pool from its own workers would deadlock."""
+        items = list(items)
+        if len(items) <= 1 or self.max_workers == 1 or getattr(self._worker, 'active', False):
+            return [self._run(fn, item) for item in items]
+        pool = self.get_pool()
+        futures = [pool.submit(self._run, fn, item) for item in items]
+        return [future.result() for future in futures]
+
+    @staticmethod
+    def _run(fn, item):
+        try:
+            return {'success': True, 'result': fn(item)}
+        except Exception as e:
+            return {'success': False, 'exception': e}
@@ -0,0 +1,213 @@
+import collections
+import json
+import random
+import threading
+import time
+from botocore.exceptions import ClientError
+
+MAX_RULES = 300  # per region
+MAX_TARGETS_PER_RULE = 5
+MAX_TARGETS_PER_PUT_TARGETS_CALL = 10
+MAX_INPUT_SIZE = 8192
+PAGE_SIZE = 100
+
+
+class FakeEventBridgeClient:
+    """
+    In-process stand-in for boto3.client('events'), to run and measure the scheduler offline.
+
+    Emulates the calls EventBridge class makes, with the EventBridge pagination, the 300 rules and
+    5 targets per rule quotas and the target Input size limit. Per-call latency and throttling
+    can be injected. Every call is counted in self.calls by its operation name.
+
+    usage:
+        client = FakeEventBridgeClient(latency=0.02, max_tps=50)
+        eventbridge = EventBridge(client)
+    """
+
+    def __init__(self, latency=0.0, throttle_rate=0.0, max_tps=None, max_rules=MAX_RULES,
+                 max_targets_per_rule=MAX_TARGETS_PER_RULE, max_input_size=MAX_INPUT_SIZE, page_size=PAGE_SIZE,
+                 region_name='us-east-1', account_id='123456789012') -> None:
+        self.latency = latency  # seconds, or a callable returning seconds
+        self.throttle_rate = throttle_rate  # probability of a call being throttled
+        self.max_tps = max_tps  # calls over this rate are throttled
+        self.max_rules = max_rules
+        self.max_targets_per_rule = max_targets_per_rule
+        self.max_input_size = max_input_size
+        self.page_size = page_size
+        self.region_name = region_name
+        self.account_id = account_id
+        self.rules = {}  # name -> rule
+        self.targets = collections.defaultdict(dict)  # rule name -> {target id: target}
+        self.calls = collections.Counter()
+        self.throttled_calls = collections.Counter()
+        self._call_times = collections.deque()
+        self._lock = threading.RLock()
+
+    # helpers
+    @staticmethod
+    def _response(**kwargs):
+        kwargs['ResponseMetadata'] = {'HTTPStatusCode': 200}
+        return kwargs
+
+    @staticmethod
+    def _error(code, message, operation_name):
+        return ClientError({'Error': {'Code': code, 'Message': message},
+                            'ResponseMetadata': {'HTTPStatusCode': 400}}, operation_name)
+
+    def _call(self, operation_name):
+        latency = self.latency() if callable(self.latency) else self.latency
+        if latency:
+            time.sleep(latency)
+        with self._lock:
+            self.calls[operation_name] += 1
+            now = time.monotonic()
+            throttled = random.random() < self.throttle_rate
+            if self.max_tps is not None:
+                while self._call_times and now - self._call_times[0] >= 1:
+                    self._call_times.popleft()
+                throttled = throttled or len(self._call_times) >= self.max_tps
+            if throttled:
+                self.throttled_calls[operation_name] += 1
+                raise self._error('ThrottlingException',
+                                  'Rate exceeded', operation_name)
+            self._call_times.append(now)
+
+    def _rule_arn(self, name):
+        return f'arn:aws:events:{self.region_name}:{self.account_id}:rule/{name}'
+
+    def _page(self, items, next_token, limit, operation_name):
+        start = 0
+        if next_token:
+            try:
+                start = int(next_token)
+            except ValueError:
+                raise self._error('ValidationException',
+                                  'Invalid NextToken', operation_name)
+        limit = min(limit or self.page_size, self.page_size)
+        page = items[start:start + limit]
+        next_start = start + limit
+        return page, (str(next_start) if next_start < len(items) else None)
+
+    # events client api
+    def list_rules(self, NamePrefix=None, EventBusName='default', NextToken=None, Limit=None):
+        self._call('ListRules')
+        with self._lock:
+            names = sorted(name for name in self.rules
+                           if not NamePrefix or name.startswith(NamePrefix))
+            page, next_token = self._page(
+                names, NextToken, Limit, 'ListRules')
+            response = {'Rules': [dict(self.rules[name]) for name in page]}
+        if next_token:
+            response['NextToken'] = next_token
+        return self._response(**response)
+
+    def describe_rule(self, Name, EventBusName='default'):
+        self._call('DescribeRule')
+        with self._lock:
+            if Name not in self.rules:
+                raise self._error('ResourceNotFoundException',
+                                  f'Rule {Name} does not exist.', 'DescribeRule')
+            return self._response(**self.rules[Name])
+
+    def put_rule(self, Name, ScheduleExpression=None, State='ENABLED', Tags=None, EventBusName='default', **kwargs):
+        self._call('PutRule')
+        with self._lock:
+            if Name not in self.rules and len(self.rules) >= self.max_rules:
+                raise self._error('LimitExceededException',
+                                  'The requested resource exceeds the maximum number allowed.', 'PutRule')
+            self.rules[Name] = {'Name': Name, 'Arn': self._rule_arn(Name), 'ScheduleExpression': ScheduleExpression,
+                                'State': State, 'EventBusName': EventBusName}
+            return self._response(RuleArn=self._rule_arn(Name))
+
+    def put_targets(self, Rule, Targets, EventBusName='default'):
+        self._call('PutTargets')
+        with self._lock:
+            if Rule not in self.rules:
+                raise self._error('ResourceNotFoundException',
+                                  f'Rule {Rule} does not exist.', 'PutTargets')
+            if len(Targets) > MAX_TARGETS_PER_PUT_TARGETS_CALL:
+                raise self._error('ValidationException',
+                                  'Too many targets in a single call.', 'PutTargets')
+            for target in Targets:
+                if len(target.get('Input', '')) > self.max_input_size:
+                    raise self._error('ValidationException',
+                                      f"Target {target.get('Id')} Input is too long.", 'PutTargets')
+            rule_targets = self.targets[Rule]
+            new_ids = {target['Id'] for target in Targets} - set(rule_targets)
+            if len(rule_targets) + len(new_ids) > self.max_targets_per_rule:
+                raise self._error('LimitExceededException',
+                                  'The requested resource exceeds the maximum number allowed.', 'PutTargets')
+            for target in Targets:
+                rule_targets[target['Id']] = dict(target)
+            return self._response(FailedEntryCount=0, FailedEntries=[])
+
+    def list_targets_by_rule(self, Rule, EventBusName='default', NextToken=None, Limit=None):
+        self._call('ListTargetsByRule')
+        with self._lock:
+            if Rule not in self.rules:
+                raise self._error('ResourceNotFoundException',
+                                  f'Rule {Rule} does not exist.', 'ListTargetsByRule')
+            targets = list(self.targets[Rule].values())
+            page, next_token = self._page(
+                targets, NextToken, Limit, 'ListTargetsByRule')
+            response = {'Targets': [dict(target) for target in page]}
+        if next_token:
+            response['NextToken'] = next_token
+        return self._response(**response)
+
+    def remove_targets(self, Rule, Ids, EventBusName='default', Force=False):
+        self._call('RemoveTargets')
+        with self._lock:
+            if Rule not in self.rules:
+                raise self._error('ResourceNotFoundException',
+                                  f'Rule {Rule} does not exist.', 'RemoveTargets')
+            for target_id in Ids:
+                self.targets[Rule].pop(target_id, None)
+            return self._response(FailedEntryCount=0, FailedEntries=[])
+
+    def delete_rule(self, Name, EventBusName='default', Force=False):
+        self._call('DeleteRule')
+        with self._lock:
+            if self.targets.get(Name):
+                raise self._error('ValidationException',
+                                  "Rule can't be deleted since it has targets.", 'DeleteRule')
+            self.rules.pop(Name, None)
+            self.targets.pop(Name, None)
+            return self._response()
+
+    # introspection for the benchmarks
+    @property
+    def total_calls(self):
+        return sum(self.calls.values())
+
+    def quota_utilisation(self):
+        return len(self.rules) / self.max_rules
+
+
+class FakeLambdaClient:
+    """
+    In-process stand-in for boto3.client('lambda'), records the invocations of the dispatcher.
+    Latency and throttling can be injected like FakeEventBridgeClient.
+    """
+
+    def __init__(self, latency=0.0, throttle_rate=0.0) -> None:
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.invocations = []  # (function name, event)
+        self.calls = collections.Counter()
+        self.throttled_calls = collections.Counter()
+        self._lock = threading.Lock()
+
+    def invoke(self, FunctionName, InvocationType='RequestResponse', Payload=b'{}', **kwargs):
+        latency = self.latency() if callable(self.latency) else self.latency
+        if latency:
+            time.sleep(latency)
+        with self._lock:
+            self.calls['Invoke'] += 1
+            if random.random() < self.throttle_rate:
+                self.throttled_calls['Invoke'] += 1
+                raise FakeEventBridgeClient._error('TooManyRequestsException', 'Rate exceeded', 'Invoke')
+            self.invocations.append((FunctionName, json.loads(Payload)))
+        return {'StatusCode': 202 if InvocationType == 'Event' else 200,
+                'ResponseMetadata': {'HTTPStatusCode': 202 if InvocationType == 'Event' else 200}}
@@ -1,4 +1,6 @@
 import abc # abstract base classes
+import json
+import os
 
 class EventBridgeInputConcatenator(metaclass=abc.ABCMeta):
 
@@ -6,6 +8,33 @@ class EventBridgeInputConcatenator(metaclass=abc.ABCMeta):
     def concatenate_inputs(self, existing_data, new_data):
         """concatenate existing data on the EventBridge Rule with the new data."""
 
+    def concatenate_many(self, existing_data, new_items):
+        """concatenate existing data on the EventBridge Rule with a list of new data, in one pass.
+        falls back to calling concatenate_inputs for every new data, override it if you can do better.
+        if the data doesn't fit in a single target Input, raises EventBridgeInputSizeExceeded with the
+        data concatenated so far and the new data that couldn't be concatenated."""
+        for i, new_data in enumerate(new_items):
+            try:
+                existing_data = self.concatenate_inputs(existing_data, new_data)
+            except EventBridgeInputSizeExceeded as e:
+                raise EventBridgeInputSizeExceeded(
+                    str(e), merged_data=existing_data, remaining_items=new_items[i:])
+        return existing_data
+
+    def remove_inputs(self, existing_data, removed_items, kept_items=()):
+        """takes the data of the cancelled jobs out of the data on the EventBridge Rule, the inverse of concatenate_many.
+        kept_items are the data of the other jobs known to stay in the same target.
+        returns the remaining data, or None if nothing is left and the target can be removed.
+        override it to be able to cancel the jobs merged with the others."""
+        raise NotImplementedError(
+            f"{type(self).__name__} can't take a job out of a concatenated input.")
+
+    def contains_inputs(self, existing_data, items):
+        """whether the data of every item is concatenated into the existing data. used to verify that a concatenated
+        target isn't overwritten by a concurrent write, override it to enable the verification."""
+        raise NotImplementedError(
+            f"{type(self).__name__} can't verify a concatenated input.")
+
 class EventBridgeSingleArrayInput(EventBridgeInputConcatenator):
     """
     Simple example implementation of EventBridgeInputConcatenator.
@@ -58,3 +87,148 @@ class EventBridgeSingleArrayInput(EventBridgeInputConcatenator):
 
     def concatenate_inputs(self, existing_data: dict, new_data: dict) -> dict:
         return self.custom_dict_value_based_update(existing_data, new_data)
+
+    def remove_inputs(self, existing_data: dict, removed_items: list, kept_items=()) -> dict:
+        """removes one occurrence of every value of the removed data from the lists,
+        and the keys that are left without a value."""
+        remaining_data = {key: list(value) if type(value) == list else value
+                          for key, value in existing_data.items()}
+        for removed_data in removed_items:
+            for key, value in removed_data.items():
+                if key not in remaining_data:
+                    continue
+                values = value if type(value) == list else [value]
+                if type(remaining_data[key]) != list:
+                    if remaining_data[key] in values:
+                        del remaining_data[key]
+                    continue
+                for v in values:
+                    if v in remaining_data[key]:
+                        remaining_data[key].remove(v)
+                if not remaining_data[key]:
+                    del remaining_data[key]
+        return remaining_data or None
+
+    def contains_inputs(self, existing_data: dict, items: list) -> bool:
+        for data in items:
+            for key, value in data.items():
+                if key not in existing_data:
+                    return False
+                # the same values custom_dict_value_based_update extends the lists with
+                values = value if type(value) == list else [
+                    value] if type(value) in (int, str) else []
+                existing_values = existing_data[key] if type(
+                    existing_data[key]) == list else [existing_data[key]]
+                if any(v not in existing_values for v in values):
+                    return False
+        return True
+
+
+class EventBridgeInputSizeExceeded(Exception):
+    """raised by a concatenator when the concatenated data wouldn't fit in a single EventBridge target Input.
+    the new data is then written to another target, or to a sibling rule."""
+    def __init__(self, message, merged_data=None, remaining_items=None):
+        super().__init__(message)
+        self.merged_data = merged_data
+        self.remaining_items = remaining_items
+
+
+class _CompactInput(dict):
+    """dict with the bookkeeping of EventBridgeCompactArrayInput: the json size of the dict
+    and a set of the values of every list, so neither has to be computed again on every merge."""
+    size = 0
+    seen = None
+
+
+class EventBridgeCompactArrayInput(EventBridgeSingleArrayInput):
+    """
+    Size-aware and de-duplicating version of EventBridgeSingleArrayInput.
+
+    Values already in a list are not appended again, e.g. the same object id scheduled twice.
+    The json size of the data is tracked incrementally, without dumping the whole data on every merge.
+    When the new data would make the target Input bigger than MAX_INPUT_SIZE, EventBridgeInputSizeExceeded
+    is raised and the new data is written to another target or rule instead.
+
+    Use Case:
+        high volume of object ids fanning in to the same lambda function.
+    """
+    MAX_INPUT_SIZE = int(os.getenv('INPUT_CONCATENATOR_MAX_INPUT_SIZE', 8192))  # EventBridge Input limit
+
+    @staticmethod
+    def _hashable(value):
+        if isinstance(value, (str, int, float, bool)) or value is None:
+            return (type(value).__name__, value)
+        return ('json', json.dumps(value, sort_keys=True))
+
+    def _as_compact_input(self, data: dict) -> _CompactInput:
+        if isinstance(data, _CompactInput):
+            return data
+        compact_input = _CompactInput(data)
+        compact_input.size = len(json.dumps(compact_input))
+        compact_input.seen = {key: {self._hashable(v) for v in value}
+                              for key, value in compact_input.items() if type(value) == list}
+        return compact_input
+
+    def concatenate_inputs(self, existing_data: dict, new_data: dict) -> dict:
+        existing_data = self._as_compact_input(existing_data)
+        # plan the changes and their size first, existing_data is only updated if they fit.
+        size = existing_data.size
+        appends = []  # (key, value, hashable value)
+        new_keys = []
+        seen_in_new_data = set()
+        for key, value in new_data.items():
+            if key not in existing_data:
+                # ', "key": value' or '"key": value' for the first key
+                size += (2 if existing_data or new_keys else 0) + \
+                    len(json.dumps(key)) + 2 + len(json.dumps(value))
+                new_keys.append(key)
+                continue
+            values = value if type(value) == list else [
+                value] if type(value) in (int, str) else []
+            existing_value = existing_data[key]
+            list_length = len(existing_value) if type(
+                existing_value) == list else 1
+            for v in values:
+                hashable_value = self._hashable(v)
+                if hashable_value in existing_data.seen.get(key, ()) or (key, hashable_value) in seen_in_new_data:
+                    continue
+                if type(existing_value) != list and hashable_value == self._hashable(existing_value):
+                    continue
+                seen_in_new_data.add((key, hashable_value))
+                if type(existing_value) != list and list_length == 1:
+                    size += 2  # becomes a list, '[' and ']'
+                size += (2 if list_length else 0) + len(json.dumps(v))
+                list_length += 1
+                appends.append((key, v, hashable_value))
+
+        if size > self.MAX_INPUT_SIZE:
+            raise EventBridgeInputSizeExceeded(
+                f'Concatenated input would be {size} characters, max. allowed is {self.MAX_INPUT_SIZE}.')
+
+        for key, v, hashable_value in appends:
+            if type(existing_data[key]) != list:
+                existing_data[key] = [existing_data[key]]  # make list
+                existing_data.seen[key] = {
+                    self._hashable(existing_data[key][0])}
+            existing_data[key].append(v)
+            existing_data.seen.setdefault(key, set()).add(hashable_value)
+        for key in new_keys:
+            existing_data[key] = list(new_data[key]) if type(
+                new_data[key]) == list else new_data[key]
+            if type(new_data[key]) == list:
+                existing_data.seen[key] = {
+                    self._hashable(v) for v in new_data[key]}
+        existing_data.size = size
+        return existing_data
+
+    def remove_inputs(self, existing_data: dict, removed_items: list, kept_items=()) -> dict:
+        # a value is stored once for all of the jobs that have it, keep the ones the other jobs still have
+        kept_values = {}
+        for kept_data in kept_items:
+            for key, value in kept_data.items():
+                kept_values.setdefault(key, set()).update(
+                    self._hashable(v) for v in (value if type(value) == list else [value]))
+        removed_items = [{key: [v for v in (value if type(value) == list else [value])
+                                if self._hashable(v) not in kept_values.get(key, ())]
+                          for key, value in removed_data.items()} for removed_data in removed_items]
+        return super().remove_inputs(dict(existing_data), removed_items)
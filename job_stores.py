@@ -0,0 +1,155 @@
+import abc # abstract base classes
+import json
+import os
+import sqlite3
+import threading
+import time
+
+JOB_STORE_SQLITE_PATH = os.getenv(
+    'JOB_STORE_SQLITE_PATH', '/tmp/aws-lambda-scheduler-jobs.sqlite3')
+JOB_STORE_DYNAMODB_TABLE = os.getenv('JOB_STORE_DYNAMODB_TABLE', False)
+# unprocessed items of a batch_write_item are sent again this many times
+JOB_STORE_WRITE_MAX_RETRIES = int(os.getenv('JOB_STORE_WRITE_MAX_RETRIES', 8))
+
+
+class JobStoreException(Exception):
+    pass
+
+
+class JobStore(metaclass=abc.ABCMeta):
+    """
+    Storage of the jobs of RULE_TARGET_ADDING_STRATEGY='DISPATCHER'.
+    Jobs are grouped by their bucket, the name of the rule that is going to dispatch them.
+    A job is a dict of 'job_id', 'lambda_function_arn' and 'data'.
+    """
+
+    @abc.abstractmethod
+    def put_jobs(self, bucket, jobs):
+        """stores the jobs in the bucket, a job with an existing job_id replaces the stored one."""
+
+    @abc.abstractmethod
+    def get_jobs(self, bucket):
+        """returns the stored jobs of the bucket."""
+
+    @abc.abstractmethod
+    def delete_jobs(self, bucket, job_ids):
+        """deletes the jobs from the bucket, missing jobs are ignored."""
+
+
+class SQLiteJobStore(JobStore):
+    """
+    Stores the jobs in a local SQLite database, for testing and local development.
+    /tmp isn't shared between Lambda execution environments, the dispatching invocation may not see
+    the jobs unless JOB_STORE_SQLITE_PATH is on a shared file system like EFS.
+    """
+
+    def __init__(self, path=None) -> None:
+        self.path = path if path else JOB_STORE_SQLITE_PATH
+        # one connection shared by the BulkExecutor threads, serialized with the lock
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS jobs ('
+                'bucket TEXT NOT NULL, job_id TEXT NOT NULL, lambda_function_arn TEXT NOT NULL, '
+                'data TEXT NOT NULL, created_at REAL NOT NULL, PRIMARY KEY (bucket, job_id))')
+
+    def put_jobs(self, bucket, jobs):
+        created_at = time.time()
+        with self._lock, self._connection:
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?)',
+                [(bucket, job['job_id'], job['lambda_function_arn'], json.dumps(job['data']), created_at)
+                 for job in jobs])
+
+    def get_jobs(self, bucket):
+        with self._lock:
+            rows = self._connection.execute(
+                'SELECT job_id, lambda_function_arn, data FROM jobs WHERE bucket = ? ORDER BY created_at, rowid',
+                (bucket,)).fetchall()
+        return [{'job_id': job_id, 'lambda_function_arn': lambda_function_arn, 'data': json.loads(data)}
+                for job_id, lambda_function_arn, data in rows]
+
+    def delete_jobs(self, bucket, job_ids):
+        with self._lock, self._connection:
+            self._connection.executemany('DELETE FROM jobs WHERE bucket = ? AND job_id = ?',
+                                         [(bucket, job_id) for job_id in job_ids])
+
+
+class DynamoDBJobStore(JobStore):
+    """
+    Stores the jobs in the DynamoDB table JOB_STORE_DYNAMODB_TABLE, shared by all of the containers.
+    The table needs a 'bucket' partition key and a 'job_id' sort key, both strings.
+    """
+
+    def __init__(self, table_name=None, client=None) -> None:
+        self.table_name = table_name if table_name else JOB_STORE_DYNAMODB_TABLE
+        if not self.table_name:
+            raise ValueError(
+                'Please set the environment variable: JOB_STORE_DYNAMODB_TABLE')
+        if not client:
+            import boto3
+            client = boto3.client('dynamodb')
+        self.client = client
+
+    def _write(self, requests):
+        # batch_write_item accepts 25 requests per call, unprocessed ones are sent again
+        for i in range(0, len(requests), 25):
+            request_items = {self.table_name: requests[i:i + 25]}
+            attempt = 0
+            while request_items:
+                response = self.client.batch_write_item(
+                    RequestItems=request_items)
+                request_items = response.get('UnprocessedItems')
+                if request_items:
+                    if attempt >= JOB_STORE_WRITE_MAX_RETRIES:
+                        raise JobStoreException(
+                            f"{len(request_items[self.table_name])} items of the table {self.table_name} "
+                            f"are still unprocessed after {attempt + 1} attempts.")
+                    attempt += 1
+                    time.sleep(min(1.0, 0.05 * 2 ** attempt))
+
+    def put_jobs(self, bucket, jobs):
+        self._write([{'PutRequest': {'Item': {
+            'bucket': {'S': bucket},
+            'job_id': {'S': job['job_id']},
+            'lambda_function_arn': {'S': job['lambda_function_arn']},
+            'data': {'S': json.dumps(job['data'])},
+        }}} for job in jobs])
+
+    def get_jobs(self, bucket):
+        jobs = []
+        query_kwargs = {'TableName': self.table_name, 'KeyConditionExpression': '#bucket = :bucket',
+                        'ExpressionAttributeNames': {'#bucket': 'bucket'},  # a reserved word
+                        'ExpressionAttributeValues': {':bucket': {'S': bucket}}, 'ConsistentRead': True}
+        while True:
+            response = self.client.query(**query_kwargs)
+            jobs.extend({'job_id': item['job_id']['S'], 'lambda_function_arn': item['lambda_function_arn']['S'],
+                         'data': json.loads(item['data']['S'])} for item in response.get('Items', []))
+            if not response.get('LastEvaluatedKey'):
+                return jobs
+            query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    def delete_jobs(self, bucket, job_ids):
+        self._write([{'DeleteRequest': {'Key': {'bucket': {'S': bucket}, 'job_id': {'S': job_id}}}}
+                     for job_id in job_ids])
+
+
+class PrefixedJobStore(JobStore):
+    """
+    Keeps the buckets of a shard apart from the other shards' in a shared job store, see sharding.py.
+    The rules of the shards have the same names, so their buckets are prefixed with the name of the shard.
+    """
+
+    def __init__(self, job_store, prefix) -> None:
+        self.job_store = job_store
+        self.prefix = prefix
+
+    def put_jobs(self, bucket, jobs):
+        self.job_store.put_jobs(self.prefix + bucket, jobs)
+
+    def get_jobs(self, bucket):
+        return self.job_store.get_jobs(self.prefix + bucket)
+
+    def delete_jobs(self, bucket, job_ids):
+        self.job_store.delete_jobs(self.prefix + bucket, job_ids)
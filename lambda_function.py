@@ -1,18 +1,21 @@
-from logging import fatal
-import re
-from time import timezone
-import boto3
-import json
+# boto3 and dateutil are imported lazily where they are needed, importing boto3 is most of the cold start.
 import datetime
-from botocore import exceptions
-import dateutil
-from dateutil.parser import parse
-from pprint import pprint
+import hashlib
+import json
 import os
 import random
+import re
 import string
-from input_concatenators import *
-from utils import *
+import time
+from input_concatenators import EventBridgeInputConcatenator, EventBridgeInputSizeExceeded
+from utils import as_utc, get_boto3_error_code, get_class_by_name_and_module, parse_datetime
+from rule_index import RuleIndex, read_snapshot
+from bulk_executor import BulkExecutor
+from bucket_selectors import EventBridgeBucketSelector
+from job_stores import JobStore, PrefixedJobStore
+from lambda_invoker import LambdaInvoker
+from metrics import Metrics, SamplingProfiler, timed_phase
+from rule_compactor import RuleCompactor
 
 RULE_PREFIX = os.getenv('RULE_PREFIX', 'AUTO_')
 LAMBDA_FUNCTION_NAME_TO_ARN_MAPPING_PREFIX = os.getenv(
@@ -20,12 +23,74 @@ LAMBDA_FUNCTION_NAME_TO_ARN_MAPPING_PREFIX = os.getenv(
 ALLOWED_T_MINUS_MINUTES = os.getenv('ALLOWED_T_MINUS_MINUTES', False)
 # TODO: default concurrent
 RULE_TARGET_ADDING_STRATEGY = os.getenv(
-    'RULE_TARGET_ADDING_STRATEGY', 'CONCURRENT_LAMBDA_TARGETS')  # INPUT_CONCATENATOR
+    'RULE_TARGET_ADDING_STRATEGY', 'CONCURRENT_LAMBDA_TARGETS')  # INPUT_CONCATENATOR, DISPATCHER
 INPUT_CONCATENATOR_MODULE_NAME = os.getenv(
     'INPUT_CONCATENATOR_MODULE_NAME', 'input_concatenators')
 INPUT_CONCATENATOR_CLASS_NAME = os.getenv(
     'INPUT_CONCATENATOR_CLASS_NAME', False)  # EventBridgeSingleArrayInput
+BUCKET_SELECTOR_MODULE_NAME = os.getenv(
+    'BUCKET_SELECTOR_MODULE_NAME', 'bucket_selectors')
+BUCKET_SELECTOR_CLASS_NAME = os.getenv(
+    'BUCKET_SELECTOR_CLASS_NAME', 'BestFitBucketSelector')  # FirstRuleBucketSelector
+# how long the listed rules and targets are trusted before listing them again, 0 disables caching.
+# the targets are listed fresh before their inputs are read-modify-written, e.g. to concatenate or cancel a job.
+RULE_CACHE_TTL_SECONDS = int(os.getenv('RULE_CACHE_TTL_SECONDS', 60))
+# RULE_TARGET_ADDING_STRATEGY='DISPATCHER' stores the jobs in the job store, and one rule per bucket invokes this lambda to dispatch them.
+JOB_STORE_MODULE_NAME = os.getenv('JOB_STORE_MODULE_NAME', 'job_stores')
+# required with DISPATCHER, the dispatching invocation runs in another execution environment and needs a shared store.
+JOB_STORE_CLASS_NAME = os.getenv(
+    'JOB_STORE_CLASS_NAME', False)  # DynamoDBJobStore, SQLiteJobStore
+# arn of this lambda for the dispatch rules, defaults to the invoked_function_arn of the lambda context
+SCHEDULER_FUNCTION_ARN = os.getenv('SCHEDULER_FUNCTION_ARN', False)
+DISPATCH_MAX_WORKERS = int(os.getenv('DISPATCH_MAX_WORKERS', 32))
+LAMBDA_INVOKE_MAX_TPS = float(os.getenv('LAMBDA_INVOKE_MAX_TPS', 500))
+# the rules and the job keys of the RuleIndex are saved here after they change, and restored by the next container.
+# empty disables the snapshot.
+RULE_INDEX_SNAPSHOT_PATH = os.getenv('RULE_INDEX_SNAPSHOT_PATH', '')
+# the handler schedules on the shards of SHARDS if it's set, the json list is parsed by sharding.py
+SHARDS_ENABLED = bool(os.getenv('SHARDS', ''))
+CLEANUP_MAX_DELETIONS_PER_CALL = int(
+    os.getenv('CLEANUP_MAX_DELETIONS_PER_CALL', 10))
+CLEANUP_RESERVED_TIME_MS = int(os.getenv('CLEANUP_RESERVED_TIME_MS', 1000))
+CLEANUP_MIN_INTERVAL_SECONDS = int(
+    os.getenv('CLEANUP_MIN_INTERVAL_SECONDS', 60))
+# the maintenance rule invokes this lambda with {"action": "maintenance"} at the rate of CALL_LAMBDA_SCHEDULER_EVERY_N_MINUTES
+# or _HOURS to delete the expired rules and refresh the rule index, the schedule requests skip the cleanup then.
+MAINTENANCE_RULE_ENABLED = os.getenv(
+    'MAINTENANCE_RULE_ENABLED', 'false').lower() == 'true'
+MAINTENANCE_RULE_NAME = os.getenv(
+    'MAINTENANCE_RULE_NAME', f'{RULE_PREFIX}MAINTENANCE')
+# the rules within COMPACTION_TOLERANCE_MINUTES are coalesced into the earliest of them by {"action": "compact"},
+# and by the maintenance rule if COMPACTION_ENABLED. see rule_compactor.py
+COMPACTION_ENABLED = os.getenv('COMPACTION_ENABLED', 'false').lower() == 'true'
+COMPACTION_TOLERANCE_MINUTES = int(os.getenv(
+    'COMPACTION_TOLERANCE_MINUTES', ALLOWED_T_MINUS_MINUTES or 0))
+# maximum number of jobs returned by a single {"action": "query"} call, the rest are paginated with the next_token
+QUERY_PAGE_SIZE = int(os.getenv('QUERY_PAGE_SIZE', 100))
+# concurrency and rate limits of the EventBridge API calls
+BULK_MAX_WORKERS = int(os.getenv('BULK_MAX_WORKERS', 8))
+EVENTBRIDGE_MAX_TPS = float(os.getenv('EVENTBRIDGE_MAX_TPS', 50))
+THROTTLE_MAX_RETRIES = int(os.getenv('THROTTLE_MAX_RETRIES', 5))
+# writes conflicting with the other containers, e.g. a concatenated target overwritten by a concurrent merge,
+# are retried this many times with jittered backoff. with WRITE_CONFLICT_CHECK_ENABLED the concatenated targets are
+# read back after a short jittered delay of up to WRITE_CONFLICT_BACKOFF_SECONDS.
+# best-effort and opt-in: a concurrent write slower than the delay goes unnoticed.
+WRITE_CONFLICT_CHECK_ENABLED = os.getenv(
+    'WRITE_CONFLICT_CHECK_ENABLED', 'false').lower() == 'true'
+WRITE_CONFLICT_MAX_RETRIES = int(os.getenv('WRITE_CONFLICT_MAX_RETRIES', 3))
+WRITE_CONFLICT_BACKOFF_SECONDS = float(
+    os.getenv('WRITE_CONFLICT_BACKOFF_SECONDS', 0.05))
+# one Embedded Metric Format record is logged per invocation, see metrics.py
+EMIT_METRICS = os.getenv('EMIT_METRICS', 'true').lower() == 'true'
+METRICS_NAMESPACE = os.getenv('METRICS_NAMESPACE', 'LambdaScheduler')
+# samples the stacks every n milliseconds and adds the hot spots to the metrics record, 0 disables the profiler.
+PROFILER_SAMPLING_INTERVAL_MS = float(
+    os.getenv('PROFILER_SAMPLING_INTERVAL_MS', 0))
 REQUIRED_EVENT_INPUTS = ('datetime_utc', 'data', 'lambda_function')
+MAX_TARGETS_PER_RULE = 5  # EventBridge quota
+MAX_TARGET_INPUT_SIZE = 8192  # EventBridge quota, characters of the Input of a target
+SHARD_SUFFIX_PATTERN = re.compile(r'-s(\d+)$')
+MAX_TARGETS_PER_PUT_TARGETS_CALL = 10  # EventBridge API limit
 
 
 class EventBridgeException(Exception):
@@ -37,41 +102,144 @@ class LambdaSchedulerException(Exception):
 
 
 class EventBridge:
-    def __init__(self, client=None) -> None:
+    def __init__(self, client=None, executor=None, metrics=None, job_store=None, invoker=None, snapshot_path=None,
+                 shard_name=None) -> None:
         # TODO: check the client type to be 'events'
-        self.client = client if client else boto3.client('events')
-        self._rules = []  # cache
-
-    def list_rules(self, refresh=False, next_token=None, name_prefix=None):
-        """ calls itself recursively for SDK pagination """
-        if refresh is False and self._rules != []:
-            return self._rules  # caching
-
-        all_rules = []
-        response = None
+        if not client:
+            import boto3
+            client = boto3.client('events')
+        self.client = client
+        self.metrics = metrics if metrics else _metrics
+        self.executor = executor if executor else BulkExecutor(
+            max_workers=BULK_MAX_WORKERS, max_rate=EVENTBRIDGE_MAX_TPS, max_retries=THROTTLE_MAX_RETRIES)
+        if self.executor.metrics is None:
+            self.executor.metrics = self.metrics
+        self.rule_index = RuleIndex()
+        self._bucket_selector = None
+        self._cleanup_watermark = None  # (date, rule_name) of the last rule processed by an unfinished sweep
+        self._cleanup_swept_at = None  # time.monotonic() of the last completed sweep
+        self._snapshot_revision = None  # revision of the RuleIndex saved or restored last
+        self._job_store = job_store
+        self._invoker = invoker
+        self.scheduler_function_arn = SCHEDULER_FUNCTION_ARN or None
+        # the rule index of every client has to be saved to a file of its own, see sharding.py
+        self.snapshot_path = snapshot_path if snapshot_path is not None else RULE_INDEX_SNAPSHOT_PATH
+        # the name of the shard of a sharding.ShardedScheduler, set on its dispatch targets and job store buckets
+        self.shard_name = shard_name
+
+    def list_rules_page(self, name_prefix=None, next_token=None):
+        """returns a single page of the rules and the token of the next page, False if it's the last page."""
         list_rules_kwargs = {}
         if next_token:
             list_rules_kwargs['NextToken'] = next_token
         if name_prefix:
             list_rules_kwargs['NamePrefix'] = name_prefix
 
-        response = self.client.list_rules(
-            **list_rules_kwargs
-        )
+        response = self.executor.call(
+            self.client.list_rules, **list_rules_kwargs)
 
         if not self.is_boto3_response_successful(response):
             raise EventBridgeException(
                 "Can't list the existing EventBridge Rules.")
+        return response.get('Rules', []), response.get('NextToken', False)
+
+    def iter_rules(self, name_prefix=None, next_token=None):
+        """yields the rules page by page, following the SDK pagination.
+        the next page is only requested when the consumer gets to it, so breaking out of the loop early saves the calls."""
+        while True:
+            rules, next_token = self.list_rules_page(name_prefix, next_token)
+            yield from rules
+            if not next_token:
+                return
+
+    def describe_rule(self, rule_name, event_bus_name='default'):
+        """returns the rule with the exact name with a single call, or None if it doesn't exist."""
+        try:
+            response = self.executor.call(
+                self.client.describe_rule, Name=rule_name, EventBusName=event_bus_name)
+        except Exception as e:
+            if get_boto3_error_code(e) == 'ResourceNotFoundException':
+                return None
+            raise
+        return {key: response.get(key) for key in ('Name', 'Arn', 'ScheduleExpression', 'State')}
+
+    def get_rule_index(self, refresh=False) -> RuleIndex:
+        """builds the RuleIndex of the prefixed rules, and rebuilds it after RULE_CACHE_TTL_SECONDS.
+        local writes keep it up to date in the meantime."""
+        fresh = not refresh and self.rule_index.is_fresh(RULE_CACHE_TTL_SECONDS)
+        if not fresh and not refresh and not self.rule_index.loaded:
+            # a new container, start from the snapshot of the previous one
+            fresh = self.restore_rule_index_snapshot()
+        self.metrics.record_cache('rule_index', hit=fresh)
+        if not fresh:
+            rules_with_dates = []
+            for rule in self.iter_rules(name_prefix=get_rule_prefix()):
+                try:
+                    rule_date = self.decode_cron_expr_to_date(
+                        rule.get('ScheduleExpression'))
+                except:
+                    # ignore un-supported cron expression exceptions
+                    continue
+                rules_with_dates.append((rule, rule_date))
+            self.rule_index.load(rules_with_dates)
+        return self.rule_index
+
+    def restore_rule_index_snapshot(self):
+        """loads the RuleIndex from the snapshot at snapshot_path, and validates it with
+        a single list_rules page: rules added or rescheduled since the snapshot are indexed again,
+        and the rules missing from the page are removed when the page is the whole list.
+        the targets aren't in the snapshot, they are listed again on use.
+        returns True if the snapshot is used."""
+        if not self.snapshot_path:
+            return False
+        snapshot = read_snapshot(self.snapshot_path)
+        if snapshot is None or snapshot['rule_prefix'] != get_rule_prefix():
+            self.metrics.record_cache('rule_index_snapshot', hit=False)
+            return False
+        try:
+            rules, next_token = self.list_rules_page(
+                name_prefix=get_rule_prefix())
+        except Exception as e:
+            print(f"Couldn't validate the rule index snapshot: {e}")
+            return False
 
-        # pagination of the SDK
-        response_next_token = response.get('NextToken', False)
-        if response_next_token:
-            next_rules = self.list_rules(
-                refresh=True, next_token=response_next_token, name_prefix=name_prefix)
-            all_rules.extend(next_rules)
-
-        all_rules.extend(response.get('Rules'))
-        return all_rules
+        age = time.time() - snapshot['indexed_at']
+        self.rule_index.load_snapshot(snapshot, loaded_at=time.monotonic() - age
+                                      if 0 <= age < RULE_CACHE_TTL_SECONDS else None)
+        listed_rule_names = set()
+        for rule in rules:
+            listed_rule_names.add(rule.get('Name'))
+            entry = self.rule_index.get(rule.get('Name'))
+            if entry is not None and entry['rule'].get('ScheduleExpression') == rule.get('ScheduleExpression'):
+                continue
+            try:
+                rule_date = self.decode_cron_expr_to_date(
+                    rule.get('ScheduleExpression'))
+            except:
+                continue
+            self.rule_index.add_rule(rule, rule_date)
+        if not next_token:
+            for rule_name in self.rule_index.rule_names():
+                if rule_name not in listed_rule_names:
+                    self.rule_index.remove_rule(rule_name)
+        self._snapshot_revision = self.rule_index.revision
+        self.metrics.record_cache('rule_index_snapshot', hit=True)
+        return True
+
+    @timed_phase('snapshot')
+    def save_rule_index_snapshot(self):
+        """saves the RuleIndex to snapshot_path if it has changed since it was saved or restored.
+        returns True if it is saved."""
+        if not self.snapshot_path or not self.rule_index.loaded \
+                or self.rule_index.revision == self._snapshot_revision:
+            return False
+        try:
+            self._snapshot_revision = self.rule_index.save_snapshot(
+                self.snapshot_path, get_rule_prefix())
+        except OSError as e:
+            print(f"Couldn't save the rule index snapshot: {e}")
+            return False
+        return True
 
     @staticmethod
     def is_boto3_response_successful(response):
@@ -79,130 +247,410 @@ class EventBridge:
             'ResponseMetadata', {}).get('HTTPStatusCode', 400)
         return 200 <= http_status_code < 300
 
-    def create_rule_target_concurrent_calls(self, rule_name, lambda_function_arn, data):
+    @staticmethod
+    def generate_target_id(rule_name, job_key=None):
+        """the target id of a job is derived from its idempotency key, the same job always gets the same id."""
+        if job_key is not None:
+            return f"{rule_name}{get_target_id_suffix(job_key)}"
         random_postfix = ''.join(random.choice(
             string.ascii_lowercase) for i in range(6))
-        target_id = f"{rule_name}-target-{random_postfix}"
-
-        response = self.client.put_targets(
-            Rule=rule_name,
-            EventBusName='default',
-            Targets=[
-                {
-                    'Id': target_id,
-                    'Arn': lambda_function_arn,
-                    'Input': json.dumps(data),
-                },
-            ]
-        )
-        success = self.is_boto3_response_successful(response)
-        failed_entries = response.get('FailedEntryCount', None)
-        failed_entry_count = response.get('FailedEntries', None)
-        return {'success': success, 'failed_entry_count': failed_entry_count, 'failed_entries': failed_entries}
-
-    def create_rule_target_input_concat(self, rule_name, target, new_data):
-        """updates the EventBridgeRule(rule_name)s target data with the new data.
-        the logic of the json data updation can be customized with impementing
-        your own input_concatenators.EventBridgeInputConcatenator abstract class.
-        Also you need to set the environment variable: INPUT_CONCATENATOR_MODULE_NAME 
-        and INPUT_CONCATENATOR_CLASS_NAME to be your module and class name."""
-        input_class_obj: EventBridgeInputConcatenator = None
-        if not INPUT_CONCATENATOR_CLASS_NAME:
-            raise EventBridgeException(
-                f'Please implement your subclass and update the environment variable: INPUT_CONCATENATOR_CLASS_NAME')
-        try:
-            # python magic to grab the non-imported class in runtime with module and class name.
-            input_concat_class = get_class_by_name_and_module(
-                INPUT_CONCATENATOR_MODULE_NAME, INPUT_CONCATENATOR_CLASS_NAME)
-            input_class_obj = input_concat_class()
-        except:
-            raise EventBridgeException(
-                f'Couldnt import class {INPUT_CONCATENATOR_MODULE_NAME}.{INPUT_CONCATENATOR_CLASS_NAME}. Please implement your subclass and update the environment variable: INPUT_CONCATENATOR_CLASS_NAME')
+        return f"{rule_name}-target-{random_postfix}"
 
-        target_lambda_arn = target.get('Arn')
-        target_id = target.get('Id')
-        target_input = json.loads(target.get('Input', {}))
-        # get the combined data and save the target
-        combined_data = input_class_obj.concatenate_inputs(
-            target_input, new_data)
-
-        response = self.client.put_targets(
-            Rule=rule_name,
-            EventBusName='default',
-            Targets=[
-                {
-                    'Id': target_id,
-                    'Arn': target_lambda_arn,
-                    'Input': json.dumps(combined_data),
-                },
-            ]
-        )
-        success = self.is_boto3_response_successful(response)
-        return {'success': success}
-
-    def create_rule_target(self, rule_name, lambda_function_arn, data):
+    @staticmethod
+    def generate_job_key(event, lambda_function_arn):
+        """returns the idempotency key of the event's job: the hash of the caller's 'idempotency_key',
+        or of the minute bucket, lambda arn and canonical json data of the event."""
+        idempotency_key = event.get('idempotency_key')
+        if idempotency_key is None:
+            date = event.get('datetime_utc')
+            idempotency_key = json.dumps([f'{date.year}-{date.month}-{date.day}--{date.hour}-{date.minute}',
+                                          lambda_function_arn, event.get('data')], sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(str(idempotency_key).encode()).hexdigest()
+
+    def find_scheduled_job(self, rules_targets, job_key):
+        """returns (rule_name, target_id) of the target the job is already written to, or None.
+        rules_targets are (rule_name, targets) pairs, targets may be None if they are unknown.
+        the job keys known to the RuleIndex and the deterministic target ids are looked up, without any api calls."""
+        target_id_suffix = get_target_id_suffix(job_key)
+        for rule_name, targets in rules_targets:
+            target_id = self.rule_index.get_job_keys(rule_name).get(job_key)
+            if target_id is None:
+                target_id = next((target.get('Id') for target in targets or []
+                                  if target.get('Id', '').endswith(target_id_suffix)), None)
+            if target_id is not None:
+                return rule_name, target_id
+        return None
+
+    @timed_phase('target_write')
+    def put_rule_targets(self, rule_name, targets, event_bus_name='default'):
+        """writes the targets with as few put_targets calls as possible.
+        put_targets accepts at most MAX_TARGETS_PER_PUT_TARGETS_CALL targets per call."""
+        success = True
+        failed_entries = []
+        for i in range(0, len(targets), MAX_TARGETS_PER_PUT_TARGETS_CALL):
+            response = self.executor.call(self.client.put_targets,
+                Rule=rule_name,
+                EventBusName=event_bus_name,
+                Targets=targets[i:i + MAX_TARGETS_PER_PUT_TARGETS_CALL]
+            )
+            success = success and self.is_boto3_response_successful(response)
+            failed_entries.extend(response.get('FailedEntries', []))
+        return {'success': success and not failed_entries,
+                'failed_entry_count': len(failed_entries), 'failed_entries': failed_entries}
+
+    def get_input_concatenator(self) -> EventBridgeInputConcatenator:
+        """returns the input concatenator resolved at import time, see load_input_concatenator."""
+        global _input_concatenator
+        if _input_concatenator is None:
+            try:
+                _input_concatenator = load_input_concatenator()
+            except LambdaSchedulerException as e:
+                raise EventBridgeException(str(e))
+        return _input_concatenator
+
+    def get_bucket_selector(self) -> EventBridgeBucketSelector:
+        """the rule selection of ALLOWED_T_MINUS_MINUTES can be customized with implementing
+        your own bucket_selectors.EventBridgeBucketSelector abstract class.
+        Also you need to set the environment variable: BUCKET_SELECTOR_MODULE_NAME
+        and BUCKET_SELECTOR_CLASS_NAME to be your module and class name."""
+        if self._bucket_selector is None:
+            try:
+                bucket_selector_class = get_class_by_name_and_module(
+                    BUCKET_SELECTOR_MODULE_NAME, BUCKET_SELECTOR_CLASS_NAME)
+                self._bucket_selector = bucket_selector_class()
+            except:
+                raise EventBridgeException(
+                    f'Couldnt import class {BUCKET_SELECTOR_MODULE_NAME}.{BUCKET_SELECTOR_CLASS_NAME}. Please implement your subclass and update the environment variable: BUCKET_SELECTOR_CLASS_NAME')
+        return self._bucket_selector
+
+    def get_job_store(self) -> JobStore:
+        """the storage of the DISPATCHER jobs can be customized with implementing your own
+        job_stores.JobStore abstract class. Also you need to set the environment variable:
+        JOB_STORE_MODULE_NAME and JOB_STORE_CLASS_NAME to be your module and class name."""
+        if self._job_store is None:
+            if not JOB_STORE_CLASS_NAME:
+                raise EventBridgeException(
+                    "Please set the environment variable: JOB_STORE_CLASS_NAME, e.g. 'DynamoDBJobStore'")
+            try:
+                job_store_class = get_class_by_name_and_module(
+                    JOB_STORE_MODULE_NAME, JOB_STORE_CLASS_NAME)
+                self._job_store = job_store_class()
+            except Exception as e:
+                raise EventBridgeException(
+                    f"Couldn't create the job store {JOB_STORE_MODULE_NAME}.{JOB_STORE_CLASS_NAME}: {e}")
+        if self.shard_name and not isinstance(self._job_store, PrefixedJobStore):
+            # the shards share the job store, and have rules of the same names
+            self._job_store = PrefixedJobStore(self._job_store, f'{self.shard_name}:')
+        return self._job_store
+
+    def get_lambda_invoker(self) -> LambdaInvoker:
+        if self._invoker is None:
+            self._invoker = LambdaInvoker(executor=BulkExecutor(
+                max_workers=DISPATCH_MAX_WORKERS, max_rate=LAMBDA_INVOKE_MAX_TPS,
+                max_retries=THROTTLE_MAX_RETRIES, metrics=self.metrics))
+        return self._invoker
+
+    def create_rule_targets(self, rule_name, jobs, overflow=None, attempt=0, recreated=False):
+        """adds the jobs, a list of (lambda_function_arn, data) or (lambda_function_arn, data, job_key) tuples,
+        as the targets of the rule. existing targets are listed once and all new or updated targets are written together.
+        a job with a job_key that is already on the rule is a no-op, its result has 'duplicate' set.
+        a job whose target Input would be over MAX_TARGET_INPUT_SIZE fails alone, the other targets are still written.
+        returns a result dict for every job, in the same order.
+        if an overflow list is given, indexes of the jobs that don't fit on the rule are appended
+        to it and their results are left None, instead of failing them.
+
+        EventBridge has no conditional writes, so the writes are optimistic and checked afterwards, up to
+        WRITE_CONFLICT_MAX_RETRIES times: the targets are listed again when another container has taken the
+        free target slots. the jobs are always concatenated into freshly listed inputs, the cached targets are only
+        used to place them. with WRITE_CONFLICT_CHECK_ENABLED, if the input_concatenator implements contains_inputs,
+        the targets are read back to check that a concurrent write hasn't overwritten the merged jobs. the jobs that are lost are written again.
+        the check is best-effort, a concurrent write slower than the read back delay goes unnoticed.
+        a rule deleted by another container since it's indexed is created again once, see recreate_rule."""
         rule_name = prefix_the_rule_name(rule_name)
 
+        input_concatenator = None
+        if RULE_TARGET_ADDING_STRATEGY == 'INPUT_CONCATENATOR':
+            try:
+                input_concatenator = self.get_input_concatenator()
+            except EventBridgeException as e:
+                return [{'success': False, 'exception': str(e)} for _ in jobs]
+
         response = self.get_rules_targets(rule_name)
+        if response.get('cached', False) and input_concatenator is not None and \
+                any(target.get('Arn') in {job[0] for job in jobs} for target in response.get('targets')):
+            # the cached inputs miss the jobs merged in by the other containers since, merge into the current ones
+            response = self.get_rules_targets(rule_name, refresh=True)
         if not response.get('success', False):
-            raise EventBridgeException(
-                f"Can't list rule targets for the rule: {rule_name}")
+            if not recreated and get_boto3_error_code(response.get('exception')) == 'ResourceNotFoundException' \
+                    and self.recreate_rule(rule_name):
+                return self.create_rule_targets(rule_name, jobs, overflow, attempt, recreated=True)
+            message = f"Can't list rule targets for the rule: {rule_name}"
+            return [{'success': False, 'exception': message} for _ in jobs]
 
         existing_rule_targets = response.get('targets')
+        free_target_slots = MAX_TARGETS_PER_RULE - len(existing_rule_targets)
+        results = [None] * len(jobs)
+        pending_targets = {}  # target_id -> target, new or updated targets to write
+        pending_jobs = {}  # target_id -> indexes of the jobs written to the target
+        decoded_inputs = {}  # target_id -> data, to merge many jobs into the same target
+
+        # repeated submissions of the same job are no-ops, and are kept out of the merges
+        new_indexes = []
+        first_indexes = {}  # job_key -> index of its first job in this call
+        repeated_indexes = {}  # index -> index of the first job with the same job_key
+        for index, job in enumerate(jobs):
+            job_key = job[2] if len(job) > 2 else None
+            scheduled_job = None if job_key is None else self.find_scheduled_job(
+                [(rule_name, existing_rule_targets)], job_key)
+            if scheduled_job is not None:
+                results[index] = {'success': True, 'duplicate': True, 'rule_name': rule_name,
+                                  'target_id': scheduled_job[1], 'job_id': generate_job_id(rule_name, job_key)}
+            elif job_key is not None and job_key in first_indexes:
+                repeated_indexes[index] = first_indexes[job_key]
+            elif len(json.dumps(job[1])) > MAX_TARGET_INPUT_SIZE:
+                results[index] = {'success': False, 'exception': (
+                    f"The data of the job is {len(json.dumps(job[1]))} characters as json, "
+                    f"max. allowed target Input is {MAX_TARGET_INPUT_SIZE}.")}
+            else:
+                if job_key is not None:
+                    first_indexes[job_key] = index
+                new_indexes.append(index)
 
-        if RULE_TARGET_ADDING_STRATEGY == 'CONCURRENT_LAMBDA_TARGETS' \
-                and len(existing_rule_targets) < 5:
-            result = self.create_rule_target_concurrent_calls(
-                rule_name, lambda_function_arn, data)
-            return result
-        elif len(existing_rule_targets) >= 5:
-            raise EventBridgeException(
-                f"Max. allowed rule target count is 5. Can't add a new rule target. Please implement env(RULE_TARGET_ADDING_STRATEGY,'INPUT_CONCATENATOR'). {lambda_function_arn} {data}")
-
-        if RULE_TARGET_ADDING_STRATEGY == 'INPUT_CONCATENATOR':
-            # select the rule target with the same lambda
-            if len(existing_rule_targets) == 0:
-                result = self.create_rule_target_concurrent_calls(
-                    rule_name, lambda_function_arn, data)
-                return result
-            selected_ert = None
-            for ert in existing_rule_targets:
-                if ert.get('Arn', False) == lambda_function_arn:
-                    selected_ert = ert
-                    break
-
-            if selected_ert is None:
-                # create concurrent bc there is no matching lambda.
-                result = self.create_rule_target_concurrent_calls(
-                    rule_name, lambda_function_arn, data)
-                return result
+        def concatenate_into_target(target_id, lambda_function_arn, indexes):
+            """concatenates the data of the jobs into the target in one pass.
+            returns the indexes of the jobs that didn't fit."""
+            try:
+                decoded_inputs[target_id] = input_concatenator.concatenate_many(
+                    decoded_inputs[target_id], [jobs[index][1] for index in indexes])
+                remaining_indexes = []
+            except EventBridgeInputSizeExceeded as e:
+                if e.merged_data is None or e.remaining_items is None:
+                    return indexes
+                decoded_inputs[target_id] = e.merged_data
+                remaining_indexes = indexes[len(
+                    indexes) - len(e.remaining_items):]
+            merged_indexes = indexes[:len(indexes) - len(remaining_indexes)]
+            if merged_indexes:
+                pending_targets.setdefault(
+                    target_id, {'Id': target_id, 'Arn': lambda_function_arn})
+                pending_jobs.setdefault(target_id, []).extend(merged_indexes)
+            return remaining_indexes
+
+        # the jobs of the same lambda are concatenated together
+        if input_concatenator is not None:
+            indexes_by_arn = {}
+            for index in new_indexes:
+                indexes_by_arn.setdefault(
+                    jobs[index][0], []).append(index)
+            job_groups = list(indexes_by_arn.values())
+        else:
+            job_groups = [[index] for index in new_indexes]
+
+        for indexes in job_groups:
+            lambda_function_arn = jobs[indexes[0]][0]
+            if input_concatenator is not None:
+                # update the data of the rule targets with the same lambda, the jobs that don't fit go to the next target
+                for target in existing_rule_targets:
+                    if not indexes:
+                        break
+                    if target.get('Arn', False) != lambda_function_arn:
+                        continue
+                    if target.get('Id') not in decoded_inputs:
+                        decoded_inputs[target.get('Id')] = json.loads(
+                            target.get('Input', '{}'))
+                    indexes = concatenate_into_target(
+                        target.get('Id'), lambda_function_arn, indexes)
+
+            while indexes and free_target_slots > 0:
+                # create concurrent bc there is no matching lambda, or the matching targets are full.
+                free_target_slots -= 1
+                target_id = self.generate_target_id(
+                    rule_name, jobs[indexes[0]][2] if len(jobs[indexes[0]]) > 2 else None)
+                pending_targets[target_id] = {
+                    'Id': target_id,
+                    'Arn': lambda_function_arn,
+                    'Input': json.dumps(jobs[indexes[0]][1]),
+                }
+                pending_jobs[target_id] = [indexes[0]]
+                indexes = indexes[1:]
+                if input_concatenator is not None and indexes:
+                    decoded_inputs[target_id] = json.loads(
+                        pending_targets[target_id]['Input'])
+                    indexes = concatenate_into_target(
+                        target_id, lambda_function_arn, indexes)
+
+            for index in indexes:
+                if overflow is not None:
+                    overflow.append(index)
+                else:
+                    lambda_function_arn, data = jobs[index][:2]
+                    results[index] = {'success': False, 'exception': (
+                        f"Max. allowed rule target count is {MAX_TARGETS_PER_RULE}. Can't add a new rule target. "
+                        f"Please implement env(RULE_TARGET_ADDING_STRATEGY,'INPUT_CONCATENATOR'). {lambda_function_arn} {data}")}
+
+        # serialize the concatenated inputs once, after all of the merges
+        for target_id, decoded_input in decoded_inputs.items():
+            if target_id in pending_targets:
+                pending_targets[target_id]['Input'] = json.dumps(decoded_input)
+        # an Input over the limit would fail the put_targets of the other targets too, e.g. the merges
+        # of an input_concatenator that doesn't check the size, see EventBridgeCompactArrayInput
+        for target_id, target in list(pending_targets.items()):
+            if len(target['Input']) > MAX_TARGET_INPUT_SIZE:
+                for index in pending_jobs.pop(target_id):
+                    results[index] = {'success': False, 'exception': (
+                        f"The Input of the target {target_id} would be {len(target['Input'])} characters, "
+                        f"max. allowed is {MAX_TARGET_INPUT_SIZE}.")}
+                del pending_targets[target_id]
+
+        if pending_targets:
+            try:
+                response = self.put_rule_targets(
+                    rule_name, list(pending_targets.values()))
+            except Exception as e:
+                if get_boto3_error_code(e) == 'ResourceNotFoundException' and not recreated \
+                        and self.recreate_rule(rule_name):
+                    return self.create_rule_targets(rule_name, jobs, overflow, attempt, recreated=True)
+                if get_boto3_error_code(e) == 'LimitExceededException' and attempt < WRITE_CONFLICT_MAX_RETRIES:
+                    # another container has taken the free target slots since they were listed
+                    self.metrics.increment('write_conflicts')
+                    self.rule_index.set_targets(rule_name, None)
+                    backoff_before_retry(attempt)
+                    return self.create_rule_targets(rule_name, jobs, overflow, attempt + 1)
+                response = {'success': False, 'exception': str(e)}
+            failed_entries = response.get('failed_entries', [])
+            failed_target_ids = {entry.get('TargetId')
+                                 for entry in failed_entries}
+            for target_id, indexes in pending_jobs.items():
+                if response.get('success', False):
+                    result = {'success': True}
+                elif failed_entries and target_id not in failed_target_ids:
+                    result = {'success': True}  # only some of the targets failed
+                else:
+                    result = {'success': False, 'exception': response.get(
+                        'exception', f"Can't put the target {target_id} on the rule: {rule_name}")}
+                result.update({'rule_name': rule_name, 'target_id': target_id})
+                for index in indexes:
+                    results[index] = dict(result)
+                    if len(jobs[index]) > 2 and result['success']:
+                        results[index]['job_id'] = generate_job_id(rule_name, jobs[index][2])
+            written_targets = [target for target_id, target in pending_targets.items()
+                               if results[pending_jobs[target_id][0]].get('success')]
+            self.rule_index.upsert_targets(rule_name, written_targets)
+            written_indexes = [(index, target['Id']) for target in written_targets
+                               for index in pending_jobs[target['Id']] if len(jobs[index]) > 2]
+            # the data of the merged jobs is kept, to take them out of the target again on cancel
+            self.rule_index.add_job_keys(
+                rule_name, {jobs[index][2]: target_id for index, target_id in written_indexes},
+                {jobs[index][2]: jobs[index][1] for index, _ in written_indexes} if input_concatenator is not None else None)
+            if len(written_targets) < len(pending_targets):
+                # the cached targets may be stale, list them again on the next write.
+                self.rule_index.set_targets(rule_name, None)
+
+            # the existing targets are read-modify-written, a concurrent write may have overwritten the merged jobs
+            existing_target_ids = {target.get('Id') for target in existing_rule_targets}
+            merged_jobs = {target['Id']: pending_jobs[target['Id']] for target in written_targets
+                           if target['Id'] in existing_target_ids} \
+                if WRITE_CONFLICT_CHECK_ENABLED and can_verify_inputs(input_concatenator) else {}
+            lost_indexes = []
+            if merged_jobs:
+                # give the writes of the other containers that read the targets before this one a moment to land,
+                # jittered so the racing writers don't read back in lockstep.
+                time.sleep(random.uniform(WRITE_CONFLICT_BACKOFF_SECONDS / 2, WRITE_CONFLICT_BACKOFF_SECONDS))
+                lost_indexes = self.verify_merged_targets(
+                    rule_name, merged_jobs, jobs, input_concatenator)
+            if lost_indexes:
+                self.metrics.increment('write_conflicts')
+                self.rule_index.remove_job_keys(
+                    rule_name, [jobs[index][2] for index in lost_indexes if len(jobs[index]) > 2])
+                if attempt < WRITE_CONFLICT_MAX_RETRIES:
+                    backoff_before_retry(attempt)
+                    retry_overflow = None if overflow is None else []
+                    retry_results = self.create_rule_targets(
+                        rule_name, [jobs[index] for index in lost_indexes], retry_overflow, attempt + 1)
+                    for index, result in zip(lost_indexes, retry_results):
+                        results[index] = result
+                    for retry_index in retry_overflow or []:
+                        overflow.append(lost_indexes[retry_index])
+                else:
+                    for index in lost_indexes:
+                        results[index] = {'success': False, 'exception': (
+                            f"The target {results[index].get('target_id')} on the rule {rule_name} is overwritten by "
+                            f"concurrent writes {WRITE_CONFLICT_MAX_RETRIES + 1} times.")}
+
+        for index, first_index in repeated_indexes.items():
+            if results[first_index] is None:
+                overflow.append(index)  # the first job has overflowed too
             else:
-                # update the data
-                result = self.create_rule_target_input_concat(
-                    rule_name, target=selected_ert, new_data=data)
-                return result
+                results[index] = {**results[first_index], 'duplicate': True}
+        return results
+
+    def verify_merged_targets(self, rule_name, merged_jobs, jobs, input_concatenator):
+        """reads the targets of the rule back after a write. merged_jobs is {target_id: indexes of the jobs}
+        concatenated into the existing targets. returns the indexes of the jobs that aren't in their target anymore.
+        see can_verify_inputs, a concatenator without contains_inputs can't verify them."""
+        try:
+            targets = {target.get('Id'): target for target in self.iter_rules_targets(rule_name)}
+        except Exception as e:
+            print(f"Couldn't verify the targets of the rule {rule_name}: {e}")
+            self.rule_index.set_targets(rule_name, None)
+            return []
+        self.rule_index.set_targets(rule_name, list(targets.values()))
+        lost_indexes = []
+        for target_id, indexes in merged_jobs.items():
+            target = targets.get(target_id)
+            if target is None:
+                lost_indexes.extend(indexes)  # removed, e.g. cancelled by another container
+                continue
+            data = json.loads(target.get('Input', '{}'))
+            try:
+                lost_indexes.extend(index for index in indexes
+                                    if not input_concatenator.contains_inputs(data, [jobs[index][1]]))
+            except NotImplementedError:
+                pass
+        return sorted(lost_indexes)
+
+    def recreate_rule(self, rule_name):
+        """creates the rule again after a call has found it deleted, e.g. by another container cancelling its last job.
+        create_rule skips the put_rule of an indexed rule, so the stale entry is dropped from the RuleIndex first.
+        returns True if the rule is created."""
+        entry = self.rule_index.get(rule_name)
+        date = entry['date'] if entry is not None else decode_rule_name_to_date(rule_name)
+        self.rule_index.remove_rule(rule_name)
+        if date is None:
+            return False
+        try:
+            return self.create_rule(rule_name, date).get('success', False)
+        except Exception as e:
+            print(f"Couldn't create the rule {rule_name} again: {e}")
+            return False
 
-        return {"success": False}
+    def create_rule_target(self, rule_name, lambda_function_arn, data):
+        return self.create_rule_targets(rule_name, [(lambda_function_arn, data)])[0]
 
+    @timed_phase('rule_create')
     def create_rule(self, rule_name, date, state='ENABLED', event_bus_name="default"):
-        # date = datetime.datetime.now(tz=dateutil.tz.UTC) # TODO: move this
         cron_expr = self.create_cron_expr_for_date(date)
         rule_name = prefix_the_rule_name(rule_name)
         # check if the rule already exists.
-
-        rules = self.list_rules(name_prefix=get_rule_prefix())
         response = None
         success = False
+        created = False
         created_rule_arn = False
-        for rule in rules:
-            if rule.get('Name') == rule_name:
-                response = rule
-                success = True
-                created_rule_arn = response.get('Arn', False)
-                break
+        indexed_rule = self.get_rule_index().get(rule_name)
+        self.metrics.record_cache('rule', hit=indexed_rule is not None)
+        if indexed_rule is not None:
+            response = indexed_rule['rule']
+        else:
+            # not seen by this container yet, check the exact name with a single call
+            response = self.describe_rule(rule_name, event_bus_name)
+            if response is not None:
+                self.rule_index.add_rule(response, date)
+        if response is not None:
+            success = True
+            created_rule_arn = response.get('Arn', False)
 
         if response is None:
-            response = self.client.put_rule(
+            response = self.executor.call(self.client.put_rule,
                 Name=rule_name,
                 ScheduleExpression=cron_expr,
                 State=state,
@@ -216,9 +664,14 @@ class EventBridge:
             )
 
             success = self.is_boto3_response_successful(response)
+            created = success
             created_rule_arn = response.get('RuleArn', False)
+            if created:
+                self.rule_index.add_rule({'Name': rule_name, 'Arn': created_rule_arn,
+                                          'ScheduleExpression': cron_expr, 'State': state},
+                                         self.decode_cron_expr_to_date(cron_expr), targets=[])
 
-        return {'success': success, 'rule_arn': created_rule_arn, 'rule_name': rule_name}
+        return {'success': success, 'created': created, 'rule_arn': created_rule_arn, 'rule_name': rule_name}
 
     def get_environment_lambda_name_to_arn_mapping(self):
         prefix = LAMBDA_FUNCTION_NAME_TO_ARN_MAPPING_PREFIX
@@ -243,53 +696,681 @@ class EventBridge:
                   f'environment variable prefix {LAMBDA_FUNCTION_NAME_TO_ARN_MAPPING_PREFIX}')
         return name_to_arn_map.get(key, default_to)
 
-    def create_rule_from_event(self, event):
-        rule_name = self.generate_rule_name_from_event(event)
-        date = event.get('datetime_utc')
-        input_lambda_function = event.get('lambda_function')
-        data = event.get('data')
-        lambda_function_arn = None
-
-        # TODO DELETE THIS
-        # return self.create_rule_target('AUTO_2021-7-7--8-53', lambda_function_arn, data)
-
+    def get_lambda_function_arn(self, input_lambda_function):
         # get the arn either from event, or the environment variables prefixed with LAMBDA_FUNCTION_NAME_TO_ARN_MAPPING_PREFIX
         if input_lambda_function.startswith('arn:'):
-            lambda_function_arn = input_lambda_function
+            return input_lambda_function
+        env_lambda_arn = self.get_from_lambda_name_to_arn_mapping(
+            input_lambda_function, False)
+        if env_lambda_arn:
+            return env_lambda_arn
+        raise EventBridgeException(
+            f'{input_lambda_function} is not an ARN or mapped in the environment variables.')
+
+    def create_rule_from_event(self, event):
+        """schedules a single event, or a list of events with create_rules_from_events."""
+        if isinstance(event, list):
+            return self.create_rules_from_events(event)
+
+        result = self.create_rules_from_events([event]).get('results')[0]
+        if not result.get('success', False) and result.get('exception'):
+            raise EventBridgeException(result.get('exception'))
+        return {'success': result.get('success', False),
+                **{key: result[key] for key in ('duplicate', 'rule_name', 'target_id', 'job_id') if key in result}}
+
+    def create_rules_from_events(self, events):
+        """schedules a batch of events in one pass over the EventBridge Rules.
+        events are grouped by their minute bucket and lambda arn, then every rule is
+        created with one put_rule and its targets are written with multi-target put_targets calls.
+        returns {'success': bool, 'results': [...]} with a result for every event, in the same order."""
+        if RULE_TARGET_ADDING_STRATEGY == 'DISPATCHER':
+            return self.create_dispatch_rules_from_events(events)
+
+        results = [None] * len(events)
+        buckets = self.plan_buckets(events, results)
+
+        # create the rules and their targets, concurrently
+        outcomes = self.executor.map(
+            lambda item: self.create_rule_and_targets(*item), buckets.items())
+        for (rule_name, bucket), outcome in zip(buckets.items(), outcomes):
+            jobs = bucket['jobs']
+            target_results = outcome.get('result') if outcome.get('success') else \
+                [{'success': False, 'exception': str(outcome.get('exception'))} for _ in jobs]
+            for (index, _, _, _), target_result in zip(jobs, target_results):
+                results[index] = target_result
+
+        return {'success': all(result.get('success', False) for result in results), 'results': results}
+
+    @timed_phase('bucket_lookup')
+    def plan_buckets(self, events, results):
+        """groups the events by their lambda arn and the rule they go to, selecting the rules within
+        ALLOWED_T_MINUS_MINUTES with the bucket selector. the results of the events that can't be
+        scheduled, or are already scheduled, are set in results.
+        returns {rule_name: {'date': date, 'jobs': [(index, lambda_function_arn, data, job_key)]}}"""
+        groups = {}  # (rule_name, lambda_function_arn) -> {'date': date, 'jobs': [(index, lambda_function_arn, data, job_key)]}
+        for index, event in enumerate(events):
+            try:
+                lambda_function_arn = self.get_lambda_function_arn(
+                    event.get('lambda_function'))
+            except EventBridgeException as e:
+                results[index] = {'success': False, 'exception': str(e)}
+                continue
+            rule_name = self.generate_rule_name_from_event(event)
+            group = groups.setdefault((rule_name, lambda_function_arn), {
+                                      'date': event.get('datetime_utc'), 'jobs': []})
+            group['jobs'].append((index, lambda_function_arn, event.get('data'),
+                                  self.generate_job_key(event, lambda_function_arn)))
+
+        buckets = {}  # rule_name -> {'date': date, 'jobs': [(index, lambda_function_arn, data, job_key)]}
+        if ALLOWED_T_MINUS_MINUTES is False:
+            for (rule_name, _), group in groups.items():
+                bucket = buckets.setdefault(
+                    rule_name, {'date': group['date'], 'jobs': []})
+                bucket['jobs'].extend(group['jobs'])
         else:
-            env_lambda_arn = self.get_from_lambda_name_to_arn_mapping(
-                input_lambda_function, False)
-            if env_lambda_arn:
-                lambda_function_arn = env_lambda_arn
+            # if ALLOWED_T_MINUS_ is enabled, select a rule within the window once per group with the bucket selector.
+            # rules selected for the earlier groups of the same batch are candidates too.
+            allowed_t_minus_minutes = int(ALLOWED_T_MINUS_MINUTES)
+            concatenate = RULE_TARGET_ADDING_STRATEGY == 'INPUT_CONCATENATOR'
+            planned_rules = {}  # rule_name -> candidate rule, with the targets planned in this batch
+            for (rule_name, lambda_function_arn), group in sorted(groups.items(), key=lambda item: item[1]['date']):
+                date = group['date']
+                candidates = {rule['Name']: rule for rule in self.find_rules_close_to_a_date(
+                    date, allowed_t_minus_minutes, lambda_function_arn, name_prefix=get_rule_prefix(), with_targets=True)}
+                offset_ago = date - \
+                    datetime.timedelta(minutes=allowed_t_minus_minutes)
+                for planned_rule in planned_rules.values():
+                    if offset_ago <= planned_rule['cron_datetime'] <= date:
+                        candidates[planned_rule['Name']] = planned_rule
+
+                # the jobs already written to a rule within the window are no-ops
+                candidates_targets = [(rule['Name'], rule['targets'])
+                                      for rule in candidates.values()]
+                jobs = []
+                for job in group['jobs']:
+                    scheduled_job = self.find_scheduled_job(
+                        candidates_targets, job[3])
+                    if scheduled_job is None:
+                        jobs.append(job)
+                    else:
+                        results[job[0]] = {'success': True, 'duplicate': True, 'rule_name': scheduled_job[0],
+                                           'target_id': scheduled_job[1], 'job_id': generate_job_id(scheduled_job[0], job[3])}
+                if not jobs:
+                    continue
+                group['jobs'] = jobs
+
+                slots_needed = 1 if concatenate else len(group['jobs'])
+                selected_rule = self.get_bucket_selector().select_rule(
+                    list(candidates.values()), date, lambda_function_arn, slots_needed=slots_needed,
+                    concatenate=concatenate, max_targets=MAX_TARGETS_PER_RULE)
+                if selected_rule is None:
+                    # a new rule, or a sibling shard rule if the rule of the minute is full
+                    selected_rule = {'Name': rule_name, 'cron_datetime': date,
+                                     'targets': [], 'target_count': 0}
+                else:
+                    selected_rule = {**selected_rule,
+                                     'targets': list(selected_rule['targets'])}
+                rule_name = selected_rule['Name']
+
+                # plan the new targets, so the next groups can see them
+                if not (concatenate and any(target.get('Arn') == lambda_function_arn
+                                            for target in selected_rule['targets'])):
+                    selected_rule['targets'].extend(
+                        [{'Arn': lambda_function_arn}] * slots_needed)
+                selected_rule['target_count'] = len(selected_rule['targets'])
+                planned_rules[rule_name] = selected_rule
+
+                bucket = buckets.setdefault(rule_name, {
+                    'date': selected_rule['cron_datetime'], 'jobs': []})
+                bucket['jobs'].extend(group['jobs'])
+        return buckets
+
+    def create_dispatch_rules_from_events(self, events):
+        """schedules a batch of events with RULE_TARGET_ADDING_STRATEGY='DISPATCHER'.
+        the jobs are stored in the job store by their bucket, and every bucket gets a single rule that
+        invokes this lambda with {"action": "dispatch", "bucket": bucket} to run them.
+        returns {'success': bool, 'results': [...]} like create_rules_from_events."""
+        if not self.scheduler_function_arn:
+            message = 'Please set the environment variable: SCHEDULER_FUNCTION_ARN'
+            return {'success': False, 'results': [{'success': False, 'exception': message} for _ in events]}
+
+        results = [None] * len(events)
+        repeated_indexes = {}  # index -> index of the first event with the same job key
+        buckets = self.plan_dispatch_buckets(events, results, repeated_indexes)
+        outcomes = self.executor.map(
+            lambda item: self.create_dispatch_bucket(*item), buckets.items())
+        for (bucket_name, bucket), outcome in zip(buckets.items(), outcomes):
+            jobs = bucket['jobs']
+            job_results = outcome.get('result') if outcome.get('success') else \
+                [{'success': False, 'exception': str(outcome.get('exception'))} for _ in jobs]
+            for (index, _, _, _), job_result in zip(jobs, job_results):
+                results[index] = job_result
+        for index, first_index in repeated_indexes.items():
+            results[index] = {**results[first_index], 'duplicate': True}
+
+        return {'success': all(result.get('success', False) for result in results), 'results': results}
+
+    @timed_phase('bucket_lookup')
+    def plan_dispatch_buckets(self, events, results, repeated_indexes=None):
+        """groups the events by the bucket they are dispatched from. with ALLOWED_T_MINUS_MINUTES, the latest
+        bucket within the window is reused, else every minute is a bucket.
+        the repeats of a job key are kept out of the buckets, and set in repeated_indexes as {index: first index}.
+        returns {bucket: {'date': date, 'jobs': [(index, lambda_function_arn, data, job_key)]}}"""
+        repeated_indexes = repeated_indexes if repeated_indexes is not None else {}
+        buckets = {}
+        first_indexes = {}  # job_key -> index of its first event
+        for index, event in sorted(enumerate(events), key=lambda item: item[1].get('datetime_utc')):
+            try:
+                lambda_function_arn = self.get_lambda_function_arn(
+                    event.get('lambda_function'))
+            except EventBridgeException as e:
+                results[index] = {'success': False, 'exception': str(e)}
+                continue
+            job_key = self.generate_job_key(event, lambda_function_arn)
+            if job_key in first_indexes:
+                # the job store is keyed by the job key, and a write can't have the same key twice
+                repeated_indexes[index] = first_indexes[job_key]
+                continue
+            first_indexes[job_key] = index
+            date = event.get('datetime_utc')
+            bucket_name = self.generate_rule_name_from_event(event)
+            if ALLOWED_T_MINUS_MINUTES is not False and bucket_name not in buckets:
+                bucket_name, date = self.find_dispatch_bucket(
+                    date, int(ALLOWED_T_MINUS_MINUTES), buckets) or (bucket_name, date)
+            bucket = buckets.setdefault(bucket_name, {'date': date, 'jobs': []})
+            bucket['jobs'].append((index, lambda_function_arn, event.get('data'), job_key))
+        return buckets
+
+    def find_dispatch_bucket(self, date, t_minus_in_minutes, planned_buckets):
+        """returns the (bucket, date) of the latest bucket within [date - t_minus_in_minutes, date], or None.
+        the buckets planned in the same batch and the indexed rules with a known dispatch target are the candidates."""
+        offset_ago = date - datetime.timedelta(minutes=t_minus_in_minutes)
+        candidates = [(bucket['date'], bucket_name) for bucket_name, bucket in planned_buckets.items()
+                      if offset_ago <= bucket['date'] <= date]
+        for entry in self.get_rule_index().between(offset_ago, date):
+            for target in (entry['targets'] or {}).values():
+                bucket_name = self.get_dispatch_bucket_of_target(target)
+                if bucket_name is not None:
+                    candidates.append((entry['date'], bucket_name))
+        if not candidates:
+            return None
+        bucket_date, bucket_name = max(candidates)
+        return bucket_name, bucket_date
+
+    def get_dispatch_target(self, bucket_name):
+        dispatch_event = {'action': 'dispatch', 'bucket': bucket_name}
+        if self.shard_name:
+            dispatch_event['shard'] = self.shard_name
+        return {'Id': f'{bucket_name}-dispatch', 'Arn': self.scheduler_function_arn, 'Input': json.dumps(dispatch_event)}
+
+    def get_dispatch_bucket_of_target(self, target):
+        """returns the bucket the target dispatches, or None if it's not a dispatch target of this lambda."""
+        if target.get('Arn') != self.scheduler_function_arn or not target.get('Id', '').endswith('-dispatch'):
+            return None
+        try:
+            return json.loads(target.get('Input', '{}')).get('bucket')
+        except ValueError:
+            return None
+
+    def create_dispatch_bucket(self, bucket_name, bucket):
+        """stores the jobs of a bucket of create_dispatch_rules_from_events, and creates its dispatch rule.
+        the job key is the job id in the store, the jobs the bucket already has are reported as duplicates.
+        returns a result for every job of the bucket."""
+        jobs = [{'job_id': job_key, 'lambda_function_arn': lambda_function_arn, 'data': data}
+                for _, lambda_function_arn, data, job_key in bucket['jobs']]
+        job_store = self.get_job_store()
+        stored_job_ids = {job['job_id'] for job in job_store.get_jobs(bucket_name)}
+        new_jobs = [job for job in jobs if job['job_id'] not in stored_job_ids]
+        # the jobs are stored first, the rule may fire right after it's created
+        if new_jobs:
+            job_store.put_jobs(bucket_name, new_jobs)
+        try:
+            result = self.create_dispatch_rule(bucket_name, bucket['date'])
+        except Exception as e:
+            result = {'success': False, 'exception': str(e)}
+        if not result.get('success', False):
+            if new_jobs:
+                job_store.delete_jobs(
+                    bucket_name, [job['job_id'] for job in new_jobs])
+            return [dict(result) for _ in jobs]
+        return [{**result, 'job_id': generate_job_id(bucket_name, job['job_id']),
+                 **({'duplicate': True} if job['job_id'] in stored_job_ids else {})} for job in jobs]
+
+    def create_dispatch_rule(self, bucket_name, date):
+        """creates the rule of the bucket with the dispatch target, if it doesn't have it yet.
+        if the rule of the minute is full of other targets, the dispatch target goes on a sibling shard rule."""
+        target = self.get_dispatch_target(bucket_name)
+        shard_number = 0
+        attempt = 0
+        recreated = False
+        while True:
+            rule_name = get_shard_rule_name(bucket_name, shard_number)
+            rule = self.create_rule(rule_name, date)
+            if not rule.get('success', False):
+                return {'success': False, 'exception': rule.get('exception', f"Can't create the rule: {rule_name}")}
+            response = self.get_rules_targets(rule_name)
+            if not response.get('success', False):
+                if not recreated and get_boto3_error_code(response.get('exception')) == 'ResourceNotFoundException':
+                    # deleted by another container since it's indexed, create_rule puts it again
+                    self.rule_index.remove_rule(rule_name)
+                    recreated = True
+                    continue
+                return {'success': False, 'exception': f"Can't list rule targets for the rule: {rule_name}"}
+            targets = response.get('targets')
+            if any(existing_target.get('Id') == target['Id'] for existing_target in targets):
+                return {'success': True, 'rule_name': rule_name, 'bucket': bucket_name}
+            if len(targets) < MAX_TARGETS_PER_RULE:
+                try:
+                    response = self.put_rule_targets(rule_name, [target])
+                except Exception as e:
+                    if get_boto3_error_code(e) == 'ResourceNotFoundException' and not recreated:
+                        self.rule_index.remove_rule(rule_name)
+                        recreated = True
+                        continue
+                    if get_boto3_error_code(e) != 'LimitExceededException' or attempt >= WRITE_CONFLICT_MAX_RETRIES:
+                        raise
+                    # another container has taken the free target slot, list the targets again
+                    self.metrics.increment('write_conflicts')
+                    self.rule_index.set_targets(rule_name, None)
+                    backoff_before_retry(attempt)
+                    attempt += 1
+                    continue
+                if not response.get('success', False):
+                    self.rule_index.set_targets(rule_name, None)
+                    return {'success': False, 'exception': f"Can't put the target {target['Id']} on the rule: {rule_name}"}
+                self.rule_index.upsert_targets(rule_name, [target])
+                return {'success': True, 'rule_name': rule_name, 'bucket': bucket_name}
+            shard_number += 1
+
+    @timed_phase('dispatch')
+    def dispatch(self, bucket_name):
+        """invokes the lambdas of the jobs stored in the bucket asynchronously, and deletes the accepted jobs.
+        the jobs that couldn't be invoked stay in the store for the next try.
+        returns {'success': bool, 'dispatched': int, 'failed': int}"""
+        job_store = self.get_job_store()
+        jobs = job_store.get_jobs(bucket_name)
+        if not jobs:
+            # the jobs may all be cancelled, or stored where this execution environment can't see them
+            print(f"There are no jobs in the bucket {bucket_name} of the job store {type(job_store).__name__}")
+            self.metrics.increment('empty_dispatches')
+        results = self.get_lambda_invoker().invoke_many(
+            [(job['lambda_function_arn'], job['data']) for job in jobs])
+        dispatched_job_ids = [job['job_id'] for job, result in zip(jobs, results)
+                              if result.get('success', False)]
+        if dispatched_job_ids:
+            job_store.delete_jobs(bucket_name, dispatched_job_ids)
+        self.metrics.increment('jobs_dispatched', len(dispatched_job_ids))
+        self.metrics.increment('jobs_dispatch_failed',
+                               len(jobs) - len(dispatched_job_ids))
+        return {'success': len(dispatched_job_ids) == len(jobs),
+                'dispatched': len(dispatched_job_ids), 'failed': len(jobs) - len(dispatched_job_ids)}
+
+    def find_job(self, job_id, data=None):
+        """resolves a job id returned at schedule time to the job, without listing the rules.
+        the jobs written by this container are found in the RuleIndex, else the targets of the rule in the job id
+        are listed once, and the earlier rules within COMPACTION_TOLERANCE_MINUTES if it's moved. DISPATCHER jobs are read from their bucket in the job store.
+        the data of a merged job is only known to the container that wrote it, the caller can pass it as data.
+        returns {'job_id', 'job_key', 'rule_name', 'lambda_function_arn', 'data', 'target', 'rule_targets'} or None if it
+        isn't scheduled. 'target' is None for the DISPATCHER jobs, 'data' is None if it's unknown."""
+        rule_name, job_key = parse_job_id(job_id)
+        job = {'job_id': job_id, 'job_key': job_key, 'rule_name': rule_name, 'target': None}
+        if RULE_TARGET_ADDING_STRATEGY == 'DISPATCHER':
+            stored_job = None if rule_name is None else next(
+                (stored_job for stored_job in self.get_job_store().get_jobs(rule_name)
+                 if stored_job['job_id'] == job_key), None)
+            if stored_job is None:
+                return None
+            return {**job, 'lambda_function_arn': stored_job['lambda_function_arn'], 'data': stored_job['data']}
+
+        # the input of a concatenated target is read-modify-written by remove_job, it's listed fresh
+        refresh = RULE_TARGET_ADDING_STRATEGY == 'INPUT_CONCATENATOR'
+
+        def list_targets(rule_name):
+            response = self.get_rules_targets(rule_name, refresh=refresh)
+            if response.get('success', False):
+                return response.get('targets')
+            if get_boto3_error_code(response.get('exception')) == 'ResourceNotFoundException':
+                return []
+            raise EventBridgeException(
+                f"Can't list rule targets for the rule: {rule_name}")
+
+        target = None
+        location = self.rule_index.find_job(job_key)
+        if location is not None:
+            targets = list_targets(location[0])
+            target = next((target for target in targets if target.get('Id') == location[1]), None)
+            if target is not None:
+                rule_name = location[0]
             else:
-                raise EventBridgeException(
-                    f'{input_lambda_function} is not an ARN or mapped in the environment variables.')
+                # the target is gone, e.g. replaced by another container cancelling a job merged into it,
+                # look the job up like another container would
+                if data is None:
+                    data = self.rule_index.get_job_data(location[0]).get(job_key)
+                self.rule_index.remove_job_keys(location[0], [job_key])
+                rule_name = rule_name or location[0]
+        if target is None and rule_name is not None:
+            # written by another container, the target id is derived from the job key
+            target_id_suffix = get_target_id_suffix(job_key)
+
+            def find_target(targets):
+                target = next((target for target in targets if target.get('Id', '').endswith(target_id_suffix)), None)
+                if target is None and data is not None:
+                    target = self.find_merged_target(targets, data)  # merged into the target of another job
+                return target
+            targets = list_targets(rule_name)
+            target = find_target(targets)
+            rule_date = decode_rule_name_to_date(rule_name)
+            if target is None and rule_date is not None:
+                # the compactor may have moved the target to an earlier rule within the tolerance
+                candidate_rule_names = [entry['rule'].get('Name') for entry in self.get_rule_index().between(
+                    rule_date - datetime.timedelta(minutes=COMPACTION_TOLERANCE_MINUTES), rule_date)
+                    if entry['rule'].get('Name') != rule_name]
+                for candidate_rule_name, candidate_targets in zip(
+                        candidate_rule_names, self.get_many_rules_targets(candidate_rule_names, refresh=refresh)):
+                    target = find_target(candidate_targets or [])
+                    if target is not None:
+                        rule_name, targets = candidate_rule_name, candidate_targets
+                        break
+        if target is None:
+            return None
+
+        if RULE_TARGET_ADDING_STRATEGY != 'INPUT_CONCATENATOR':
+            data = json.loads(target.get('Input', '{}'))
+        elif job_key in self.rule_index.get_job_data(rule_name):
+            data = self.rule_index.get_job_data(rule_name)[job_key]
+        return {**job, 'rule_name': rule_name, 'lambda_function_arn': target.get('Arn'), 'data': data, 'target': target,
+                'rule_targets': targets}
+
+    def find_merged_target(self, targets, data):
+        """returns the first target the data is concatenated into, None if there isn't one or the input
+        concatenator can't tell, see can_verify_inputs."""
+        if RULE_TARGET_ADDING_STRATEGY != 'INPUT_CONCATENATOR':
+            return None
+        input_concatenator = self.get_input_concatenator()
+        if not can_verify_inputs(input_concatenator):
+            return None
+        for target in targets:
+            try:
+                if input_concatenator.contains_inputs(json.loads(target.get('Input', '{}')), [data]):
+                    return target
+            except (ValueError, NotImplementedError):
+                continue
+        return None
+
+    def remove_job(self, job):
+        """takes a job found by find_job out of its target, and removes the target when no job is left in it.
+        the rule is deleted along with its last target. DISPATCHER jobs are deleted from the job store,
+        their dispatch rule is left for the expired rule cleanup, the bucket may be getting new jobs.
+        returns {'success': bool, ...}"""
+        rule_name, job_key, target = job['rule_name'], job['job_key'], job['target']
+        if target is None:
+            self.get_job_store().delete_jobs(rule_name, [job_key])
+            return {'success': True, 'job_id': job['job_id'], 'bucket': rule_name}
+
+        remaining_data = None
+        if RULE_TARGET_ADDING_STRATEGY == 'INPUT_CONCATENATOR':
+            if job['data'] is None:
+                return {'success': False, 'job_id': job['job_id'], 'exception': (
+                    f"The data of the job {job['job_id']} merged into the target {target.get('Id')} is unknown. "
+                    "Please provide the 'data' of the job to cancel it.")}
+            # the other jobs known to be merged into the same target keep their values
+            job_keys = self.rule_index.get_job_keys(rule_name)
+            job_data = self.rule_index.get_job_data(rule_name)
+            kept_items = [job_data[other_job_key] for other_job_key, target_id in job_keys.items()
+                          if target_id == target.get('Id') and other_job_key != job_key and other_job_key in job_data]
+            try:
+                remaining_data = self.get_input_concatenator().remove_inputs(
+                    json.loads(target.get('Input', '{}')), [job['data']], kept_items=kept_items)
+            except (EventBridgeException, NotImplementedError) as e:
+                return {'success': False, 'job_id': job['job_id'], 'exception': str(e)}
+
+        result = {'success': True, 'job_id': job['job_id'], 'rule_name': rule_name, 'target_id': target.get('Id')}
+        if remaining_data is not None:
+            updated_target = {**target, 'Input': json.dumps(remaining_data)}
+            if target.get('Id', '').endswith(get_target_id_suffix(job_key)):
+                # the target id is derived from the cancelled job, find_scheduled_job, find_job and query_jobs would
+                # still resolve it to this job. the remaining jobs are moved to a target id of their own.
+                return self.replace_target(rule_name, target, updated_target, job, result)
+            response = self.put_rule_targets(rule_name, [updated_target])
+            if not response.get('success', False):
+                self.rule_index.set_targets(rule_name, None)
+                return {'success': False, 'job_id': job['job_id'],
+                        'exception': f"Can't put the target {target.get('Id')} on the rule: {rule_name}"}
+            self.rule_index.upsert_targets(rule_name, [updated_target])
+            self.rule_index.remove_job_keys(rule_name, [job_key])
+            return result
 
-        rule_to_create_target_on = None
-        # if ALLOWED_T_MINUS_ is enabled, check for the rules within the window
-        if ALLOWED_T_MINUS_MINUTES is not False:
-            allowed_t_minus_minutes = int(ALLOWED_T_MINUS_MINUTES)
-            neartime_rules = self.find_rules_close_to_a_date(
-                date, allowed_t_minus_minutes, lambda_function_arn, name_prefix=get_rule_prefix())
-            if len(neartime_rules) >= 1:
-                rule_to_create_target_on = neartime_rules[0]
-                rule_to_create_target_on.update({'success': True})
-                rule_name = rule_to_create_target_on.get('Name')
-        # create the rule and its targets
-        if rule_to_create_target_on is None:
-            rule_to_create_target_on = self.create_rule(rule_name, date)
-            rule_name = rule_to_create_target_on.get('rule_name')
-
-        if rule_to_create_target_on.get('success', False):
-
-            created_target = self.create_rule_target(
-                rule_name, lambda_function_arn, data)
-            if created_target.get('success', False):
-                return {'success': True}
+        if not self.remove_rule_targets(rule_name, [target.get('Id')]):
+            return {'success': False, 'job_id': job['job_id'],
+                    'exception': f"Can't remove the target {target.get('Id')} from the rule: {rule_name}"}
+        remaining_targets = [remaining_target for remaining_target in job['rule_targets']
+                             if remaining_target.get('Id') != target.get('Id')]
+        self.rule_index.set_targets(rule_name, remaining_targets)
+        self.rule_index.remove_job_keys(rule_name, [job_key for job_key, target_id in
+                                                    self.rule_index.get_job_keys(rule_name).items() if target_id == target.get('Id')])
+        if not remaining_targets:
+            result['rule_deleted'] = self.delete_empty_rule(rule_name)
+        return result
+
+    def replace_target(self, rule_name, target, updated_target, job, result):
+        """writes the remaining data of the target under the id of a kept job known to the RuleIndex, or a random id,
+        and removes the target. the new target is put first when the rule has a free slot and removed again if the
+        old one can't be, else the old target is removed first and put back if the new one can't be written.
+        returns the result of remove_job."""
+        job_keys = self.rule_index.get_job_keys(rule_name)
+        kept_job_keys = [other_job_key for other_job_key, target_id in job_keys.items()
+                         if target_id == target.get('Id') and other_job_key != job['job_key']]
+        existing_target_ids = {rule_target.get('Id') for rule_target in job['rule_targets']}
+        new_target_id = self.generate_target_id(rule_name, kept_job_keys[0]) if kept_job_keys else None
+        while new_target_id is None or new_target_id in existing_target_ids:
+            new_target_id = self.generate_target_id(rule_name)
+        new_target = {**updated_target, 'Id': new_target_id}
+
+        failure = {'success': False, 'job_id': job['job_id'],
+                   'exception': f"Can't replace the target {target.get('Id')} on the rule: {rule_name}"}
+        if len(job['rule_targets']) < MAX_TARGETS_PER_RULE:
+            if not self.put_rule_targets(rule_name, [new_target]).get('success', False):
+                self.rule_index.set_targets(rule_name, None)
+                return failure
+            if not self.remove_rule_targets(rule_name, [target.get('Id')]):
+                self.remove_rule_targets(rule_name, [new_target_id])
+                return failure
+        else:
+            if not self.remove_rule_targets(rule_name, [target.get('Id')]):
+                return failure
+            if not self.put_rule_targets(rule_name, [new_target]).get('success', False):
+                self.put_rule_targets(rule_name, [target])
+                self.rule_index.set_targets(rule_name, None)
+                return failure
+
+        self.rule_index.set_targets(rule_name, [rule_target for rule_target in job['rule_targets']
+                                                if rule_target.get('Id') != target.get('Id')] + [new_target])
+        self.rule_index.remove_job_keys(rule_name, [job['job_key']])
+        job_data = self.rule_index.get_job_data(rule_name)
+        self.rule_index.add_job_keys(rule_name, dict.fromkeys(kept_job_keys, new_target_id),
+                                     {job_key: job_data[job_key] for job_key in kept_job_keys if job_key in job_data})
+        return {**result, 'target_id': new_target_id}
+
+    @timed_phase('cancel')
+    def cancel_job(self, job_id, data=None):
+        """cancels the job with the job id returned at schedule time, see find_job and remove_job."""
+        job = self.find_job(job_id, data)
+        if job is None:
+            return {'success': False, 'job_id': job_id, 'exception': f"Can't find the job {job_id}, it may have run or been cancelled."}
+        result = self.remove_job(job)
+        if result.get('success', False):
+            self.metrics.increment('jobs_cancelled')
+        return result
+
+    @timed_phase('reschedule')
+    def reschedule_job(self, job_id, date, data=None):
+        """moves the job to the date. the job is scheduled at the new date first and then cancelled,
+        so a failure never loses it. returns the result of the new job, with its new job id."""
+        job = self.find_job(job_id, data)
+        if job is None:
+            return {'success': False, 'job_id': job_id, 'exception': f"Can't find the job {job_id}, it may have run or been cancelled."}
+        if job['data'] is None:
+            return {'success': False, 'job_id': job_id, 'exception': (
+                f"The data of the job {job_id} is unknown. Please provide the 'data' of the job to reschedule it.")}
+        result = self.create_rule_from_event(
+            {'datetime_utc': date, 'lambda_function': job['lambda_function_arn'], 'data': job['data']})
+        if not result.get('success', False) or result.get('job_id') == job_id:
+            return result  # the job is already at the date
+        removed = self.remove_job(job)
+        if not removed.get('success', False):
+            return {**result, 'success': False, 'exception': (
+                f"The job is scheduled again as {result.get('job_id')}, but the old job couldn't be cancelled: {removed.get('exception')}")}
+        self.metrics.increment('jobs_rescheduled')
+        return {**result, 'previous_job_id': job_id}
+
+    @timed_phase('query')
+    def query_jobs(self, start, end, lambda_function_arn=None, limit=None, next_token=None):
+        """returns the jobs scheduled to run in the [start, end) window, ordered by their date. read-only.
+        only the indexed rules inside the window have their targets listed, BULK_MAX_WORKERS rules at a time.
+        a page ends at a rule, it stops at the first rule after limit jobs and next_token is the name of the
+        rule to continue from. jobs concatenated into a target are returned as one job, with the ids of the jobs
+        known to this container or the id of the job the target is created for.
+        returns {'success', 'jobs': [{'job_ids', 'rule_name', 'datetime_utc', 'lambda_function_arn', 'data', 'target_id'}],
+        'next_token'}"""
+        limit = limit if limit else QUERY_PAGE_SIZE
+        entries = [entry for entry in self.get_rule_index().between(start, end) if entry['date'] < as_utc(end)]
+        if next_token:
+            rule_names = [entry['rule'].get('Name') for entry in entries]
+            if next_token in rule_names:
+                entries = entries[rule_names.index(next_token):]
             else:
-                deleted = self.delete_rule(rule_name)
+                # the rule is deleted since, continue from its date
+                token_date = decode_rule_name_to_date(next_token)
+                if token_date is None:
+                    raise EventBridgeException(f"Invalid next_token: {next_token}")
+                entries = [entry for entry in entries if entry['date'] >= token_date]
+
+        jobs = []
+        position = 0
+        while position < len(entries) and len(jobs) < limit:
+            chunk = entries[position:position + BULK_MAX_WORKERS]
+            chunk_rule_names = [entry['rule'].get('Name') for entry in chunk]
+            for entry, rule_name, targets in zip(chunk, chunk_rule_names, self.get_many_rules_targets(chunk_rule_names)):
+                if len(jobs) >= limit:
+                    break
+                position += 1
+                if targets is None:
+                    raise EventBridgeException(f"Can't list rule targets for the rule: {rule_name}")
+                jobs.extend(self.get_jobs_of_targets(rule_name, entry['date'], targets, lambda_function_arn))
+
+        self.metrics.increment('jobs_queried', len(jobs))
+        return {'success': True, 'jobs': jobs,
+                'next_token': entries[position]['rule'].get('Name') if position < len(entries) else None}
+
+    def get_jobs_of_targets(self, rule_name, date, targets, lambda_function_arn=None):
+        """returns the jobs of query_jobs for the targets of the rule, the dispatch targets are read from the job store."""
+        datetime_utc = date.strftime('%Y-%m-%d %H:%M:%S')
+        known_job_keys = {}  # target_id -> job keys written by this container
+        for job_key, target_id in self.rule_index.get_job_keys(rule_name).items():
+            known_job_keys.setdefault(target_id, []).append(job_key)
+
+        jobs = []
+        for target in targets:
+            bucket_name = self.get_dispatch_bucket_of_target(target)
+            if bucket_name is not None:
+                jobs.extend({'job_ids': [generate_job_id(bucket_name, stored_job['job_id'])], 'rule_name': bucket_name,
+                             'datetime_utc': datetime_utc, 'lambda_function_arn': stored_job['lambda_function_arn'],
+                             'data': stored_job['data'], 'target_id': None}
+                            for stored_job in self.get_job_store().get_jobs(bucket_name)
+                            if lambda_function_arn is None or stored_job['lambda_function_arn'] == lambda_function_arn)
+                continue
+            if lambda_function_arn is not None and target.get('Arn') != lambda_function_arn:
+                continue
+            target_id = target.get('Id', '')
+            # the target id ends with the beginning of the key of the job it's created for, find_job resolves it
+            job_keys = known_job_keys.get(target_id) or [target_id.rpartition('-target-')[2]]
+            jobs.append({'job_ids': [generate_job_id(rule_name, job_key) for job_key in job_keys], 'rule_name': rule_name,
+                         'datetime_utc': datetime_utc, 'lambda_function_arn': target.get('Arn'),
+                         'data': json.loads(target.get('Input', '{}')), 'target_id': target_id})
+        return jobs
+
+    def create_rule_and_targets(self, rule_name, bucket):
+        """creates the rule of a bucket of create_rules_from_events if it doesn't exist, and adds its jobs
+        as targets. returns a result for every job of the bucket.
+        the shard group of the rule is one logical bucket: jobs are merged into the targets of the same lambda
+        on any shard, and jobs that don't fit on a full rule spill over to its sibling shard rules."""
+        jobs = bucket['jobs']
+        results = [None] * len(jobs)
+        shard_rule_names = [rule_name] + \
+            [name for name in self.get_shard_group(rule_name, bucket['date']) if name != rule_name]
+
+        # assign the jobs to the shard with a target of the same lambda, or to the selected rule
+        assignments = {name: [] for name in shard_rule_names}
+        preferred_shards = {}  # lambda_function_arn -> shard rule name
+        shards_targets = []  # (shard rule name, targets)
+        if len(shard_rule_names) > 1:
+            shards_targets = list(zip(
+                shard_rule_names, self.get_many_rules_targets(shard_rule_names)))
+        if RULE_TARGET_ADDING_STRATEGY == 'INPUT_CONCATENATOR':
+            for name, targets in shards_targets:
+                for target in targets or []:
+                    preferred_shards.setdefault(target.get('Arn'), name)
+        for position, (_, lambda_function_arn, _, job_key) in enumerate(jobs):
+            # the jobs already written to a sibling shard are no-ops
+            scheduled_job = self.find_scheduled_job(shards_targets, job_key)
+            if scheduled_job is not None:
+                results[position] = {'success': True, 'duplicate': True, 'rule_name': scheduled_job[0],
+                                     'target_id': scheduled_job[1], 'job_id': generate_job_id(scheduled_job[0], job_key)}
+                continue
+            assignments[preferred_shards.get(
+                lambda_function_arn, rule_name)].append(position)
+
+        overflow_positions = []
+        shard_position = 0
+        while shard_position < len(shard_rule_names) or overflow_positions:
+            if shard_position == len(shard_rule_names):
+                # every shard is full, spill over to a new one
+                shard_rule_names.append(get_shard_rule_name(
+                    rule_name, max(get_shard_number(name) for name in shard_rule_names) + 1))
+            shard_rule_name = shard_rule_names[shard_position]
+            shard_position += 1
+            positions = overflow_positions + \
+                assignments.get(shard_rule_name, [])
+            overflow_positions = []
+            if not positions:
+                continue
+
+            try:
+                rule = self.create_rule(shard_rule_name, bucket['date'])
+            except Exception as e:
+                rule = {'success': False, 'exception': str(e)}
+            if not rule.get('success', False):
+                for position in positions:
+                    results[position] = {'success': False, 'exception': rule.get(
+                        'exception', f"Can't create the rule: {shard_rule_name}")}
+                continue
+
+            overflow = []
+            target_results = self.create_rule_targets(
+                shard_rule_name, [jobs[position][1:] for position in positions], overflow=overflow)
+            for position, target_result in zip(positions, target_results):
+                results[position] = target_result
+            overflow_positions = [positions[index] for index in overflow]
+
+            # don't leave a newly created rule without any targets behind. another container may have
+            # added its targets in the meantime, so the rule is only deleted if it's still empty.
+            if rule.get('created', False) and \
+                    not any(target_result and target_result.get('success', False) for target_result in target_results):
+                self.delete_empty_rule(shard_rule_name)
+                break
+
+        for position, result in enumerate(results):
+            if result is None:
+                results[position] = {'success': False,
+                                     'exception': f"Can't add the target on the rule: {shard_rule_name}"}
+        return results
 
-        return {'success': False}
+    def get_shard_group(self, rule_name, date):
+        """returns the names of the existing rules in the shard group of the rule, ordered by their shard number."""
+        group_name = get_shard_group_name(rule_name)
+        rule_names = [entry['rule'].get('Name') for entry in self.get_rule_index().between(date, date)
+                      if get_shard_group_name(entry['rule'].get('Name')) == group_name]
+        return sorted(rule_names, key=get_shard_number)
 
     def create_cron_expr_for_date(self, date):
         day_of_week = '?'
@@ -300,116 +1381,254 @@ class EventBridge:
             cron_expr = cron_expr.lstrip('cron(').rstrip(')')
         minute, hour, day, month, _, year = cron_expr.split(' ')
         datetime_obj = datetime.datetime(minute=int(minute), hour=int(hour), day=int(
-            day), month=int(month), year=int(year), tzinfo=dateutil.tz.UTC)
+            day), month=int(month), year=int(year), tzinfo=datetime.timezone.utc)
         return datetime_obj
 
     # TODO: get the lambda_arn as a param too.
-    def find_rules_close_to_a_date(self, date, t_minus_in_minutes, lambda_function_arn, name_prefix=None):
-        """ """
-        rules = self.list_rules(refresh=True, name_prefix=name_prefix)
+    def find_rules_close_to_a_date(self, date, t_minus_in_minutes, lambda_function_arn, name_prefix=None, with_targets=False):
+        """returns the rules within [date - t_minus_in_minutes, date] with bisect lookups on the RuleIndex.
+        returned rules have 'cron_datetime', 'target_count' and 'shard_group' keys set, target_count is None if it's unknown.
+        with_targets also sets the 'targets' key, unknown targets are listed concurrently."""
+        offset_ago = date - datetime.timedelta(minutes=t_minus_in_minutes)
         selected_rules = []
-        for rule in rules:
-            try:
-                cron_expr = rule.get('ScheduleExpression')
-                cron_datetime = self.decode_cron_expr_to_date(cron_expr)
-                rule['cron_datetime'] = cron_datetime
+        for entry in self.get_rule_index().between(offset_ago, date):
+            rule = entry['rule']
+            if name_prefix and not rule.get('Name', '').startswith(name_prefix):
+                continue
+            selected_rules.append({**rule, 'cron_datetime': entry['date'], 'target_count': entry['target_count'],
+                                   'shard_group': get_shard_group_name(rule.get('Name'))})
+
+        if with_targets:
+            rule_names = [rule['Name'] for rule in selected_rules]
+            for rule, targets in zip(selected_rules, self.get_many_rules_targets(rule_names)):
+                rule['targets'] = targets
+                rule['target_count'] = None if targets is None else len(targets)
+        return selected_rules
 
-                offset_ago = date - \
-                    datetime.timedelta(minutes=t_minus_in_minutes)
-                if offset_ago <= cron_datetime <= date:
-                    selected_rules.append(rule)
-            except:
-                # ignore un-supported cron expression exceptions
-                pass
+    def iter_rules_targets(self, rule_name, next_token=None, event_bus_name='default'):
+        """yields the targets of the rule page by page, following the SDK pagination."""
+        while True:
+            params = {
+                "Rule": rule_name,
+                "EventBusName": event_bus_name,
+            }
+            if next_token:
+                params["NextToken"] = next_token
+            response = self.executor.call(
+                self.client.list_targets_by_rule, **params)
+            if not self.is_boto3_response_successful(response):
+                raise EventBridgeException(
+                    f"Can't list rule targets for the rule: {rule_name}")
 
-        return selected_rules
+            yield from response.get('Targets', [])
+            next_token = response.get('NextToken', False)
+            if not next_token:  # pagination
+                return
 
-    def get_rules_targets(self, rule_name, next_token=None, event_bus_name='default') -> bool:
-        """recursive"""
+    def get_rules_targets(self, rule_name, next_token=None, event_bus_name='default', refresh=False) -> bool:
+        """returns the targets of the rule, cached in the RuleIndex for RULE_CACHE_TTL_SECONDS.
+        refresh lists them again, e.g. to read-modify-write their inputs."""
         rule_name = prefix_the_rule_name(rule_name)
-        output = []  # all rule targets of rule_name
-        params = {
-            "Rule": rule_name,
-            "EventBusName": event_bus_name,
-        }
+        if next_token is None and not refresh:
+            cached_targets = self.rule_index.get_targets(rule_name) \
+                if self.rule_index.is_fresh(RULE_CACHE_TTL_SECONDS) else None
+            self.metrics.record_cache(
+                'targets', hit=cached_targets is not None)
+            if cached_targets is not None:
+                return {'success': True, 'targets': cached_targets, 'cached': True}
 
-        if next_token:
-            params["NextToken"] = next_token
         try:
-            response = self.client.list_targets_by_rule(**params)
+            output = list(self.iter_rules_targets(
+                rule_name, next_token=next_token, event_bus_name=event_bus_name))
         except Exception as e:
             return {'success': False, 'exception': e}
 
-        targets = response.get('Targets', [])
-        output.extend(targets)
+        if next_token is None:
+            self.rule_index.set_targets(rule_name, output)
+        return {'success': True, 'targets': output}
 
-        response_next_token = response.get('NextToken', False)
-        if response_next_token:  # pagination
-            next_rules = self.get_rules_targets(
-                rule_name, next_token=response_next_token)
-            if next_rules.get('success', False):
-                output.extend(next_rules.get('targets', []))
-
-        success = self.is_boto3_response_successful(response)
-        return {'success': success, 'targets': output}
+    def get_many_rules_targets(self, rule_names, refresh=False):
+        """lists the targets of the rules concurrently. returns the targets of every rule
+        in the same order, None for the rules whose targets couldn't be listed."""
+        outcomes = self.executor.map(
+            lambda rule_name: self.get_rules_targets(rule_name, refresh=refresh), rule_names)
+        return [outcome.get('result').get('targets') if outcome.get('success') and
+                outcome.get('result').get('success', False) else None for outcome in outcomes]
 
     def delete_rules_targets(self, rule_name, event_bus_name='default') -> bool:
+        """removes all of the targets of the rule. returns True if the rule is left without targets."""
         rule_name = prefix_the_rule_name(rule_name)
         # delete the targets first.
         rules_targets = self.get_rules_targets(rule_name)
-        success = rules_targets.get('success', False)
-        if success:
-            targets = rules_targets.get('targets', [])
-            target_ids = [x.get('Id') for x in targets if x.get('Id', False)]
-            if not target_ids:
-                return True  # no targets registered to rule
-
-            response = self.client.remove_targets(
-                Rule=rule_name,
-                EventBusName=event_bus_name,
-                Ids=target_ids
-            )
-            success = success or self.is_boto3_response_successful(response)
-
+        if not rules_targets.get('success', False):
+            # the rule may be deleted already, e.g. by another container
+            return get_boto3_error_code(rules_targets.get('exception')) == 'ResourceNotFoundException'
+        targets = rules_targets.get('targets', [])
+        target_ids = [x.get('Id') for x in targets if x.get('Id', False)]
+        if not target_ids:
+            return True  # no targets registered to rule
+
+        response = self.executor.call(self.client.remove_targets,
+            Rule=rule_name,
+            EventBusName=event_bus_name,
+            Ids=target_ids
+        )
+        success = self.is_boto3_response_successful(response) and not response.get('FailedEntryCount')
+        # the targets that failed to be removed are still on the rule, list them again on the next try.
+        self.rule_index.set_targets(rule_name, [] if success else None)
         return success
 
     def delete_rule(self, rule_name, event_bus_name='default'):
         # get the lists
         rule_name = prefix_the_rule_name(rule_name)
         # delete the targets first.
-        targets_deleted = self.delete_rules_targets(rule_name, event_bus_name)
-        # ignoring deleted targets, there may be no targets in the rule
+        try:
+            targets_deleted = self.delete_rules_targets(rule_name, event_bus_name)
+        except Exception as e:
+            # the rule may be deleted already, e.g. by another container
+            if get_boto3_error_code(e) != 'ResourceNotFoundException':
+                raise
+            targets_deleted = True
+        if not targets_deleted:
+            # EventBridge doesn't delete a rule with targets, the rule is tried again by the next sweep
+            print(f"Couldn't remove the targets of the rule {rule_name}")
+            return False
         success = False
         #  delete the rule.
         try:
-            response = self.client.delete_rule(
+            response = self.executor.call(self.client.delete_rule,
                 Name=rule_name,
                 EventBusName=event_bus_name,
             )
             success = self.is_boto3_response_successful(response)
 
         except Exception as e:
-            success = False
+            success = get_boto3_error_code(e) == 'ResourceNotFoundException'
+
+        if success:
+            self.rule_index.remove_rule(rule_name)
+        else:
+            # the cached targets may be stale, list them again on the next try.
+            self.rule_index.set_targets(rule_name, None)
+        return success
+
+    def remove_rule_targets(self, rule_name, target_ids, event_bus_name='default'):
+        """removes the targets with the ids from the rule, the other targets are left alone. returns True on success."""
+        rule_name = prefix_the_rule_name(rule_name)
+        success = True
+        for i in range(0, len(target_ids), MAX_TARGETS_PER_PUT_TARGETS_CALL):
+            response = self.executor.call(self.client.remove_targets,
+                Rule=rule_name,
+                EventBusName=event_bus_name,
+                Ids=target_ids[i:i + MAX_TARGETS_PER_PUT_TARGETS_CALL]
+            )
+            success = success and self.is_boto3_response_successful(
+                response) and not response.get('FailedEntryCount')
+        if success:
+            cached_targets = self.rule_index.get_targets(rule_name)
+            if cached_targets is not None:
+                self.rule_index.set_targets(rule_name, [target for target in cached_targets
+                                                        if target.get('Id') not in target_ids])
+        else:
+            self.rule_index.set_targets(rule_name, None)
+        return success
 
+    def delete_empty_rule(self, rule_name, event_bus_name='default'):
+        """deletes the rule without removing its targets. EventBridge doesn't delete a rule with targets, so a
+        target added by another container in the meantime keeps the rule. returns True if the rule is deleted."""
+        rule_name = prefix_the_rule_name(rule_name)
+        try:
+            response = self.executor.call(
+                self.client.delete_rule, Name=rule_name, EventBusName=event_bus_name)
+            success = self.is_boto3_response_successful(response)
+        except Exception as e:
+            success = get_boto3_error_code(e) == 'ResourceNotFoundException'
+        if success:
+            self.rule_index.remove_rule(rule_name)
+        else:
+            self.rule_index.set_targets(rule_name, None)
         return success
 
-    def clean_up_expired_rules(self):
-        """deletes expired Rules created by this Lambda Function."""
+    @timed_phase('cleanup')
+    def clean_up_expired_rules(self, context=None):
+        """deletes expired Rules created by this Lambda Function, within a budget.
+        stops after CLEANUP_MAX_DELETIONS_PER_CALL deletions, or when the remaining time of the
+        lambda context is less than CLEANUP_RESERVED_TIME_MS. the next call resumes from the watermark.
+        a completed sweep isn't repeated for CLEANUP_MIN_INTERVAL_SECONDS."""
         deleted_rules = []
-        rules = self.list_rules(name_prefix=get_rule_prefix())
-        for rule in rules:
-            schedule_expr = rule.get('ScheduleExpression')
-            rule_date = self.decode_cron_expr_to_date(schedule_expr)
-            rule_name = rule.get('Name')
-            now_utc = datetime.datetime.now(tz=dateutil.tz.UTC)
-            if now_utc > rule_date:
-                is_rule_deleted = self.delete_rule(rule_name)
-                if is_rule_deleted:
+        if self._cleanup_watermark is None and self._cleanup_swept_at is not None \
+                and time.monotonic() - self._cleanup_swept_at < CLEANUP_MIN_INTERVAL_SECONDS:
+            return deleted_rules  # swept recently
+
+        now_utc = datetime.datetime.now(tz=datetime.timezone.utc)
+        expired_entries = self.get_rule_index().before(now_utc)
+        if self._cleanup_watermark is not None:
+            # resume after the last rule the previous call has processed
+            expired_entries = [entry for entry in expired_entries
+                               if (entry['date'], entry['rule'].get('Name')) > self._cleanup_watermark]
+
+        expired_entries = expired_entries[:CLEANUP_MAX_DELETIONS_PER_CALL]
+        budget_exhausted = len(expired_entries) == CLEANUP_MAX_DELETIONS_PER_CALL
+        # delete the rules concurrently, checking the time budget before every chunk
+        chunk_size = self.executor.max_workers
+        for i in range(0, len(expired_entries), chunk_size):
+            if context is not None and context.get_remaining_time_in_millis() < CLEANUP_RESERVED_TIME_MS:
+                return deleted_rules  # out of budget, the watermark is kept for the next call
+            chunk = expired_entries[i:i + chunk_size]
+            outcomes = self.executor.map(
+                lambda entry: self.delete_rule(entry['rule'].get('Name')), chunk)
+            for entry, outcome in zip(chunk, outcomes):
+                rule = entry['rule']
+                if outcome.get('success') and outcome.get('result'):
                     deleted_rules.append(rule)
+                    self.metrics.increment('expired_rules_deleted')
                 else:
                     print(f"Couldn't delete Rule: {rule}")
+            last_entry = chunk[-1]
+            self._cleanup_watermark = (
+                last_entry['date'], last_entry['rule'].get('Name'))
+
+        if budget_exhausted:
+            return deleted_rules  # there may be more expired rules, continue from the watermark
+
+        # the sweep is completed
+        self._cleanup_watermark = None
+        self._cleanup_swept_at = time.monotonic()
         return deleted_rules
 
+    @timed_phase('maintenance')
+    def run_maintenance(self, context=None):
+        """the work of the maintenance rule: lists the rules again to refresh the RuleIndex, and deletes the
+        expired rules until the sweep is completed or the lambda is out of time. the snapshot is saved by the handler."""
+        rule_index = self.get_rule_index(refresh=True)
+        self._cleanup_swept_at = None  # sweep now, even if the last sweep was recent
+        deleted_rules = []
+        while True:
+            deleted = self.clean_up_expired_rules(context)
+            deleted_rules.extend(deleted)
+            if self._cleanup_watermark is None or not deleted:
+                break  # the sweep is completed, or no progress is made
+        result = {'success': True, 'indexed_rules': len(rule_index), 'deleted_rules': len(deleted_rules),
+                  'sweep_completed': self._cleanup_watermark is None}
+        if COMPACTION_ENABLED:
+            result['compaction'] = self.compact_rules()
+        return result
+
+    @timed_phase('compaction')
+    def compact_rules(self, dry_run=False):
+        """coalesces the rules within COMPACTION_TOLERANCE_MINUTES of each other into the earliest of them,
+        see rule_compactor.RuleCompactor. with dry_run, only reports the merges."""
+        input_concatenator = self.get_input_concatenator() \
+            if RULE_TARGET_ADDING_STRATEGY == 'INPUT_CONCATENATOR' else None
+        compactor = RuleCompactor(self, tolerance_minutes=COMPACTION_TOLERANCE_MINUTES,
+                                  max_targets_per_rule=MAX_TARGETS_PER_RULE, input_concatenator=input_concatenator,
+                                  no_concatenation_arns=[self.scheduler_function_arn],
+                                  max_retries=WRITE_CONFLICT_MAX_RETRIES, retry_backoff_seconds=WRITE_CONFLICT_BACKOFF_SECONDS)
+        report = compactor.compact(dry_run=dry_run)
+        if not dry_run:
+            self.metrics.increment('rules_compacted', report['deleted_rules'])
+        return report
+
     def generate_rule_name_from_event(self, event):
         date = event.get('datetime_utc')
         rule_name = f'{date.year}-{date.month}-{date.day}--{date.hour}-{date.minute}'
@@ -429,11 +1648,11 @@ def get_lambda_scheduler_cron_expression():
     try:
         if every_n_minutes:
             # checking if the value is an integer
-            every_n_minutes = int(every_n_minutes)
+            n = int(every_n_minutes)
             schedule_expr_type = 'minutes'
         elif every_n_hours:
             # checking if the value is an integer
-            every_n_hours = int(every_n_hours)
+            n = int(every_n_hours)
             schedule_expr_type = 'hours'
         else:
             raise LambdaSchedulerException(
@@ -442,6 +1661,11 @@ def get_lambda_scheduler_cron_expression():
         raise LambdaSchedulerException("'every_n_minutes' or 'every_n_hours' parameter can't be converted to int. "
                                        "Please properly set one of the following environment variables: "
                                        "[CALL_LAMBDA_SCHEDULER_EVERY_N_MINUTES, CALL_LAMBDA_SCHEDULER_EVERY_N_HOURS]")
+    if n < 1:
+        raise LambdaSchedulerException(
+            "'every_n_minutes' or 'every_n_hours' has to be a positive integer.")
+    if n == 1:
+        schedule_expr_type = schedule_expr_type.rstrip('s')  # EventBridge only accepts rate(1 minute)
 
     return f"rate({n} {schedule_expr_type})"
 
@@ -452,14 +1676,45 @@ def get_rule_prefix():
 
 def create_lambda_schedulers_rule(event_bridge: EventBridge, current_lambda_function_arn):
     """
+    installs the maintenance rule MAINTENANCE_RULE_NAME, that invokes this lambda with {"action": "maintenance"}.
     try to grab existing rule.
     if it doesn't exist, create it
     if it exists update the rules.
+    returns True if the rule is created or updated, False if it's up to date.
     """
+    if not current_lambda_function_arn:
+        raise LambdaSchedulerException(
+            'Please set the environment variable: SCHEDULER_FUNCTION_ARN')
     scheduler_cron_expr = get_lambda_scheduler_cron_expression()
-    rules = event_bridge.list_rules(name_prefix=get_rule_prefix())
-    pprint(rules)
-    pass
+    rule_name = prefix_the_rule_name(MAINTENANCE_RULE_NAME)
+    target = {'Id': 'maintenance', 'Arn': current_lambda_function_arn,
+              'Input': json.dumps({'action': 'maintenance'})}
+    rule = event_bridge.describe_rule(rule_name)
+    if rule is not None and rule.get('ScheduleExpression') == scheduler_cron_expr:
+        response = event_bridge.get_rules_targets(rule_name)
+        if response.get('success', False) and any(
+                {key: existing_target.get(key) for key in target} == target for existing_target in response.get('targets')):
+            return False
+
+    # the rate expression isn't decoded to a date, the rule index and the expired rule cleanup ignore the rule
+    response = event_bridge.executor.call(event_bridge.client.put_rule,
+        Name=rule_name,
+        ScheduleExpression=scheduler_cron_expr,
+        State='ENABLED',
+        Tags=[
+            {
+                'Key': 'auto',
+                'Value': 'true'
+            },
+        ],
+    )
+    if not event_bridge.is_boto3_response_successful(response):
+        raise EventBridgeException(f"Can't create the rule: {rule_name}")
+    response = event_bridge.put_rule_targets(rule_name, [target])
+    if not response.get('success', False):
+        raise EventBridgeException(
+            f"Can't put the target {target['Id']} on the rule: {rule_name}")
+    return True
 
 
 def prefix_the_rule_name(rule_name):
@@ -473,6 +1728,57 @@ def prefix_the_rule_name(rule_name):
     return rule_name
 
 
+def decode_rule_name_to_date(rule_name):
+    """returns the date in the name of a rule created for a date, e.g. AUTO_2030-12-30--20-20-s1, or None."""
+    try:
+        return datetime.datetime.strptime(get_shard_group_name(rule_name)[len(get_rule_prefix()):],
+                                          '%Y-%m-%d--%H-%M').replace(tzinfo=datetime.timezone.utc)
+    except ValueError:
+        return None
+
+
+def can_verify_inputs(input_concatenator):
+    """whether the input concatenator implements contains_inputs, to read the concatenated targets back."""
+    contains_inputs = getattr(type(input_concatenator), 'contains_inputs', None)
+    return contains_inputs is not None and contains_inputs is not EventBridgeInputConcatenator.contains_inputs
+
+
+def backoff_before_retry(attempt):
+    """sleeps with full jitter before retrying a conflicting write, so the racing writers don't collide again."""
+    time.sleep(random.uniform(0, WRITE_CONFLICT_BACKOFF_SECONDS * 2 ** attempt))
+
+
+def get_target_id_suffix(job_key):
+    return f"-target-{job_key[:12]}"
+
+
+def generate_job_id(rule_name, job_key):
+    """the job id returned to the caller, the rule (or the dispatch bucket) the job is written to and its idempotency key.
+    rule names can't have a '/', e.g. AUTO_2030-12-30--20-20/3f1c9a0b7d2e..."""
+    return f"{rule_name}/{job_key}"
+
+
+def parse_job_id(job_id):
+    """returns (rule_name, job_key) of the job id, rule_name is None if the id is a bare job key."""
+    rule_name, _, job_key = str(job_id).rpartition('/')
+    return rule_name or None, job_key
+
+
+def get_shard_group_name(rule_name):
+    """sibling shard rules of the same minute share the name of the first rule, e.g. AUTO_2030-12-30--20-20-s1"""
+    return SHARD_SUFFIX_PATTERN.sub('', rule_name)
+
+
+def get_shard_number(rule_name):
+    match = SHARD_SUFFIX_PATTERN.search(rule_name)
+    return int(match.group(1)) if match else 0
+
+
+def get_shard_rule_name(rule_name, shard_number):
+    group_name = get_shard_group_name(rule_name)
+    return f"{group_name}-s{shard_number}" if shard_number else group_name
+
+
 def validate_event(event):
     def true_if_not_false(x): return True if x != False else False
     input_existence_list = [true_if_not_false(event.get(e_input, False))
@@ -481,31 +1787,275 @@ def validate_event(event):
     return has_all_inputs
 
 
+def parse_event(event, metrics=None):
+    """validates the event and parses its datetime_utc string to datetime obj.
+    returns the error response, or None if the event is valid."""
+    metrics = metrics if metrics else _metrics
+    with metrics.phase('validate'):
+        is_valid = isinstance(event, dict) and validate_event(event)
+    if not is_valid:
+        return {'success': False, 'message': f'Please provide all of the parameters: {REQUIRED_EVENT_INPUTS=}'}
+
+    # parse the datetime_utc string to datetime obj
+    try:
+        with metrics.phase('parse'):
+            event['datetime_utc'] = as_utc(
+                parse_datetime(event['datetime_utc']))
+    except Exception as e:
+        return {'success': False, 'message': f"datetime_utc parameter can't be parsed."}
+    return None
+
+
+def load_input_concatenator() -> EventBridgeInputConcatenator:
+    """the logic of the json data updation can be customized with impementing
+    your own input_concatenators.EventBridgeInputConcatenator abstract class.
+    Also you need to set the environment variable: INPUT_CONCATENATOR_MODULE_NAME 
+    and INPUT_CONCATENATOR_CLASS_NAME to be your module and class name."""
+    if not INPUT_CONCATENATOR_CLASS_NAME:
+        raise LambdaSchedulerException(
+            f'Please implement your subclass and update the environment variable: INPUT_CONCATENATOR_CLASS_NAME')
+    try:
+        # python magic to grab the non-imported class in runtime with module and class name.
+        input_concat_class = get_class_by_name_and_module(
+            INPUT_CONCATENATOR_MODULE_NAME, INPUT_CONCATENATOR_CLASS_NAME)
+    except (ImportError, AttributeError):
+        raise LambdaSchedulerException(
+            f'Couldnt import class {INPUT_CONCATENATOR_MODULE_NAME}.{INPUT_CONCATENATOR_CLASS_NAME}. Please implement your subclass and update the environment variable: INPUT_CONCATENATOR_CLASS_NAME')
+    if not (isinstance(input_concat_class, type) and issubclass(input_concat_class, EventBridgeInputConcatenator)):
+        raise LambdaSchedulerException(
+            f'{INPUT_CONCATENATOR_MODULE_NAME}.{INPUT_CONCATENATOR_CLASS_NAME} is not a subclass of input_concatenators.EventBridgeInputConcatenator')
+    return input_concat_class()
+
+
+# the input concatenator is resolved once, and a misconfiguration fails the cold start instead of the first merge.
+_input_concatenator = load_input_concatenator() \
+    if RULE_TARGET_ADDING_STRATEGY == 'INPUT_CONCATENATOR' else None
+
+_eventbridge = None  # container scoped, reused by the warm invocations
+_maintenance_rule_installed = False  # checked once per container
+_metrics = Metrics()  # container scoped, reset by every invocation
+
+
+def get_eventbridge(context=None) -> EventBridge:
+    """returns the EventBridge instance of this container, its client and caches are
+    reused by the warm invocations. created on the first use, invalid events never import boto3.
+    with SHARDS, it's a sharding.ShardedScheduler of the shards instead, with the same methods."""
+    global _eventbridge
+    if _eventbridge is None:
+        if SHARDS_ENABLED:
+            from sharding import ShardedScheduler  # sharding imports this module
+            _eventbridge = ShardedScheduler.from_environment()
+        else:
+            _eventbridge = EventBridge()
+    if _eventbridge.scheduler_function_arn is None:
+        _eventbridge.scheduler_function_arn = getattr(
+            context, 'invoked_function_arn', None)
+    return _eventbridge
+
+
+def clean_up_on_request(eventbridge, context):
+    """deletes the expired rules within the budget of a schedule request. with MAINTENANCE_RULE_ENABLED the
+    maintenance rule deletes them instead, and the request only makes sure that the rule is installed."""
+    global _maintenance_rule_installed
+    if not MAINTENANCE_RULE_ENABLED:
+        eventbridge.clean_up_expired_rules(context)
+        return
+    if _maintenance_rule_installed:
+        return
+    try:
+        # a ShardedScheduler installs it on a single shard, the maintenance runs on every shard
+        create_lambda_schedulers_rule(eventbridge if isinstance(eventbridge, EventBridge) else
+                                      eventbridge.get_home_shard(), eventbridge.scheduler_function_arn)
+        _maintenance_rule_installed = True
+    except Exception as e:
+        print(f"Couldn't install the maintenance rule: {e}")
+        eventbridge.clean_up_expired_rules(context)
+
+
+def emit_metrics(context, profiler=None):
+    """logs the metrics of the invocation as one Embedded Metric Format record."""
+    function_name = getattr(context, 'function_name', None) or os.getenv(
+        'AWS_LAMBDA_FUNCTION_NAME', 'aws-lambda-scheduler')
+    properties = {'RequestId': getattr(context, 'aws_request_id', None)}
+    if profiler is not None:
+        properties['ProfileSampleCount'] = profiler.sample_count
+        properties['ProfileTopFrames'] = profiler.top(20)
+    _metrics.emit(METRICS_NAMESPACE, dimensions={
+                  'FunctionName': function_name}, properties=properties)
+
+
 def lambda_handler(event, context):
-    # create the this lambda functions event
-    eventbridge = EventBridge(boto3.client('events'))
-    # eventbridge = EventBridge() # create with the default client
+    _metrics.reset()
+    profiler = SamplingProfiler(PROFILER_SAMPLING_INTERVAL_MS / 1000).start() \
+        if PROFILER_SAMPLING_INTERVAL_MS > 0 else None
+    try:
+        response = handle_event(event, context)
+        if _eventbridge is not None:
+            _eventbridge.save_rule_index_snapshot()
+    finally:
+        if profiler is not None:
+            profiler.stop()
+        if EMIT_METRICS:
+            emit_metrics(context, profiler)
+    return response
+
+
+def handle_event(event, context):
     try:
         event = json.loads(event)
     except:
         pass
 
+    # the dispatch rules of RULE_TARGET_ADDING_STRATEGY='DISPATCHER' invoke this lambda with {"action": "dispatch"}
+    if isinstance(event, dict) and event.get('action') == 'dispatch':
+        eventbridge = get_eventbridge(context)
+        if event.get('shard'):
+            # the dispatch rule of a shard, see sharding.py
+            if not SHARDS_ENABLED:
+                raise LambdaSchedulerException(
+                    f"Couldn't dispatch the bucket {event.get('bucket')} of the shard {event['shard']}, "
+                    f"please set the environment variable: SHARDS")
+            eventbridge = eventbridge.get_shard(event['shard'])
+        response = eventbridge.dispatch(event.get('bucket'))
+        if not response.get('success', False):
+            # raising makes lambda retry the asynchronous invocation, for the jobs left in the store
+            raise LambdaSchedulerException(
+                f"Couldn't dispatch {response.get('failed')} jobs of the bucket {event.get('bucket')}")
+        return response
 
-    if not validate_event(event):
-        return {'success': False, 'message': f'Please provide all of the parameters: {REQUIRED_EVENT_INPUTS=}'}
+    # the maintenance rule invokes this lambda with {"action": "maintenance"}, see create_lambda_schedulers_rule
+    if isinstance(event, dict) and event.get('action') == 'maintenance':
+        return get_eventbridge(context).run_maintenance(context)
 
-    # parse the datetime_utc string to datetime obj
-    try:
-        event['datetime_utc'] = parse(event['datetime_utc'])
-    except Exception as e:
-        return {'success': False, 'message': f"datetime_utc parameter can't be parsed."}
+    # {"action": "compact", "dry_run": true} reports the rules that can be coalesced, without the dry_run it coalesces them
+    if isinstance(event, dict) and event.get('action') == 'compact':
+        return get_eventbridge(context).compact_rules(dry_run=bool(event.get('dry_run', False)))
 
-    deleted_rules = eventbridge.clean_up_expired_rules()
-    pprint({'deleted_expired_rules': deleted_rules})
+    # {"action": "cancel", "job_id": ...} or {"action": "reschedule", "job_id": ..., "datetime_utc": ...}
+    if isinstance(event, dict) and event.get('action') in ('cancel', 'reschedule'):
+        return handle_job_action(event, context)
+
+    # {"action": "query", "from_datetime_utc": ..., "to_datetime_utc": ...} lists the jobs scheduled in the window
+    if isinstance(event, dict) and event.get('action') == 'query':
+        return handle_query(event, context)
+
+    # SQS messages are scheduled as a batch, and only the failed messages are delivered again.
+    if is_sqs_event(event):
+        return handle_sqs_event(event, context)
+
+    # a list of events is scheduled as a batch, with a result for every event.
+    if isinstance(event, list):
+        results = schedule_events(event, context)
+        return {'success': all(result.get('success', False) for result in results), 'results': results}
+
+    _metrics.increment('events')
+    error_response = parse_event(event)
+    if error_response is not None:
+        return error_response
+
+    eventbridge = get_eventbridge(context)
+    clean_up_on_request(eventbridge, context)
 
     try:
         created_rule = eventbridge.create_rule_from_event(event)
+        _metrics.increment(
+            'events_scheduled', int(created_rule.get('success', False)))
         return created_rule
     except Exception as e:
         return {'success': False, 'event': event, 'exception': str(e)}
 
+
+def handle_job_action(event, context):
+    """cancels or reschedules the job with the job id returned at schedule time.
+    'data' of the job is optional, it's needed for the jobs merged by the other containers."""
+    if not event.get('job_id'):
+        return {'success': False, 'message': "Please provide the 'job_id' of the job."}
+    eventbridge = get_eventbridge(context)
+    try:
+        if event.get('action') == 'cancel':
+            return eventbridge.cancel_job(event['job_id'], event.get('data'))
+        try:
+            date = as_utc(parse_datetime(event.get('datetime_utc')))
+        except Exception:
+            return {'success': False, 'message': "datetime_utc parameter can't be parsed."}
+        return eventbridge.reschedule_job(event['job_id'], date, event.get('data'))
+    except Exception as e:
+        return {'success': False, 'job_id': event.get('job_id'), 'exception': str(e)}
+
+
+def handle_query(event, context):
+    """lists the jobs scheduled in the [from_datetime_utc, to_datetime_utc) window, from_datetime_utc defaults to now.
+    'lambda_function' filters the jobs by the lambda, 'limit' and 'next_token' paginate them."""
+    if not event.get('to_datetime_utc'):
+        return {'success': False, 'message': "Please provide the 'to_datetime_utc' of the window."}
+    try:
+        start = as_utc(parse_datetime(event['from_datetime_utc'])) if event.get('from_datetime_utc') else \
+            datetime.datetime.now(tz=datetime.timezone.utc)
+        end = as_utc(parse_datetime(event.get('to_datetime_utc')))
+    except Exception:
+        return {'success': False, 'message': "from_datetime_utc or to_datetime_utc parameter can't be parsed."}
+    eventbridge = get_eventbridge(context)
+    try:
+        lambda_function_arn = eventbridge.get_lambda_function_arn(event['lambda_function']) \
+            if event.get('lambda_function') else None
+        return eventbridge.query_jobs(start, end, lambda_function_arn, limit=int(event.get('limit') or 0),
+                                      next_token=event.get('next_token'))
+    except Exception as e:
+        return {'success': False, 'exception': str(e)}
+
+
+def schedule_events(events, context):
+    """schedules a list of events in one pass, returns a result for every event in the same order."""
+    _metrics.increment('events', len(events))
+    results = [parse_event(e) for e in events]
+    valid_events = [e for e, result in zip(events, results) if result is None]
+
+    eventbridge = get_eventbridge(context)
+    clean_up_on_request(eventbridge, context)
+
+    try:
+        created_rules = eventbridge.create_rule_from_event(valid_events)
+        created_results = iter(created_rules.get('results'))
+    except Exception as e:
+        created_results = iter([{'success': False, 'exception': str(e)}
+                                for _ in valid_events])
+    results = [result if result is not None else next(created_results)
+               for result in results]
+    _metrics.increment(
+        'events_scheduled', sum(result.get('success', False) for result in results))
+    return results
+
+
+def is_sqs_event(event):
+    return isinstance(event, dict) and isinstance(event.get('Records'), list) and \
+        all(record.get('eventSource') == 'aws:sqs' for record in event['Records'])
+
+
+def handle_sqs_event(event, context):
+    """schedules the events of an SQS batch together. the body of a message is an event, or a list of events.
+    returns the messages with an invalid or failed event as batchItemFailures, so only they are delivered again.
+    the event source mapping needs ReportBatchItemFailures, the scheduling is idempotent so the events of a
+    redelivered message that were already scheduled are no-ops."""
+    records = event['Records']
+    _metrics.increment('sqs_messages', len(records))
+    events = []
+    message_ids = []  # message id of every event
+    failed_message_ids = set()
+    for record in records:
+        try:
+            body = json.loads(record.get('body'))
+        except (TypeError, ValueError):
+            print(f"Couldn't decode the body of the message {record.get('messageId')}")
+            failed_message_ids.add(record.get('messageId'))
+            continue
+        for e in body if isinstance(body, list) else [body]:
+            events.append(e)
+            message_ids.append(record.get('messageId'))
+
+    for message_id, result in zip(message_ids, schedule_events(events, context)):
+        if not result.get('success', False):
+            print(f"Couldn't schedule an event of the message {message_id}: {result.get('exception', result.get('message'))}")
+            failed_message_ids.add(message_id)
+    _metrics.increment('sqs_messages_failed', len(failed_message_ids))
+    return {'batchItemFailures': [{'itemIdentifier': record.get('messageId')} for record in records
+                                  if record.get('messageId') in failed_message_ids]}
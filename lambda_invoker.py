@@ -0,0 +1,33 @@
+import json
+from bulk_executor import BulkExecutor
+
+
+class LambdaInvoker:
+    """
+    Invokes Lambda Functions asynchronously, with InvocationType='Event', from a bounded worker pool.
+
+    The calls go through a BulkExecutor of their own, so the throttled invokes are retried
+    with backoff without slowing down the EventBridge calls.
+    """
+
+    def __init__(self, client=None, executor=None) -> None:
+        if not client:
+            import boto3
+            client = boto3.client('lambda')
+        self.client = client
+        self.executor = executor if executor else BulkExecutor()
+
+    def invoke(self, lambda_function_arn, data):
+        """queues an asynchronous invocation of the lambda with data as its event. returns True if it's accepted."""
+        response = self.executor.call(self.client.invoke, FunctionName=lambda_function_arn,
+                                      InvocationType='Event', Payload=json.dumps(data).encode())
+        return response.get('StatusCode') == 202 and not response.get('FunctionError')
+
+    def invoke_many(self, invocations):
+        """invokes (lambda_function_arn, data) pairs concurrently.
+        returns [{'success': bool, 'exception': ...}] in the same order with the invocations."""
+        outcomes = self.executor.map(
+            lambda invocation: self.invoke(*invocation), invocations)
+        return [{'success': True} if outcome.get('success') and outcome.get('result') else
+                {'success': False, 'exception': str(outcome.get('exception', "Invocation isn't accepted."))}
+                for outcome in outcomes]
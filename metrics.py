@@ -0,0 +1,230 @@
+import collections
+import contextlib
+import functools
+import json
+import sys
+import threading
+import time
+
+# upper bounds of the latency histogram buckets, in milliseconds
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+# threads waiting in these files are idle, the SamplingProfiler skips them
+IDLE_FRAME_FILES = ('threading.py', 'concurrent/futures/thread.py',
+                    'concurrent/futures/_base.py')
+
+
+def to_metric_name(name):
+    """'list_rules' -> 'ListRules'"""
+    return ''.join(part[:1].upper() + part[1:] for part in name.split('_'))
+
+
+def timed_phase(phase):
+    """decorates a method to time its calls as the phase, in the Metrics of self.metrics"""
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.metrics.phase(phase):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class LatencyHistogram:
+    """fixed bucket histogram of latencies, cheap enough to update on every API call."""
+
+    def __init__(self) -> None:
+        self.counts = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def add(self, milliseconds):
+        position = 0
+        while position < len(LATENCY_BUCKETS_MS) and milliseconds > LATENCY_BUCKETS_MS[position]:
+            position += 1
+        self.counts[position] += 1
+        self.count += 1
+        self.total_ms += milliseconds
+        self.max_ms = max(self.max_ms, milliseconds)
+
+    def to_dict(self):
+        labels = [f'<={bound}ms' for bound in LATENCY_BUCKETS_MS] + \
+            [f'>{LATENCY_BUCKETS_MS[-1]}ms']
+        return {'count': self.count, 'sum_ms': round(self.total_ms, 3), 'max_ms': round(self.max_ms, 3),
+                'buckets': {label: count for label, count in zip(labels, self.counts) if count}}
+
+
+class Metrics:
+    """
+    Per-invocation metrics of the scheduler.
+
+    Records the EventBridge API calls per boto3 operation with their latency histograms,
+    the time spent in every phase of the handler, cache hits and misses and plain counters.
+    Methods are thread safe, the BulkExecutor threads record into the same instance.
+    reset() starts a new invocation, to_emf() renders it as one CloudWatch Embedded Metric Format record.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started_at = time.time()
+            self.api_calls = collections.Counter()  # operation -> calls, including the throttled retries
+            self.api_throttles = collections.Counter()  # operation -> throttled calls
+            self.api_errors = collections.Counter()  # operation -> failed calls, other than throttling
+            self.api_latencies = collections.defaultdict(LatencyHistogram)  # operation -> histogram
+            self.phase_times = collections.defaultdict(float)  # phase -> seconds, summed over the threads
+            self.phase_counts = collections.Counter()
+            self.cache_hits = collections.Counter()  # cache -> hits
+            self.cache_misses = collections.Counter()  # cache -> misses
+            self.counters = collections.Counter()
+
+    def record_call(self, operation, seconds, throttled=False, failed=False):
+        with self._lock:
+            self.api_calls[operation] += 1
+            self.api_latencies[operation].add(seconds * 1000)
+            if throttled:
+                self.api_throttles[operation] += 1
+            elif failed:
+                self.api_errors[operation] += 1
+
+    def record_phase(self, phase, seconds):
+        with self._lock:
+            self.phase_times[phase] += seconds
+            self.phase_counts[phase] += 1
+
+    @contextlib.contextmanager
+    def phase(self, phase):
+        """times the block as the phase, e.g. with metrics.phase('cleanup'): ..."""
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_phase(phase, time.perf_counter() - started_at)
+
+    def record_cache(self, cache, hit):
+        with self._lock:
+            if hit:
+                self.cache_hits[cache] += 1
+            else:
+                self.cache_misses[cache] += 1
+
+    def increment(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def cache_hit_rate(self, cache):
+        lookups = self.cache_hits[cache] + self.cache_misses[cache]
+        return self.cache_hits[cache] / lookups if lookups else None
+
+    def to_emf(self, namespace, dimensions=None, properties=None):
+        """returns the metrics of the invocation as a CloudWatch Embedded Metric Format record.
+        histograms and the other non-metric details are plain properties of the record, queryable with Logs Insights."""
+        dimensions = dict(dimensions or {})
+        record = {**dimensions}
+        definitions = []
+
+        def put(name, value, unit):
+            record[name] = value
+            definitions.append({'Name': name, 'Unit': unit})
+
+        with self._lock:
+            put('ApiCalls', sum(self.api_calls.values()), 'Count')
+            put('ApiThrottles', sum(self.api_throttles.values()), 'Count')
+            for operation, calls in sorted(self.api_calls.items()):
+                metric_name = to_metric_name(operation)
+                put(f'{metric_name}Calls', calls, 'Count')
+                put(f'{metric_name}Latency',
+                    round(self.api_latencies[operation].total_ms, 3), 'Milliseconds')
+                if self.api_throttles[operation]:
+                    put(f'{metric_name}Throttles',
+                        self.api_throttles[operation], 'Count')
+                if self.api_errors[operation]:
+                    put(f'{metric_name}Errors',
+                        self.api_errors[operation], 'Count')
+            for phase, seconds in sorted(self.phase_times.items()):
+                put(f'{to_metric_name(phase)}Time',
+                    round(seconds * 1000, 3), 'Milliseconds')
+            for cache in sorted(set(self.cache_hits) | set(self.cache_misses)):
+                metric_name = to_metric_name(cache)
+                put(f'{metric_name}CacheHits', self.cache_hits[cache], 'Count')
+                put(f'{metric_name}CacheMisses',
+                    self.cache_misses[cache], 'Count')
+                put(f'{metric_name}CacheHitRate',
+                    round(self.cache_hit_rate(cache) * 100, 2), 'Percent')
+            for name, value in sorted(self.counters.items()):
+                put(to_metric_name(name), value, 'Count')
+            record['ApiLatencyHistograms'] = {to_metric_name(operation): histogram.to_dict()
+                                              for operation, histogram in sorted(self.api_latencies.items())}
+            record['PhaseCounts'] = {to_metric_name(phase): count
+                                     for phase, count in sorted(self.phase_counts.items())}
+
+        record.update(properties or {})
+        record['_aws'] = {
+            'Timestamp': int(self.started_at * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': namespace,
+                'Dimensions': [list(dimensions)],
+                'Metrics': definitions,
+            }],
+        }
+        return record
+
+    def emit(self, namespace, dimensions=None, properties=None):
+        """prints the EMF record as a single log line, CloudWatch extracts the metrics from it."""
+        print(json.dumps(self.to_emf(namespace, dimensions, properties), separators=(',', ':'), default=str))
+
+
+class SamplingProfiler:
+    """
+    Statistical profiler for finding the hot spots of an invocation, without instrumenting the code.
+
+    A daemon thread samples the stacks of the other threads every interval_seconds, and counts
+    the innermost frames as 'file:line:function'. Threads idling in the threading and thread pool
+    internals are skipped. Cheap enough to leave on in a test environment.
+
+    usage:
+        profiler = SamplingProfiler(0.005)
+        profiler.start()
+        ...
+        profiler.stop()
+        profiler.top(10)
+    """
+
+    def __init__(self, interval_seconds=0.005) -> None:
+        self.interval_seconds = interval_seconds
+        self.samples = collections.Counter()
+        self.sample_count = 0
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        return self
+
+    def _run(self):
+        own_thread_id = threading.get_ident()
+        while not self._stopped.wait(self.interval_seconds):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread_id:
+                    continue
+                code = frame.f_code
+                if code.co_filename.endswith(IDLE_FRAME_FILES):
+                    continue
+                self.samples[f'{code.co_filename.rsplit("/", 1)[-1]}:{frame.f_lineno}:{code.co_name}'] += 1
+            self.sample_count += 1
+
+    def top(self, n=10):
+        """returns the n most sampled frames, as {'file:line:function': samples}"""
+        return dict(self.samples.most_common(n))
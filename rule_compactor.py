@@ -0,0 +1,242 @@
+import datetime
+import json
+import random
+import time
+from input_concatenators import EventBridgeInputSizeExceeded
+
+# rules running sooner than this are left alone, their targets may be firing while they are moved
+MIN_LEAD_TIME = datetime.timedelta(minutes=2)
+
+
+class RuleCompactionException(Exception):
+    pass
+
+
+class RuleCompactor:
+    """
+    Coalesces the sparse rules a few minutes apart into the earliest of them, to reclaim the rule quota.
+
+    ALLOWED_T_MINUS_MINUTES only merges at insert time and only into the earlier rules, so the jobs arriving
+    out of order leave half-empty rules behind. The compactor walks the indexed rules by date, and moves the
+    targets of the later rules within tolerance_minutes into the earliest one, as long as they fit in
+    max_targets_per_rule. Targets of the same lambda are concatenated with the input_concatenator if one is given.
+    Jobs only ever move earlier, by at most tolerance_minutes from the time of their rule.
+
+    Runs alongside the other containers scheduling, on a best-effort basis, EventBridge has no conditional writes:
+        - the targets of both rules are listed again right before the write, and merged into the current inputs.
+        - the kept rule is read back after the write, the moves overwritten by a concurrent write are retried.
+        - the targets are removed from the emptied rule by their ids, and only if they haven't changed since they
+          were listed, so a failure or a race leaves a job on both rules rather than losing it.
+        - an emptied rule is deleted without removing its targets, a rule that got a new target
+          in the meantime isn't deleted.
+        - the rules running within MIN_LEAD_TIME aren't touched.
+
+    usage:
+        compactor = RuleCompactor(eventbridge, tolerance_minutes=10)
+        compactor.plan()  # dry-run report
+        compactor.compact()
+    """
+
+    def __init__(self, eventbridge, tolerance_minutes=0, max_targets_per_rule=5, input_concatenator=None,
+                 no_concatenation_arns=(), max_retries=3, retry_backoff_seconds=0.05) -> None:
+        self.eventbridge = eventbridge
+        self.tolerance = datetime.timedelta(minutes=int(tolerance_minutes))
+        self.max_targets_per_rule = max_targets_per_rule
+        self.input_concatenator = input_concatenator
+        self.no_concatenation_arns = set(no_concatenation_arns)  # e.g. the dispatch targets of the scheduler
+        self.max_retries = max_retries
+        self.retry_backoff_seconds = retry_backoff_seconds
+
+    def merge_targets(self, targets, new_targets):
+        """merges the new targets into the targets, concatenating the inputs of the same lambda when possible.
+        returns (merged targets, {new target id: target id it's merged into}), or None if they don't fit."""
+        targets = [dict(target) for target in targets]
+        moved_target_ids = {}
+        for new_target in new_targets:
+            merged_into = None
+            if self.input_concatenator is not None and new_target.get('Arn') not in self.no_concatenation_arns:
+                for target in targets:
+                    if target.get('Arn') != new_target.get('Arn'):
+                        continue
+                    try:
+                        merged_data = self.input_concatenator.concatenate_inputs(
+                            json.loads(target.get('Input', '{}')), json.loads(new_target.get('Input', '{}')))
+                    except EventBridgeInputSizeExceeded:
+                        continue
+                    target['Input'] = json.dumps(merged_data)
+                    merged_into = target.get('Id')
+                    break
+            if merged_into is None:
+                targets.append(dict(new_target))
+                merged_into = new_target.get('Id')
+            moved_target_ids[new_target.get('Id')] = merged_into
+        if len(targets) > self.max_targets_per_rule:
+            return None
+        return targets, moved_target_ids
+
+    def plan(self, now=None):
+        """returns the merges, without changing anything:
+        [{'rule_name', 'date', 'original_targets', 'targets', 'merged_rules': [{'rule_name', 'date', 'targets', 'moved_target_ids'}]}]
+        the targets of every rule are listed again, concurrently."""
+        now = now if now else datetime.datetime.now(tz=datetime.timezone.utc)
+        rule_index = self.eventbridge.get_rule_index(refresh=True)
+        entries = rule_index.between(now + MIN_LEAD_TIME, datetime.datetime.max.replace(tzinfo=datetime.timezone.utc))
+        rule_names = [entry['rule'].get('Name') for entry in entries]
+        rules = [{'rule_name': rule_name, 'date': entry['date'], 'targets': targets}
+                 for rule_name, entry, targets in zip(rule_names, entries, self.eventbridge.get_many_rules_targets(rule_names))
+                 if targets]  # rules with unknown targets are skipped
+
+        merges = []
+        merged_rule_names = set()
+        for position, rule in enumerate(rules):
+            if rule['rule_name'] in merged_rule_names:
+                continue
+            merge = {'rule_name': rule['rule_name'], 'date': rule['date'], 'original_targets': rule['targets'],
+                     'targets': rule['targets'], 'merged_rules': []}
+            for later_rule in rules[position + 1:]:
+                if later_rule['date'] - rule['date'] > self.tolerance:
+                    break
+                if later_rule['rule_name'] in merged_rule_names:
+                    continue
+                merged = self.merge_targets(merge['targets'], later_rule['targets'])
+                if merged is None:
+                    continue  # doesn't fit, a later rule with fewer targets may
+                merge['targets'], moved_target_ids = merged
+                merge['merged_rules'].append({'rule_name': later_rule['rule_name'], 'date': later_rule['date'],
+                                              'targets': later_rule['targets'], 'moved_target_ids': moved_target_ids})
+                merged_rule_names.add(later_rule['rule_name'])
+            if merge['merged_rules']:
+                merged_rule_names.add(rule['rule_name'])
+                merges.append(merge)
+        return merges
+
+    def apply(self, merge):
+        """moves the targets of the merged rules to the kept rule, then empties and deletes the merged rules.
+        the plan is stale by now, the targets of both rules are listed again and merged into the current inputs.
+        the kept rule is read back, the moves that a concurrent write has overwritten are merged again, up to
+        max_retries times. only the targets still as they were listed are removed from the merged rules.
+        returns the names of the deleted rules."""
+        eventbridge, rule_index, rule_name = self.eventbridge, self.eventbridge.rule_index, merge['rule_name']
+        merged_rule_names = [merged_rule['rule_name'] for merged_rule in merge['merged_rules']]
+        moves = {merged_rule_name: {} for merged_rule_name in merged_rule_names}  # {target id: (target, merged into)}
+        pending = None  # {merged rule: target ids} of the moves to write again, None before the first write
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                time.sleep(random.uniform(0, self.retry_backoff_seconds * 2 ** attempt))
+            listed_targets = self.read_many_targets([rule_name] + merged_rule_names)
+            if listed_targets[0] is None:
+                raise RuleCompactionException(f"Can't list the targets of the rule: {rule_name}")
+            targets = list(listed_targets[0].values())
+            original_targets = {target.get('Id'): target for target in targets}
+            written = []
+            for merged_rule_name, merged_targets in zip(merged_rule_names, listed_targets[1:]):
+                if merged_targets is None:
+                    continue  # left alone, the next compaction retries
+                new_targets = [target for target in merged_targets.values()
+                               if pending is None or target.get('Id') in pending.get(merged_rule_name, ())]
+                merged = self.merge_targets(targets, new_targets) if new_targets else None
+                if merged is None:
+                    continue  # doesn't fit anymore
+                targets, moved_target_ids = merged
+                written.append((merged_rule_name, new_targets, moved_target_ids))
+            if not written:
+                break
+            changed_targets = [target for target in targets if original_targets.get(target.get('Id')) != target]
+            response = eventbridge.put_rule_targets(rule_name, changed_targets)
+            if not response.get('success', False):
+                rule_index.set_targets(rule_name, None)
+                raise RuleCompactionException(f"Can't put the targets on the rule: {rule_name}")
+            rule_index.upsert_targets(rule_name, changed_targets)
+
+            kept_targets = self.read_targets(rule_name)
+            pending = {}
+            for merged_rule_name, new_targets, moved_target_ids in written:
+                for target in new_targets:
+                    merged_into = moved_target_ids[target.get('Id')]
+                    if self.is_moved(target, kept_targets.get(merged_into)):
+                        moves[merged_rule_name][target.get('Id')] = (target, merged_into)
+                    else:
+                        pending.setdefault(merged_rule_name, []).append(target.get('Id'))
+            if not pending:
+                break
+            eventbridge.metrics.increment('write_conflicts')
+        else:
+            print(f"The targets {pending} are overwritten by concurrent writes {self.max_retries + 1} times, "
+                  f"they are left on their rules.")
+
+        # the targets changed since they were listed may have jobs that aren't moved, they are left on their rules
+        current_targets = dict(zip(merged_rule_names, self.read_many_targets(merged_rule_names)))
+        deleted_rule_names = []
+        for merged_rule_name in merged_rule_names:
+            targets = current_targets[merged_rule_name] or {}
+            moved_target_ids = {target_id: merged_into for target_id, (target, merged_into)
+                                in moves[merged_rule_name].items() if targets.get(target_id) == target}
+            if not moved_target_ids:
+                continue
+            # the job keys follow their targets
+            job_keys = rule_index.get_job_keys(merged_rule_name)
+            job_data = rule_index.get_job_data(merged_rule_name)
+            rule_index.add_job_keys(rule_name, {job_key: moved_target_ids[target_id] for job_key, target_id in job_keys.items()
+                                                if target_id in moved_target_ids},
+                                    {job_key: data for job_key, data in job_data.items()
+                                     if job_keys.get(job_key) in moved_target_ids})
+            if not eventbridge.remove_rule_targets(merged_rule_name, list(moved_target_ids)):
+                continue  # the targets are on both rules now, the next compaction retries
+            rule_index.remove_job_keys(merged_rule_name, [job_key for job_key, target_id in job_keys.items()
+                                                          if target_id in moved_target_ids])
+            if len(targets) == len(moved_target_ids) and eventbridge.delete_empty_rule(merged_rule_name):
+                deleted_rule_names.append(merged_rule_name)
+        return deleted_rule_names
+
+    def read_targets(self, rule_name):
+        """lists the targets of the rule, bypassing the cache. returns {target id: target}."""
+        try:
+            targets = list(self.eventbridge.iter_rules_targets(rule_name))
+        except Exception as e:
+            self.eventbridge.rule_index.set_targets(rule_name, None)
+            raise RuleCompactionException(f"Can't read back the targets of the rule: {rule_name}") from e
+        self.eventbridge.rule_index.set_targets(rule_name, targets)
+        return {target.get('Id'): target for target in targets}
+
+    def read_many_targets(self, rule_names):
+        """lists the targets of the rules concurrently, bypassing the cache.
+        returns {target id: target} of every rule in the same order, None for the rules that couldn't be listed."""
+        outcomes = self.eventbridge.executor.map(self.read_targets, rule_names)
+        return [outcome.get('result') if outcome.get('success') else None for outcome in outcomes]
+
+    def is_moved(self, target, kept_target):
+        """whether the input of the moved target is on the kept target. a target merged into another one is
+        presumed to be there if the input_concatenator can't verify it."""
+        if kept_target is None or kept_target.get('Arn') != target.get('Arn'):
+            return False
+        if kept_target.get('Id') == target.get('Id') and kept_target.get('Input') == target.get('Input'):
+            return True
+        if self.input_concatenator is None:
+            return False
+        try:
+            return self.input_concatenator.contains_inputs(
+                json.loads(kept_target.get('Input', '{}')), [json.loads(target.get('Input', '{}'))])
+        except NotImplementedError:
+            return True
+
+    def compact(self, dry_run=False, now=None):
+        """plans and applies the merges, the merges are independent of each other and applied concurrently.
+        returns the report: {'success', 'dry_run', 'rules', 'rules_to_delete', 'deleted_rules', 'merges', 'failed'}"""
+        merges = self.plan(now)
+        report = {'success': True, 'dry_run': dry_run, 'rules': len(self.eventbridge.rule_index),
+                  'rules_to_delete': sum(len(merge['merged_rules']) for merge in merges), 'deleted_rules': 0,
+                  'merges': [{'rule_name': merge['rule_name'], 'targets': len(merge['targets']),
+                              'merged_rules': [merged_rule['rule_name'] for merged_rule in merge['merged_rules']]}
+                             for merge in merges],
+                  'failed': []}
+        if dry_run:
+            return report
+
+        outcomes = self.eventbridge.executor.map(self.apply, merges)
+        for merge, outcome in zip(merges, outcomes):
+            if outcome.get('success'):
+                report['deleted_rules'] += len(outcome.get('result'))
+            else:
+                report['success'] = False
+                report['failed'].append({'rule_name': merge['rule_name'], 'exception': str(outcome.get('exception'))})
+        return report
@@ -0,0 +1,248 @@
+import bisect
+import datetime
+import json
+import os
+import struct
+import threading
+import time
+import zlib
+from utils import as_utc
+
+# snapshot file layout: header, then the zlib compressed json columns of the index
+SNAPSHOT_MAGIC = b'LSRI'
+SNAPSHOT_SCHEMA_VERSION = 4
+# magic, schema version, wall clock time the index was loaded at, crc32 and length of the payload
+SNAPSHOT_HEADER = struct.Struct('>4sHdII')
+SNAPSHOT_RULE_KEYS = ('Name', 'Arn', 'ScheduleExpression', 'State')
+
+
+class RuleIndex:
+    """
+    Sorted in-memory index of the EventBridge Rules, keyed by the UTC minute the Rules are going to run.
+
+    Range queries are bisect lookups instead of decoding every Rules ScheduleExpression again.
+    Every entry also caches the targets and the target count of the Rule, when they are known,
+    and the idempotency keys of the jobs written to its targets by this container. The data of the jobs
+    merged into a shared target is kept too, to take them out of the target again when they are cancelled.
+    find_job resolves a job key to its rule and target with a single dict lookup.
+    Local writes update the index incrementally with add_rule, set_targets, upsert_targets and remove_rule.
+    revision is increased by the changes of the rules and the job keys, to tell if the index has to be saved again.
+    the targets are only a cache of the listings, they aren't saved and don't change the revision.
+    """
+
+    def __init__(self) -> None:
+        self.loaded = False
+        self.loaded_at = None  # time.monotonic() of the last load
+        self._dates = []  # sorted rule dates
+        self._names = []  # rule names, in the same order with self._dates
+        self._entries = {}  # rule_name -> {'rule': rule, 'date': date, 'targets': {id: target} or None, 'target_count': int or None, 'job_keys': {job_key: target_id}, 'job_data': {job_key: data}}
+        self._job_rules = {}  # job_key -> rule_name
+        self.revision = 0
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, rule_name):
+        return rule_name in self._entries
+
+    def load(self, rules_with_dates):
+        """replaces the content of the index with the given (rule, date) pairs.
+        the job keys of the rules that are still there are kept."""
+        with self._lock:
+            previous_entries = self._entries
+            self._dates, self._names, self._entries, self._job_rules = [], [], {}, {}
+            for rule, date in rules_with_dates:
+                self.add_rule(rule, date)
+                previous_entry = previous_entries.get(rule.get('Name'))
+                if previous_entry is not None:
+                    self.add_job_keys(rule.get('Name'), previous_entry['job_keys'], previous_entry['job_data'])
+            self.loaded = True
+            self.loaded_at = time.monotonic()
+            self.revision += 1
+
+    def is_fresh(self, ttl_seconds):
+        """whether the index was loaded within the last ttl_seconds."""
+        return self.loaded and time.monotonic() - self.loaded_at < ttl_seconds
+
+    def add_rule(self, rule, date, targets=None):
+        with self._lock:
+            rule_name = rule.get('Name')
+            previous_entry = self.remove_rule(rule_name)
+            date = as_utc(date)
+            position = bisect.bisect_right(self._dates, date)
+            self._dates.insert(position, date)
+            self._names.insert(position, rule_name)
+            self._entries[rule_name] = {'rule': rule, 'date': date, 'targets': None, 'target_count': None,
+                                        'job_keys': {}, 'job_data': {}}
+            if previous_entry is not None:
+                self.add_job_keys(rule_name, previous_entry['job_keys'], previous_entry['job_data'])
+            self.set_targets(rule_name, targets)
+            self.revision += 1
+
+    def remove_rule(self, rule_name):
+        with self._lock:
+            entry = self._entries.pop(rule_name, None)
+            if entry is None:
+                return None
+            lo = bisect.bisect_left(self._dates, entry['date'])
+            hi = bisect.bisect_right(self._dates, entry['date'])
+            position = self._names.index(rule_name, lo, hi)
+            del self._dates[position]
+            del self._names[position]
+            for job_key in entry['job_keys']:
+                if self._job_rules.get(job_key) == rule_name:
+                    del self._job_rules[job_key]
+            self.revision += 1
+            return entry
+
+    def rule_names(self):
+        """returns the names of the indexed rules, ordered by date."""
+        with self._lock:
+            return list(self._names)
+
+    def get(self, rule_name):
+        return self._entries.get(rule_name)
+
+    def set_targets(self, rule_name, targets):
+        """caches the targets of the rule, None marks the targets as unknown."""
+        with self._lock:
+            entry = self._entries.get(rule_name)
+            if entry is not None:
+                entry['targets'] = None if targets is None else {
+                    target.get('Id'): target for target in targets}
+                entry['target_count'] = None if targets is None else len(
+                    entry['targets'])
+
+    def get_targets(self, rule_name):
+        """returns the cached targets of the rule, or None if they are unknown."""
+        with self._lock:
+            entry = self._entries.get(rule_name)
+            if entry is None or entry['targets'] is None:
+                return None
+            return list(entry['targets'].values())
+
+    def upsert_targets(self, rule_name, targets):
+        """adds or replaces the given targets of the rule, unknown targets stay unknown."""
+        with self._lock:
+            entry = self._entries.get(rule_name)
+            if entry is not None and entry['targets'] is not None:
+                for target in targets:
+                    entry['targets'][target.get('Id')] = target
+                entry['target_count'] = len(entry['targets'])
+
+    def get_job_keys(self, rule_name):
+        """returns {job_key: target_id} of the jobs known to be written to the targets of the rule."""
+        with self._lock:
+            entry = self._entries.get(rule_name)
+            return {} if entry is None else dict(entry['job_keys'])
+
+    def get_job_data(self, rule_name):
+        """returns {job_key: data} of the jobs known to be merged into the targets of the rule."""
+        with self._lock:
+            entry = self._entries.get(rule_name)
+            return {} if entry is None else dict(entry['job_data'])
+
+    def add_job_keys(self, rule_name, job_keys, job_data=None):
+        """records the jobs written to the targets of the rule, job_keys is {job_key: target_id}.
+        job_data is {job_key: data} of the jobs merged into the targets."""
+        with self._lock:
+            entry = self._entries.get(rule_name)
+            if entry is not None and job_keys:
+                entry['job_keys'].update(job_keys)
+                entry['job_data'].update(job_data or {})
+                self._job_rules.update(dict.fromkeys(job_keys, rule_name))
+                self.revision += 1
+
+    def remove_job_keys(self, rule_name, job_keys):
+        with self._lock:
+            entry = self._entries.get(rule_name)
+            if entry is None:
+                return
+            for job_key in job_keys:
+                entry['job_keys'].pop(job_key, None)
+                entry['job_data'].pop(job_key, None)
+                if self._job_rules.get(job_key) == rule_name:
+                    del self._job_rules[job_key]
+            self.revision += 1
+
+    def find_job(self, job_key):
+        """returns (rule_name, target_id) of the job, or None if it isn't known to the index."""
+        with self._lock:
+            rule_name = self._job_rules.get(job_key)
+            if rule_name is None:
+                return None
+            return rule_name, self._entries[rule_name]['job_keys'][job_key]
+
+    def between(self, start, end):
+        """returns the entries with start <= date <= end, ordered by date."""
+        with self._lock:
+            lo = bisect.bisect_left(self._dates, as_utc(start))
+            hi = bisect.bisect_right(self._dates, as_utc(end))
+            return [self._entries[name] for name in self._names[lo:hi]]
+
+    def before(self, date):
+        """returns the entries with date < date, ordered by date."""
+        with self._lock:
+            hi = bisect.bisect_left(self._dates, as_utc(date))
+            return [self._entries[name] for name in self._names[:hi]]
+
+    def save_snapshot(self, path, rule_prefix):
+        """writes the index to path atomically, in the snapshot format read by read_snapshot.
+        returns the revision of the index that is saved."""
+        with self._lock:
+            # the wall clock time of the load, monotonic clocks don't survive the container
+            indexed_at = time.time() - (time.monotonic() - self.loaded_at)
+            entries = [self._entries[name] for name in self._names]
+            columns = {
+                'rule_prefix': rule_prefix,
+                'rules': [[entry['rule'].get(key) for key in SNAPSHOT_RULE_KEYS] for entry in entries],
+                'dates': [int(entry['date'].timestamp()) for entry in entries],
+                'job_keys': [entry['job_keys'] for entry in entries],
+            }
+            revision = self.revision
+        payload = zlib.compress(json.dumps(
+            columns, separators=(',', ':')).encode())
+        header = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_SCHEMA_VERSION, indexed_at,
+                                      zlib.crc32(payload), len(payload))
+        temporary_path = f'{path}.{os.getpid()}.tmp'
+        with open(temporary_path, 'wb') as f:
+            f.write(header + payload)
+        os.replace(temporary_path, path)
+        return revision
+
+    def load_snapshot(self, snapshot, loaded_at=None):
+        """replaces the content of the index with a snapshot returned by read_snapshot.
+        the targets are unknown until they are listed again."""
+        with self._lock:
+            self._dates, self._names, self._entries, self._job_rules = [], [], {}, {}
+            for rule, date, job_keys in zip(snapshot['rules'], snapshot['dates'], snapshot['job_keys']):
+                self.add_rule(rule, date)
+                self.add_job_keys(rule.get('Name'), job_keys)
+            self.loaded = True
+            self.loaded_at = time.monotonic() if loaded_at is None else loaded_at
+            self.revision += 1
+
+
+def read_snapshot(path):
+    """reads a snapshot written by RuleIndex.save_snapshot.
+    returns {'indexed_at', 'rule_prefix', 'rules', 'dates', 'job_keys'}, or None if the file is missing,
+    corrupt or written with another schema version."""
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+        magic, schema_version, indexed_at, crc, length = SNAPSHOT_HEADER.unpack_from(data)
+        payload = data[SNAPSHOT_HEADER.size:]
+        if magic != SNAPSHOT_MAGIC or schema_version != SNAPSHOT_SCHEMA_VERSION \
+                or len(payload) != length or zlib.crc32(payload) != crc:
+            return None
+        columns = json.loads(zlib.decompress(payload))
+        return {
+            'indexed_at': indexed_at,
+            'rule_prefix': columns['rule_prefix'],
+            'rules': [dict(zip(SNAPSHOT_RULE_KEYS, rule)) for rule in columns['rules']],
+            'dates': [datetime.datetime.fromtimestamp(date, tz=datetime.timezone.utc) for date in columns['dates']],
+            'job_keys': columns['job_keys'],
+        }
+    except (OSError, ValueError, KeyError, TypeError, struct.error, zlib.error):
+        return None
@@ -0,0 +1,353 @@
+import bisect
+import datetime
+import hashlib
+import json
+import os
+import lambda_function
+from bulk_executor import BulkExecutor
+from lambda_function import EventBridge, EventBridgeException
+
+# json list of the shards, e.g. [{"name": "use1", "region_name": "us-east-1"},
+# {"name": "euw1", "region_name": "eu-west-1", "role_arn": "arn:aws:iam::123456789012:role/scheduler"}]
+SHARDS = os.getenv('SHARDS', '')
+# CONSISTENT_HASH or LEAST_LOADED
+SHARD_PLACEMENT = os.getenv('SHARD_PLACEMENT', 'CONSISTENT_HASH')
+SHARD_VIRTUAL_NODES = int(os.getenv('SHARD_VIRTUAL_NODES', 64))
+SHARD_MAX_RULES = int(os.getenv('SHARD_MAX_RULES', 300))  # EventBridge quota, per region and account
+SHARD_ID_SEPARATOR = ':'  # rule names can't have a ':', e.g. use1:AUTO_2030-12-30--20-20/3f1c9a0b7d2e...
+
+
+class ShardingException(Exception):
+    pass
+
+
+def hash_key(key):
+    return int.from_bytes(hashlib.sha256(str(key).encode()).digest()[:8], 'big')
+
+
+class HashRing:
+    """
+    Consistent hash ring of the shard names. Every shard is put on the ring virtual_nodes times,
+    so the keys are spread evenly, and adding a shard only moves about 1/n of the keys to it.
+    """
+
+    def __init__(self, names, virtual_nodes=SHARD_VIRTUAL_NODES) -> None:
+        points = sorted((hash_key(f'{name}#{i}'), name)
+                        for name in names for i in range(virtual_nodes))
+        self._hashes = [point[0] for point in points]
+        self._names = [point[1] for point in points]
+
+    def get(self, key, candidates=None):
+        """returns the shard of the key, the first of the candidates clockwise of it if candidates are given."""
+        start = bisect.bisect(self._hashes, hash_key(key))
+        for i in range(len(self._names)):
+            name = self._names[(start + i) % len(self._names)]
+            if candidates is None or name in candidates:
+                return name
+        return None
+
+
+class ShardedScheduler:
+    """
+    Front-end of a pool of EventBridge instances, one per region or assumed role, to scale past
+    the 300 rules quota and the API throttles of a single region and account.
+
+    It has the same scheduling, cancel, reschedule, query and cleanup methods as EventBridge:
+        - the jobs are placed on a shard by SHARD_PLACEMENT:
+            CONSISTENT_HASH: by the idempotency key of the job on a HashRing, the same job always goes to the same shard.
+            LEAST_LOADED: the jobs of a minute stay together, on the shard that already has a rule within
+              ALLOWED_T_MINUS_MINUTES, else on the shard with the fewest rules.
+        - only the shards in the region of the job's lambda are candidates, a rule can't target a lambda in another region.
+        - the job ids are prefixed with the name of their shard, cancel and reschedule go to the owning shard.
+        - query and cleanup fan out to every shard concurrently.
+        - the shards are named after their keys. with DISPATCHER, the dispatch rules pass the name of their shard,
+          and the buckets of every shard are kept apart in the shared job store.
+
+    usage:
+        scheduler = ShardedScheduler({'use1': EventBridge(boto3.client('events', region_name='us-east-1')),
+                                      'use2': EventBridge(boto3.client('events', region_name='us-east-2'))})
+        scheduler.create_rule_from_event(event)
+    """
+
+    def __init__(self, shards, placement=None, virtual_nodes=SHARD_VIRTUAL_NODES, executor=None) -> None:
+        if not shards:
+            raise ShardingException('Please provide at least one shard.')
+        for name in shards:
+            if not name or SHARD_ID_SEPARATOR in name or '/' in name:
+                raise ShardingException(f"Invalid shard name: {name!r}, it can't have a '{SHARD_ID_SEPARATOR}' or '/'.")
+        self.shards = dict(shards)  # name -> EventBridge
+        for name, eventbridge in self.shards.items():
+            if eventbridge.shard_name is None:
+                eventbridge.shard_name = name
+        self.placement = placement if placement else SHARD_PLACEMENT
+        if self.placement not in ('CONSISTENT_HASH', 'LEAST_LOADED'):
+            raise ShardingException(f"Unknown SHARD_PLACEMENT: {self.placement}")
+        self.ring = HashRing(self.shards, virtual_nodes)
+        self.executor = executor if executor else BulkExecutor(max_workers=len(self.shards))
+
+    @classmethod
+    def from_environment(cls, **kwargs):
+        """creates the shards of SHARDS, with a boto3 client of their region and role."""
+        try:
+            shard_configs = json.loads(SHARDS)
+        except ValueError:
+            raise ShardingException('Please set the environment variable SHARDS to a json list of the shards.')
+        snapshot_path = lambda_function.RULE_INDEX_SNAPSHOT_PATH
+        shards = {}
+        for config in shard_configs:
+            eventbridge = EventBridge(
+                create_events_client(config.get('region_name'), config.get('role_arn')),
+                snapshot_path=f"{snapshot_path}.{config['name']}" if snapshot_path else '', shard_name=config['name'])
+            if config.get('scheduler_function_arn'):
+                eventbridge.scheduler_function_arn = config['scheduler_function_arn']
+            shards[config['name']] = eventbridge
+        return cls(shards, **kwargs)
+
+    @property
+    def scheduler_function_arn(self):
+        return self.get_home_shard().scheduler_function_arn
+
+    @scheduler_function_arn.setter
+    def scheduler_function_arn(self, scheduler_function_arn):
+        """sets the scheduler of the shards that don't have one of their own yet."""
+        for eventbridge in self.shards.values():
+            if eventbridge.scheduler_function_arn is None:
+                eventbridge.scheduler_function_arn = scheduler_function_arn
+
+    def get_shard(self, name) -> EventBridge:
+        if name not in self.shards:
+            raise ShardingException(f"There is no shard named {name!r}.")
+        return self.shards[name]
+
+    def get_home_shard(self) -> EventBridge:
+        """returns the first shard in the region of its own scheduler, where the maintenance rule is installed.
+        a rule can only invoke the scheduler in its region."""
+        for eventbridge in self.shards.values():
+            arn_parts = (eventbridge.scheduler_function_arn or '').split(':')
+            if len(arn_parts) > 3 and self.get_region_name(eventbridge) in (None, arn_parts[3]):
+                return eventbridge
+        return next(iter(self.shards.values()))
+
+    def get_lambda_function_arn(self, input_lambda_function):
+        return next(iter(self.shards.values())).get_lambda_function_arn(input_lambda_function)
+
+    # placement
+    @staticmethod
+    def get_region_name(eventbridge):
+        client = eventbridge.client
+        return getattr(getattr(client, 'meta', None), 'region_name', None) or getattr(client, 'region_name', None)
+
+    def get_candidate_shards(self, lambda_function_arn):
+        """returns the names of the shards that can target the lambda, the ones in its region.
+        with DISPATCHER every shard is, its rules target its scheduler, and the scheduler invokes the lambda."""
+        if lambda_function.RULE_TARGET_ADDING_STRATEGY == 'DISPATCHER':
+            return list(self.shards)
+        arn_parts = lambda_function_arn.split(':')
+        arn_region = arn_parts[3] if len(arn_parts) > 3 else None
+        return [name for name, eventbridge in self.shards.items()
+                if not arn_region or self.get_region_name(eventbridge) in (None, arn_region)]
+
+    def place(self, event, lambda_function_arn, planned_rules=None):
+        """returns the name of the shard of the job. planned_rules is {rule_name: shard name} of the new rules
+        planned earlier in the same batch, for LEAST_LOADED."""
+        candidates = self.get_candidate_shards(lambda_function_arn)
+        if not candidates:
+            raise ShardingException(f"There is no shard in the region of {lambda_function_arn}")
+        if self.placement == 'CONSISTENT_HASH':
+            return self.ring.get(EventBridge.generate_job_key(event, lambda_function_arn), set(candidates))
+
+        # the job goes where a rule within ALLOWED_T_MINUS_MINUTES is, the latest one if there are many,
+        # so the jobs of a window stay together and a job submitted again finds the shard it's on.
+        planned_rules = planned_rules if planned_rules is not None else {}
+        date = event.get('datetime_utc')
+        window_start = date - datetime.timedelta(minutes=int(lambda_function.ALLOWED_T_MINUS_MINUTES or 0))
+        latest_rule_dates = {}  # shard name -> date of its latest rule in the window
+        for name in candidates:
+            entries = self.shards[name].get_rule_index().between(window_start, date)
+            if entries:
+                latest_rule_dates[name] = entries[-1]['date']
+        for rule_name, name in planned_rules.items():
+            rule_date = lambda_function.decode_rule_name_to_date(rule_name)
+            if name in candidates and rule_date is not None and window_start <= rule_date <= date:
+                latest_rule_dates[name] = max(latest_rule_dates.get(name, rule_date), rule_date)
+        if latest_rule_dates:
+            return max(latest_rule_dates, key=lambda name: latest_rule_dates[name])
+
+        loads = {name: len(self.shards[name].get_rule_index()) +
+                 sum(1 for planned_name in planned_rules.values() if planned_name == name) for name in candidates}
+        name = min(candidates, key=lambda name: loads[name])
+        if loads[name] >= SHARD_MAX_RULES:
+            raise ShardingException(f"Every shard in the region of {lambda_function_arn} has {SHARD_MAX_RULES} rules.")
+        planned_rules[self.shards[name].generate_rule_name_from_event(event)] = name  # a new window
+        return name
+
+    # scheduling
+    def create_rule_from_event(self, event):
+        """schedules a single event, or a list of events with create_rules_from_events."""
+        if isinstance(event, list):
+            return self.create_rules_from_events(event)
+
+        result = self.create_rules_from_events([event]).get('results')[0]
+        if not result.get('success', False) and result.get('exception'):
+            raise EventBridgeException(result.get('exception'))
+        return {'success': result.get('success', False),
+                **{key: result[key] for key in ('duplicate', 'rule_name', 'target_id', 'job_id', 'shard') if key in result}}
+
+    def create_rules_from_events(self, events):
+        """places the events on their shards, and schedules the events of every shard as a batch, concurrently.
+        returns {'success': bool, 'results': [...]} with a result for every event, in the same order."""
+        results = [None] * len(events)
+        shard_indexes = {}  # shard name -> indexes of its events
+        planned_rules = {}
+        for index, event in enumerate(events):
+            try:
+                lambda_function_arn = self.get_lambda_function_arn(event.get('lambda_function'))
+                name = self.place(event, lambda_function_arn, planned_rules)
+            except (EventBridgeException, ShardingException) as e:
+                results[index] = {'success': False, 'exception': str(e)}
+                continue
+            shard_indexes.setdefault(name, []).append(index)
+
+        outcomes = self.executor.map(
+            lambda item: self.shards[item[0]].create_rules_from_events([events[index] for index in item[1]]),
+            shard_indexes.items())
+        for (name, indexes), outcome in zip(shard_indexes.items(), outcomes):
+            shard_results = outcome.get('result').get('results') if outcome.get('success') else \
+                [{'success': False, 'exception': str(outcome.get('exception'))} for _ in indexes]
+            for index, result in zip(indexes, shard_results):
+                results[index] = self.add_shard(name, result)
+
+        return {'success': all(result.get('success', False) for result in results), 'results': results}
+
+    # jobs
+    @staticmethod
+    def add_shard(name, result):
+        """prefixes the job ids of a shard's result with the shard name."""
+        result = {**result, 'shard': name}
+        for key in ('job_id', 'previous_job_id'):
+            if result.get(key):
+                result[key] = generate_sharded_job_id(name, result[key])
+        return result
+
+    def get_owning_shard(self, job_id):
+        name, shard_job_id = parse_sharded_job_id(job_id)
+        if name not in self.shards:
+            raise ShardingException(f"The job {job_id} isn't on any shard.")
+        return name, shard_job_id
+
+    def cancel_job(self, job_id, data=None):
+        try:
+            name, shard_job_id = self.get_owning_shard(job_id)
+        except ShardingException as e:
+            return {'success': False, 'job_id': job_id, 'exception': str(e)}
+        return self.add_shard(name, self.shards[name].cancel_job(shard_job_id, data))
+
+    def reschedule_job(self, job_id, date, data=None):
+        """moves the job to the date, on the shard it's on."""
+        try:
+            name, shard_job_id = self.get_owning_shard(job_id)
+        except ShardingException as e:
+            return {'success': False, 'job_id': job_id, 'exception': str(e)}
+        return self.add_shard(name, self.shards[name].reschedule_job(shard_job_id, date, data))
+
+    def query_jobs(self, start, end, lambda_function_arn=None, limit=None, next_token=None):
+        """queries every shard concurrently, and merges their jobs by date. a page ends at a rule like
+        EventBridge.query_jobs, next_token holds the position of every shard that has jobs left."""
+        limit = limit if limit else lambda_function.QUERY_PAGE_SIZE
+        if next_token:
+            try:
+                shard_tokens = json.loads(next_token)
+            except ValueError:
+                shard_tokens = None
+            if not isinstance(shard_tokens, dict):
+                raise ShardingException(f"Invalid next_token: {next_token}")
+        else:
+            shard_tokens = dict.fromkeys(self.shards)  # from the start
+        names = [name for name in shard_tokens if name in self.shards]
+        outcomes = self.executor.map(lambda name: self.shards[name].query_jobs(
+            start, end, lambda_function_arn, limit, shard_tokens[name]), names)
+
+        merged_jobs = []  # (datetime_utc, shard name, position in its page, job)
+        pages = {}
+        for name, outcome in zip(names, outcomes):
+            if not outcome.get('success'):
+                raise ShardingException(f"Can't query the shard {name}: {outcome.get('exception')}")
+            pages[name] = outcome.get('result')
+            merged_jobs.extend((job['datetime_utc'], name, position, job)
+                               for position, job in enumerate(pages[name]['jobs']))
+        merged_jobs.sort(key=lambda item: item[:3])
+
+        # the jobs of the last rule on the page aren't split
+        count = min(limit, len(merged_jobs))
+        while 0 < count < len(merged_jobs) and merged_jobs[count][1] == merged_jobs[count - 1][1] and \
+                merged_jobs[count][3]['rule_name'] == merged_jobs[count - 1][3]['rule_name']:
+            count += 1
+        next_tokens = {name: page['next_token'] for name, page in pages.items() if page['next_token']}
+        for _, name, _, job in reversed(merged_jobs[count:]):
+            next_tokens[name] = job['rule_name']  # the first job of the shard left out of the page
+        jobs = [{**job, 'job_ids': [generate_sharded_job_id(name, job_id) for job_id in job['job_ids']], 'shard': name}
+                for _, name, _, job in merged_jobs[:count]]
+        return {'success': True, 'jobs': jobs, 'next_token': json.dumps(next_tokens) if next_tokens else None}
+
+    # maintenance
+    def map_shards(self, fn):
+        """runs fn(eventbridge) on every shard concurrently. returns {'success': bool, 'shards': {name: result}}"""
+        outcomes = self.executor.map(lambda name: fn(self.shards[name]), list(self.shards))
+        results = {name: outcome.get('result') if outcome.get('success') else
+                   {'success': False, 'exception': str(outcome.get('exception'))}
+                   for name, outcome in zip(self.shards, outcomes)}
+        return {'success': all(outcome.get('success') and (not isinstance(outcome.get('result'), dict) or
+                                                           outcome.get('result').get('success', True))
+                               for outcome in outcomes),
+                'shards': results}
+
+    def clean_up_expired_rules(self, context=None):
+        return self.map_shards(lambda eventbridge: eventbridge.clean_up_expired_rules(context))
+
+    def run_maintenance(self, context=None):
+        return self.map_shards(lambda eventbridge: eventbridge.run_maintenance(context))
+
+    def compact_rules(self, dry_run=False):
+        return self.map_shards(lambda eventbridge: eventbridge.compact_rules(dry_run))
+
+    def save_rule_index_snapshot(self):
+        for eventbridge in self.shards.values():
+            eventbridge.save_rule_index_snapshot()
+
+    def get_capacity(self):
+        """returns {name: {'rules', 'quota_utilisation'}} of every shard, from their rule indexes."""
+        return {name: {'rules': len(eventbridge.get_rule_index()),
+                       'quota_utilisation': len(eventbridge.get_rule_index()) / SHARD_MAX_RULES}
+                for name, eventbridge in self.shards.items()}
+
+
+def generate_sharded_job_id(name, job_id):
+    return f"{name}{SHARD_ID_SEPARATOR}{job_id}"
+
+
+def parse_sharded_job_id(job_id):
+    """returns (shard name, job id on the shard), shard name is None if the job id isn't sharded."""
+    name, separator, shard_job_id = str(job_id).partition(SHARD_ID_SEPARATOR)
+    return (name, shard_job_id) if separator else (None, job_id)
+
+
+def create_events_client(region_name=None, role_arn=None):
+    """returns an events client of the region. with a role_arn, the role is assumed and its credentials
+    are refreshed before they expire, the containers outlive them."""
+    import boto3
+    if not role_arn:
+        return boto3.client('events', region_name=region_name)
+    from botocore.credentials import RefreshableCredentials
+    from botocore.session import get_session
+    sts_client = boto3.client('sts')
+
+    def assume_role():
+        credentials = sts_client.assume_role(
+            RoleArn=role_arn, RoleSessionName='aws-lambda-scheduler')['Credentials']
+        return {'access_key': credentials['AccessKeyId'], 'secret_key': credentials['SecretAccessKey'],
+                'token': credentials['SessionToken'], 'expiry_time': credentials['Expiration'].isoformat()}
+
+    botocore_session = get_session()
+    botocore_session._credentials = RefreshableCredentials.create_from_metadata(
+        metadata=assume_role(), refresh_using=assume_role, method='sts-assume-role')
+    return boto3.Session(botocore_session=botocore_session).client('events', region_name=region_name)
@@ -0,0 +1,44 @@
+import os
+import sys
+
+os.environ.setdefault('EMIT_METRICS', 'false')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest  # noqa: E402
+import benchmarks  # noqa: E402
+import lambda_function  # noqa: E402
+from eventbridge_emulator import FakeEventBridgeClient  # noqa: E402
+
+LAMBDA_ARN = 'arn:aws:lambda:us-east-1:123456789012:function:a'
+OTHER_LAMBDA_ARN = 'arn:aws:lambda:us-east-1:123456789012:function:b'
+
+# the module globals the tests change, restored after every test
+CONFIGURATION = ('RULE_TARGET_ADDING_STRATEGY', 'INPUT_CONCATENATOR_CLASS_NAME', 'ALLOWED_T_MINUS_MINUTES',
+                 'EMIT_METRICS', 'RULE_INDEX_SNAPSHOT_PATH', 'MAINTENANCE_RULE_ENABLED', 'COMPACTION_TOLERANCE_MINUTES',
+                 'WRITE_CONFLICT_CHECK_ENABLED', 'SHARDS_ENABLED', '_input_concatenator', '_eventbridge',
+                 '_maintenance_rule_installed')
+
+
+@pytest.fixture
+def context():
+    return benchmarks.FakeContext()
+
+
+@pytest.fixture
+def scheduler(monkeypatch):
+    """configure(strategy) points the lambda handler to a fresh emulator with the strategy of benchmarks.STRATEGIES,
+    and returns the FakeEventBridgeClient."""
+    for name in CONFIGURATION:
+        monkeypatch.setattr(lambda_function, name, getattr(lambda_function, name))
+    lambda_function._metrics.reset()
+
+    def configure(strategy, client=None):
+        client = client if client is not None else FakeEventBridgeClient()
+        benchmarks.configure(strategy, client, max_tps=1e6)
+        return client
+    return configure
+
+
+def make_event(minute, data, lambda_function_arn=LAMBDA_ARN, hour=10, **kwargs):
+    return {'datetime_utc': f'2031-01-01 {hour:02d}:{minute:02d}:00', 'lambda_function': lambda_function_arn,
+            'data': data, **kwargs}
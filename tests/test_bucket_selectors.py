@@ -0,0 +1,58 @@
+import datetime
+import lambda_function
+from bucket_selectors import BestFitBucketSelector, FirstRuleBucketSelector
+from conftest import LAMBDA_ARN, OTHER_LAMBDA_ARN, make_event
+
+DATE = datetime.datetime(2031, 1, 1, 10, 10, tzinfo=datetime.timezone.utc)
+
+
+def make_rule(name, minute, arns):
+    targets = None if arns is None else [{'Arn': arn} for arn in arns]
+    return {'Name': name, 'cron_datetime': DATE.replace(minute=minute), 'targets': targets,
+            'target_count': None if targets is None else len(targets)}
+
+
+def select(rules, slots_needed=1, concatenate=False):
+    rule = BestFitBucketSelector().select_rule(rules, DATE, LAMBDA_ARN, slots_needed=slots_needed,
+                                               concatenate=concatenate, max_targets=5)
+    return None if rule is None else rule['Name']
+
+
+def test_best_fit_packs_the_fullest_rule():
+    rules = [make_rule('empty', 9, []), make_rule('three', 5, [OTHER_LAMBDA_ARN] * 3),
+             make_rule('full', 8, [OTHER_LAMBDA_ARN] * 5)]
+    assert select(rules) == 'three'
+    assert select(rules, slots_needed=2) == 'three'
+    assert select(rules, slots_needed=3) == 'empty'
+    assert select(rules, slots_needed=6) is None
+
+
+def test_best_fit_prefers_the_nearest_of_the_equally_full_rules():
+    assert select([make_rule('early', 1, [OTHER_LAMBDA_ARN]), make_rule('late', 9, [OTHER_LAMBDA_ARN])]) == 'late'
+
+
+def test_best_fit_concatenates_into_a_rule_of_the_same_lambda():
+    rules = [make_rule('full-same', 2, [LAMBDA_ARN] + [OTHER_LAMBDA_ARN] * 4), make_rule('same', 1, [LAMBDA_ARN]),
+             make_rule('fuller', 9, [OTHER_LAMBDA_ARN] * 3)]
+    assert select(rules, concatenate=True) == 'full-same'  # no new target is needed
+    assert select(rules, concatenate=False) == 'fuller'
+
+
+def test_best_fit_skips_the_rules_with_unknown_targets():
+    assert select([make_rule('unknown', 9, None)]) is None
+    assert select([make_rule('unknown', 9, None), make_rule('known', 1, [])]) == 'known'
+
+
+def test_first_rule_ignores_the_targets():
+    rules = [make_rule('full', 1, [OTHER_LAMBDA_ARN] * 5), make_rule('empty', 2, [])]
+    assert FirstRuleBucketSelector().select_rule(rules, DATE, LAMBDA_ARN)['Name'] == 'full'
+    assert FirstRuleBucketSelector().select_rule([], DATE, LAMBDA_ARN) is None
+
+
+def test_jobs_within_the_window_share_a_rule(scheduler, context):
+    client = scheduler('concurrent+t_minus')
+    for minute in (5, 8, 12, 15, 16):
+        assert lambda_function.lambda_handler(make_event(minute, {'id': [minute]}), context)['success']
+    # the 10 minutes window of 10:16 reaches back to 10:06 only
+    assert sorted(client.rules) == ['AUTO_2031-1-1--10-16', 'AUTO_2031-1-1--10-5']
+    assert len(client.targets['AUTO_2031-1-1--10-5']) == 4
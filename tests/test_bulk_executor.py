@@ -0,0 +1,86 @@
+import time
+import pytest
+from bulk_executor import AdaptiveTokenBucket, BulkExecutor, is_throttling_exception
+from eventbridge_emulator import FakeEventBridgeClient
+from metrics import Metrics
+
+
+class FlakyCall:
+    """raises the error for the first failures calls, then returns 'ok'."""
+
+    def __init__(self, failures, code='ThrottlingException') -> None:
+        self.failures = failures
+        self.code = code
+        self.calls = 0
+        self.__name__ = 'put_targets'
+
+    def __call__(self):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise FakeEventBridgeClient._error(self.code, 'Rate exceeded', 'PutTargets')
+        return 'ok'
+
+
+def test_throttled_calls_are_retried():
+    metrics = Metrics()
+    executor = BulkExecutor(max_rate=1e6, max_retries=3, base_delay=0.001, metrics=metrics)
+    call = FlakyCall(failures=2)
+    assert executor.call(call) == 'ok'
+    assert call.calls == 3
+    assert metrics.api_calls['put_targets'] == 3
+    assert metrics.api_throttles['put_targets'] == 2
+
+
+def test_throttled_calls_give_up_after_max_retries():
+    executor = BulkExecutor(max_rate=1e6, max_retries=2, base_delay=0.001)
+    call = FlakyCall(failures=5)
+    with pytest.raises(Exception) as e:
+        executor.call(call)
+    assert is_throttling_exception(e.value)
+    assert call.calls == 3
+
+
+def test_other_errors_are_not_retried():
+    executor = BulkExecutor(max_rate=1e6, base_delay=0.001)
+    call = FlakyCall(failures=1, code='ValidationException')
+    with pytest.raises(Exception):
+        executor.call(call)
+    assert call.calls == 1
+    assert not is_throttling_exception(ValueError('not a ClientError'))
+
+
+def test_the_rate_adapts_to_throttling():
+    bucket = AdaptiveTokenBucket(max_rate=8, min_rate=2)
+    bucket.on_throttle()
+    assert bucket.rate == 4
+    bucket.on_throttle()
+    bucket.on_throttle()
+    assert bucket.rate == 2  # not below min_rate
+    bucket.on_success()
+    assert bucket.rate == 3
+    for _ in range(10):
+        bucket.on_success()
+    assert bucket.rate == 8  # not above max_rate
+
+
+def test_the_token_bucket_limits_the_rate():
+    bucket = AdaptiveTokenBucket(max_rate=20)
+    started_at = time.monotonic()
+    for _ in range(25):  # a full bucket of 20, then 5 more at 20 per second
+        bucket.acquire()
+    assert time.monotonic() - started_at >= 0.2
+
+
+def test_map_reports_every_outcome_in_order():
+    executor = BulkExecutor(max_workers=4, max_rate=1e6)
+    outcomes = executor.map(lambda i: 10 // i, [1, 0, 2, 5])
+    assert [outcome['success'] for outcome in outcomes] == [True, False, True, True]
+    assert [outcome.get('result') for outcome in outcomes] == [10, None, 5, 2]
+    assert isinstance(outcomes[1]['exception'], ZeroDivisionError)
+
+
+def test_nested_map_runs_inline():
+    executor = BulkExecutor(max_workers=2, max_rate=1e6)
+    outcomes = executor.map(lambda i: [outcome['result'] for outcome in executor.map(lambda j: i * j, range(3))],
+                            range(4))
+    assert [outcome['result'] for outcome in outcomes] == [[0, 0, 0], [0, 1, 2], [0, 2, 4], [0, 3, 6]]
@@ -0,0 +1,68 @@
+import json
+import lambda_function
+from conftest import make_event
+
+LISTINGS = ('ListRules', 'DescribeRule', 'ListTargetsByRule')
+
+
+def count_listings(client):
+    return {operation: client.calls[operation] for operation in LISTINGS}
+
+
+def test_warm_invocations_reuse_the_cache(scheduler, context):
+    client = scheduler('concurrent')
+    assert lambda_function.lambda_handler(make_event(5, {'id': [1]}), context)['success']
+    listings = count_listings(client)
+    assert listings['ListRules'] == 1
+    for i in range(2, 5):
+        assert lambda_function.lambda_handler(make_event(5, {'id': [i]}), context)['success']
+    assert count_listings(client) == listings
+    assert client.calls['PutRule'] == 1
+
+
+def test_the_cache_expires(scheduler, context):
+    client = scheduler('concurrent')
+    assert lambda_function.lambda_handler(make_event(5, {'id': [1]}), context)['success']
+    listings = count_listings(client)
+    lambda_function._eventbridge.rule_index.loaded_at -= lambda_function.RULE_CACHE_TTL_SECONDS
+    assert lambda_function.lambda_handler(make_event(5, {'id': [2]}), context)['success']
+    assert client.calls['ListRules'] == listings['ListRules'] + 1
+    assert client.calls['ListTargetsByRule'] == listings['ListTargetsByRule'] + 1
+
+
+def test_a_ttl_of_zero_disables_the_cache(scheduler, context, monkeypatch):
+    client = scheduler('concurrent')
+    monkeypatch.setattr(lambda_function, 'RULE_CACHE_TTL_SECONDS', 0)
+    assert lambda_function.lambda_handler(make_event(5, {'id': [0]}), context)['success']
+    for i in range(1, 3):
+        listings = count_listings(client)
+        assert lambda_function.lambda_handler(make_event(5, {'id': [i]}), context)['success']
+        assert client.calls['ListRules'] > listings['ListRules']
+        assert client.calls['ListTargetsByRule'] > listings['ListTargetsByRule']
+
+
+def test_a_failed_write_invalidates_the_cached_targets(scheduler, context):
+    client = scheduler('concurrent')
+    assert lambda_function.lambda_handler(make_event(5, {'id': [1]}), context)['success']
+    put_targets = client.put_targets
+    client.put_targets = lambda Targets, **kwargs: {
+        'FailedEntryCount': len(Targets), 'FailedEntries': [{'TargetId': target['Id']} for target in Targets],
+        'ResponseMetadata': {'HTTPStatusCode': 200}}
+    assert not lambda_function.lambda_handler(make_event(5, {'id': [2]}), context)['success']
+    assert lambda_function._eventbridge.rule_index.get_targets('AUTO_2031-1-1--10-5') is None
+    client.put_targets = put_targets
+    listed = client.calls['ListTargetsByRule']
+    assert lambda_function.lambda_handler(make_event(5, {'id': [3]}), context)['success']
+    assert client.calls['ListTargetsByRule'] == listed + 1
+
+
+def test_concatenated_inputs_are_listed_fresh(scheduler, context):
+    client = scheduler('concatenator')
+    first_container = lambda_function._eventbridge
+    assert lambda_function.lambda_handler(make_event(5, {'id': [1]}), context)['success']
+    lambda_function._eventbridge = lambda_function.EventBridge(client)
+    assert lambda_function.lambda_handler(make_event(5, {'id': [2]}), context)['success']
+    lambda_function._eventbridge = first_container
+    assert lambda_function.lambda_handler(make_event(5, {'id': [3]}), context)['success']
+    assert [json.loads(target['Input']) for target in client.targets['AUTO_2031-1-1--10-5'].values()] == [
+        {'id': [1, 2, 3]}]
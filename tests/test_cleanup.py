@@ -0,0 +1,72 @@
+import lambda_function
+from conftest import LAMBDA_ARN, make_event
+
+
+def add_expired_rules(client, minutes):
+    """adds a rule with a target for every minute of 2020-01-01 10:00, returns their names."""
+    rule_names = []
+    for minute in minutes:
+        rule_name = f'AUTO_2020-1-1--10-{minute}'
+        client.put_rule(Name=rule_name, ScheduleExpression=f'cron({minute} 10 1 1 ? 2020)')
+        client.put_targets(Rule=rule_name, Targets=[{'Id': 'a', 'Arn': LAMBDA_ARN, 'Input': '{}'}])
+        rule_names.append(rule_name)
+    return rule_names
+
+
+def test_failed_target_removal_keeps_the_rule(scheduler, context):
+    client = scheduler('concurrent')
+    failing_rule_name, rule_name = add_expired_rules(client, [1, 2])
+    eventbridge = lambda_function._eventbridge
+    remove_targets = client.remove_targets
+
+    def fail_on_the_first_rule(Rule, Ids, **kwargs):
+        if Rule == failing_rule_name:
+            return {'FailedEntryCount': 1, 'FailedEntries': [{'TargetId': 'a'}], 'ResponseMetadata': {'HTTPStatusCode': 200}}
+        return remove_targets(Rule=Rule, Ids=Ids, **kwargs)
+    client.remove_targets = fail_on_the_first_rule
+
+    eventbridge.get_rule_index()
+    assert not eventbridge.delete_rules_targets(failing_rule_name)
+    assert eventbridge.rule_index.get_targets(failing_rule_name) is None  # unknown, not empty
+
+    deleted = eventbridge.clean_up_expired_rules(context)
+    assert [rule['Name'] for rule in deleted] == [rule_name]
+    assert list(client.rules) == [failing_rule_name]
+    assert client.calls['DeleteRule'] == 1
+
+
+def test_cleanup_resumes_from_the_watermark(scheduler, context, monkeypatch):
+    client = scheduler('concurrent')
+    monkeypatch.setattr(lambda_function, 'CLEANUP_MAX_DELETIONS_PER_CALL', 3)
+    rule_names = add_expired_rules(client, [7, 1, 6, 2, 5, 3, 4])
+    eventbridge = lambda_function._eventbridge
+
+    deleted = [[rule['Name'] for rule in eventbridge.clean_up_expired_rules(context)] for _ in range(3)]
+    assert deleted == [sorted(rule_names)[:3], sorted(rule_names)[3:6], sorted(rule_names)[6:]]
+    assert not client.rules
+    # the sweep is completed, it isn't repeated for CLEANUP_MIN_INTERVAL_SECONDS
+    calls = client.total_calls
+    add_expired_rules(client, [8])
+    assert eventbridge.clean_up_expired_rules(context) == []
+    assert client.total_calls == calls + 2  # the put_rule and put_targets above
+
+
+def test_cleanup_stops_when_the_lambda_is_out_of_time(scheduler, context):
+    client = scheduler('concurrent')
+    add_expired_rules(client, [1, 2])
+    eventbridge = lambda_function._eventbridge
+    context.remaining_time_in_millis = lambda_function.CLEANUP_RESERVED_TIME_MS - 1
+    assert eventbridge.clean_up_expired_rules(context) == []
+    assert len(client.rules) == 2
+    context.remaining_time_in_millis = 60000
+    assert len(eventbridge.clean_up_expired_rules(context)) == 2
+
+
+def test_schedule_requests_clean_up_within_the_budget(scheduler, context, monkeypatch):
+    client = scheduler('concurrent')
+    monkeypatch.setattr(lambda_function, 'CLEANUP_MAX_DELETIONS_PER_CALL', 2)
+    add_expired_rules(client, [1, 2, 3])
+    assert lambda_function.lambda_handler(make_event(5, {'id': [1]}), context)['success']
+    assert sorted(client.rules) == ['AUTO_2020-1-1--10-3', 'AUTO_2031-1-1--10-5']
+    assert lambda_function.lambda_handler(make_event(6, {'id': [2]}), context)['success']
+    assert sorted(client.rules) == ['AUTO_2031-1-1--10-5', 'AUTO_2031-1-1--10-6']
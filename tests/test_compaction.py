@@ -0,0 +1,95 @@
+import json
+import lambda_function
+import pytest
+from conftest import LAMBDA_ARN, make_event
+
+
+def get_inputs(client):
+    """returns {rule name: [data of every target]}"""
+    return {rule_name: [json.loads(target.get('Input', '{}')) for target in targets.values()]
+            for rule_name, targets in sorted(client.targets.items())}
+
+
+def schedule_out_of_order(scheduler, context, strategy, minutes):
+    """schedules a job per minute, the later minutes first, so every job gets a rule of its own."""
+    client = scheduler(strategy)
+    lambda_function.COMPACTION_TOLERANCE_MINUTES = 10
+    for minute in minutes:
+        assert lambda_function.lambda_handler(make_event(minute, {'id': [minute]}), context)['success']
+    return client, lambda_function._eventbridge
+
+
+@pytest.mark.parametrize('strategy', ['concurrent+t_minus', 'concatenator+t_minus', 'dispatcher+t_minus'])
+def test_compaction(scheduler, context, strategy):
+    client, _ = schedule_out_of_order(scheduler, context, strategy, [30, 25, 20, 15, 10, 5])
+    assert len(client.rules) == 6
+    dry_run = lambda_function.lambda_handler({'action': 'compact', 'dry_run': True}, context)
+    assert dry_run['rules_to_delete'] == 4
+    assert len(client.rules) == 6
+
+    response = lambda_function.lambda_handler({'action': 'compact'}, context)
+    assert response['success']
+    assert response['deleted_rules'] == 4
+    assert sorted(client.rules) == ['AUTO_2031-1-1--10-20', 'AUTO_2031-1-1--10-5']
+    jobs = lambda_function.lambda_handler({'action': 'query', 'from_datetime_utc': '2031-01-01 10:00:00',
+                                           'to_datetime_utc': '2031-01-01 11:00:00'}, context)['jobs']
+    assert sorted(value for job in jobs for value in job['data']['id']) == [5, 10, 15, 20, 25, 30]
+
+
+def test_compaction_keeps_a_job_merged_into_the_emptied_rule(scheduler, context):
+    client, eventbridge = schedule_out_of_order(scheduler, context, 'concatenator+t_minus', [20, 15])
+    put_rule_targets = eventbridge.put_rule_targets
+    raced = []
+
+    def put_then_merge(rule_name, targets):
+        # another container concatenates job 99 into the rule being emptied, after the compactor listed it
+        response = put_rule_targets(rule_name, targets)
+        if not raced:
+            raced.append(True)
+            target = dict(next(iter(client.targets['AUTO_2031-1-1--10-20'].values())))
+            target['Input'] = json.dumps({'id': [20, 99]})
+            client.put_targets(Rule='AUTO_2031-1-1--10-20', Targets=[target])
+        return response
+    eventbridge.put_rule_targets = put_then_merge
+
+    response = eventbridge.compact_rules()
+    assert response['deleted_rules'] == 0
+    assert get_inputs(client) == {'AUTO_2031-1-1--10-15': [{'id': [15, 20]}],
+                                  'AUTO_2031-1-1--10-20': [{'id': [20, 99]}]}
+
+
+def test_compaction_writes_the_moves_overwritten_by_a_concurrent_write_again(scheduler, context):
+    client, eventbridge = schedule_out_of_order(scheduler, context, 'concatenator+t_minus', [20, 15])
+    put_rule_targets = eventbridge.put_rule_targets
+    raced = []
+
+    def put_then_overwrite(rule_name, targets):
+        # another container writes the kept target it read before the compactor's write, merging job 77 into it
+        stale_targets = [dict(target) for target in client.targets[rule_name].values()]
+        response = put_rule_targets(rule_name, targets)
+        if not raced:
+            raced.append(True)
+            stale_targets[0]['Input'] = json.dumps({'id': [15, 77]})
+            client.put_targets(Rule=rule_name, Targets=stale_targets)
+        return response
+    eventbridge.put_rule_targets = put_then_overwrite
+
+    response = eventbridge.compact_rules()
+    assert response['deleted_rules'] == 1
+    assert get_inputs(client) == {'AUTO_2031-1-1--10-15': [{'id': [15, 77, 20]}]}
+    assert lambda_function._metrics.counters['write_conflicts'] == 1
+
+
+def test_compaction_keeps_a_rule_that_got_a_new_target(scheduler, context):
+    client, eventbridge = schedule_out_of_order(scheduler, context, 'concurrent+t_minus', [20, 15])
+    remove_rule_targets = eventbridge.remove_rule_targets
+
+    def add_then_remove(rule_name, target_ids):
+        client.put_targets(Rule=rule_name, Targets=[{'Id': 'late', 'Arn': LAMBDA_ARN, 'Input': '{}'}])
+        return remove_rule_targets(rule_name, target_ids)
+    eventbridge.remove_rule_targets = add_then_remove
+
+    response = eventbridge.compact_rules()
+    assert response['deleted_rules'] == 0
+    assert get_inputs(client) == {'AUTO_2031-1-1--10-15': [{'id': [15]}, {'id': [20]}],
+                                  'AUTO_2031-1-1--10-20': [{}]}
@@ -0,0 +1,88 @@
+import json
+import job_stores
+import lambda_function
+import pytest
+from conftest import LAMBDA_ARN, OTHER_LAMBDA_ARN, make_event
+from job_stores import DynamoDBJobStore, JobStoreException
+
+
+def fire(client, context, rule_name):
+    """invokes the lambda handler with the input of the dispatch target of the rule, like EventBridge does."""
+    target = next(iter(client.targets[rule_name].values()))
+    return lambda_function.lambda_handler(json.loads(target['Input']), context)
+
+
+def test_dispatch(scheduler, context):
+    client = scheduler('dispatcher')
+    response = lambda_function.lambda_handler(
+        [make_event(5, {'id': [1]}), make_event(5, {'id': [2]}, OTHER_LAMBDA_ARN)], context)
+    assert response['success']
+    assert list(client.targets) == ['AUTO_2031-1-1--10-5']
+    assert len(client.targets['AUTO_2031-1-1--10-5']) == 1
+
+    assert fire(client, context, 'AUTO_2031-1-1--10-5') == {'success': True, 'dispatched': 2, 'failed': 0}
+    invoker = lambda_function._eventbridge.get_lambda_invoker()
+    assert sorted(invoker.client.invocations) == [(LAMBDA_ARN, {'id': [1]}), (OTHER_LAMBDA_ARN, {'id': [2]})]
+    assert lambda_function._eventbridge.get_job_store().get_jobs('AUTO_2031-1-1--10-5') == []
+
+
+def test_repeated_job_keys_are_stored_once(scheduler, context):
+    scheduler('dispatcher')
+    job_store = lambda_function._eventbridge.get_job_store()
+    put_jobs = job_store.put_jobs
+    written_job_ids = []
+
+    def record_put_jobs(bucket, jobs):
+        written_job_ids.extend(job['job_id'] for job in jobs)
+        put_jobs(bucket, jobs)
+    job_store.put_jobs = record_put_jobs
+
+    response = lambda_function.lambda_handler(
+        [make_event(5, {'id': [1]}), make_event(5, {'id': [1]}), make_event(5, {'id': [2]})], context)
+    assert [result.get('duplicate', False) for result in response['results']] == [False, True, False]
+    assert len(written_job_ids) == len(set(written_job_ids)) == 2
+
+    again = lambda_function.lambda_handler([make_event(5, {'id': [2]}), make_event(5, {'id': [3]})], context)
+    assert [result.get('duplicate', False) for result in again['results']] == [True, False]
+    assert len(written_job_ids) == 3
+
+
+def test_failed_dispatch_rule_keeps_the_stored_jobs(scheduler, context):
+    client = scheduler('dispatcher')
+    assert lambda_function.lambda_handler(make_event(5, {'id': [1]}), context)['success']
+    client.put_targets = lambda **kwargs: {'FailedEntryCount': 1, 'FailedEntries': [{'TargetId': 'x'}]}
+    lambda_function._eventbridge.rule_index.set_targets('AUTO_2031-1-1--10-5', [])  # a stale cache
+    response = lambda_function.lambda_handler([make_event(5, {'id': [1]}), make_event(5, {'id': [2]})], context)
+    assert not response['success']
+    stored_jobs = lambda_function._eventbridge.get_job_store().get_jobs('AUTO_2031-1-1--10-5')
+    assert [job['data'] for job in stored_jobs] == [{'id': [1]}]
+
+
+def test_dispatcher_needs_a_job_store(scheduler, context, monkeypatch):
+    scheduler('dispatcher')
+    monkeypatch.setattr(lambda_function, 'JOB_STORE_CLASS_NAME', False)
+    lambda_function._eventbridge = lambda_function.EventBridge(lambda_function._eventbridge.client)
+    response = lambda_function.lambda_handler(make_event(5, {'id': [1]}), context)
+    assert not response['success']
+    assert 'JOB_STORE_CLASS_NAME' in response['exception']
+
+
+class UnprocessedDynamoDBClient:
+    """leaves every item of batch_write_item unprocessed."""
+
+    def __init__(self) -> None:
+        self.calls = 0
+
+    def batch_write_item(self, RequestItems):
+        self.calls += 1
+        return {'UnprocessedItems': RequestItems}
+
+
+def test_dynamodb_writes_give_up(monkeypatch):
+    monkeypatch.setattr(job_stores, 'JOB_STORE_WRITE_MAX_RETRIES', 2)
+    monkeypatch.setattr(job_stores.time, 'sleep', lambda seconds: None)
+    client = UnprocessedDynamoDBClient()
+    job_store = DynamoDBJobStore('jobs', client=client)
+    with pytest.raises(JobStoreException):
+        job_store.put_jobs('AUTO_2031-1-1--10-5', [{'job_id': 'a', 'lambda_function_arn': LAMBDA_ARN, 'data': {}}])
+    assert client.calls == 3
@@ -0,0 +1,47 @@
+import itertools
+
+from bulk_executor import BulkExecutor
+from conftest import LAMBDA_ARN
+from eventbridge_emulator import FakeEventBridgeClient
+from lambda_function import EventBridge
+
+
+def make_eventbridge(rules=5, targets=5):
+    client = FakeEventBridgeClient(page_size=2)
+    for minute in range(rules):
+        client.put_rule(Name=f'AUTO_2031-1-1--10-{minute}', ScheduleExpression=f'cron({minute} 10 1 1 ? 2031)')
+    client.put_targets(Rule='AUTO_2031-1-1--10-0', Targets=[{'Id': f't-{i}', 'Arn': LAMBDA_ARN, 'Input': '{}'}
+                                                             for i in range(targets)])
+    client.calls.clear()
+    return client, EventBridge(client, executor=BulkExecutor(max_rate=1e6))
+
+
+def test_describe_rule():
+    client, eventbridge = make_eventbridge()
+    assert eventbridge.describe_rule('AUTO_2031-1-1--10-1')['ScheduleExpression'] == 'cron(1 10 1 1 ? 2031)'
+    assert eventbridge.describe_rule('AUTO_2031-1-1--10-9') is None
+    assert client.calls['DescribeRule'] == 2
+
+
+def test_iter_rules_follows_the_pagination():
+    client, eventbridge = make_eventbridge()
+    assert len(list(eventbridge.iter_rules())) == 5
+    assert client.calls['ListRules'] == 3
+
+
+def test_iter_rules_requests_only_the_pages_it_gets_to():
+    client, eventbridge = make_eventbridge()
+    assert len(list(itertools.islice(eventbridge.iter_rules(), 3))) == 3
+    assert client.calls['ListRules'] == 2
+
+
+def test_rule_targets_follow_the_pagination():
+    client, eventbridge = make_eventbridge()
+    assert [target['Id'] for target in eventbridge.iter_rules_targets('AUTO_2031-1-1--10-0')] == \
+        [f't-{i}' for i in range(5)]
+    assert client.calls['ListTargetsByRule'] == 3
+    client.calls.clear()
+    response = eventbridge.get_rules_targets('AUTO_2031-1-1--10-0', refresh=True)
+    assert response['success']
+    assert len(response['targets']) == 5
+    assert client.calls['ListTargetsByRule'] == 3
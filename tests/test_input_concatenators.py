@@ -0,0 +1,56 @@
+import json
+
+import pytest
+from input_concatenators import (EventBridgeCompactArrayInput, EventBridgeInputConcatenator,
+                                 EventBridgeInputSizeExceeded, EventBridgeSingleArrayInput)
+
+
+def test_compact_array_input_de_duplicates_the_values():
+    concatenator = EventBridgeCompactArrayInput()
+    data = concatenator.concatenate_inputs({'id': [1, 2]}, {'id': [2, 3, 3], 'name': 'x'})
+    data = concatenator.concatenate_inputs(data, {'id': 1, 'name': 'x'})
+    assert data == {'id': [1, 2, 3], 'name': 'x'}
+
+
+def test_compact_array_input_tracks_the_json_size():
+    concatenator = EventBridgeCompactArrayInput()
+    data = {'id': 'a'}
+    for new_data in ({'id': ['b', {'c': 1}]}, {'other': [1]}, {'id': 'd', 'more': None}):
+        data = concatenator.concatenate_inputs(data, new_data)
+        assert data.size == len(json.dumps(data))
+
+
+def test_compact_array_input_raises_over_the_size_limit(monkeypatch):
+    monkeypatch.setattr(EventBridgeCompactArrayInput, 'MAX_INPUT_SIZE', 30)
+    concatenator = EventBridgeCompactArrayInput()
+    data = concatenator.concatenate_inputs({'id': [1]}, {'id': [2]})
+    with pytest.raises(EventBridgeInputSizeExceeded):
+        concatenator.concatenate_inputs(data, {'id': ['a' * 20]})
+    # the existing data is left as it was
+    assert data == {'id': [1, 2]}
+    assert data.size == len(json.dumps(data))
+
+
+class UpToThreeIds(EventBridgeInputConcatenator):
+    def concatenate_inputs(self, existing_data, new_data):
+        ids = existing_data['id'] + new_data['id']
+        if len(ids) > 3:
+            raise EventBridgeInputSizeExceeded('Too many ids.')
+        return {'id': ids}
+
+
+def test_concatenate_many_falls_back_to_concatenate_inputs():
+    assert UpToThreeIds().concatenate_many({'id': [1]}, [{'id': [2]}, {'id': [3]}]) == {'id': [1, 2, 3]}
+
+
+def test_concatenate_many_returns_what_didnt_fit():
+    new_items = [{'id': [2]}, {'id': [3]}, {'id': [4]}, {'id': [5]}]
+    with pytest.raises(EventBridgeInputSizeExceeded) as exc_info:
+        UpToThreeIds().concatenate_many({'id': [1]}, new_items)
+    assert exc_info.value.merged_data == {'id': [1, 2, 3]}
+    assert exc_info.value.remaining_items == [{'id': [4]}, {'id': [5]}]
+
+
+def test_single_array_input_concatenates_many():
+    data = EventBridgeSingleArrayInput().concatenate_many({'id': ['a'], 'x': 1}, [{'id': 'b'}, {'id': ['c', 'd'], 'y': 2}])
+    assert data == {'id': ['a', 'b', 'c', 'd'], 'x': 1, 'y': 2}
@@ -0,0 +1,152 @@
+import lambda_function
+import pytest
+from conftest import LAMBDA_ARN, OTHER_LAMBDA_ARN, make_event
+
+WINDOW = {'from_datetime_utc': '2031-01-01 10:00:00', 'to_datetime_utc': '2031-01-01 11:00:00'}
+
+
+def schedule(context, events):
+    response = lambda_function.lambda_handler(events, context)
+    assert response['success']
+    return [result['job_id'] for result in response['results']]
+
+
+def query_all(context, limit, **kwargs):
+    """returns the pages of the query, following its next_token."""
+    pages = []
+    next_token = None
+    while True:
+        response = lambda_function.lambda_handler({'action': 'query', **WINDOW, **kwargs, 'limit': limit,
+                                                   'next_token': next_token}, context)
+        assert response['success']
+        pages.append(response['jobs'])
+        next_token = response['next_token']
+        if not next_token:
+            return pages
+
+
+def get_ids(jobs):
+    return sorted(value for job in jobs for value in job['data']['id'])
+
+
+@pytest.mark.parametrize('strategy', ['concurrent', 'concatenator', 'dispatcher'])
+def test_cancel(scheduler, context, strategy):
+    scheduler(strategy)
+    job_ids = schedule(context, [make_event(5, {'id': [1]}), make_event(5, {'id': [2]})])
+    response = lambda_function.lambda_handler({'action': 'cancel', 'job_id': job_ids[0]}, context)
+    assert response['success']
+    assert get_ids(query_all(context, 100)[0]) == [2]
+    again = lambda_function.lambda_handler({'action': 'cancel', 'job_id': job_ids[0]}, context)
+    assert not again['success']
+
+
+@pytest.mark.parametrize('rule_is_full', [False, True])
+def test_cancel_of_the_job_a_merged_target_is_named_after(scheduler, context, rule_is_full):
+    client = scheduler('concatenator')
+    other_jobs = [make_event(5, {'id': [10 + i]}, f'{LAMBDA_ARN}-{i}') for i in range(4 if rule_is_full else 0)]
+    job_ids = schedule(context, [make_event(5, {'id': [1]}), make_event(5, {'id': [2]})] + other_jobs)
+    assert len(client.targets['AUTO_2031-1-1--10-5']) == 1 + len(other_jobs)
+    response = lambda_function.lambda_handler({'action': 'cancel', 'job_id': job_ids[0]}, context)
+    assert response['success']
+    assert len(client.targets['AUTO_2031-1-1--10-5']) == 1 + len(other_jobs)
+    # the target of the remaining job isn't attributed to the cancelled job, in this container or another one
+    jobs = [job for job in query_all(context, 100)[0] if job['lambda_function_arn'] == LAMBDA_ARN]
+    assert [(job['job_ids'], job['data']) for job in jobs] == [([job_ids[1]], {'id': [2]})]
+    lambda_function._eventbridge = lambda_function.EventBridge(client)
+    jobs = [job for job in query_all(context, 100)[0] if job['lambda_function_arn'] == LAMBDA_ARN]
+    assert job_ids[0] not in jobs[0]['job_ids']
+
+    again = lambda_function.lambda_handler(make_event(5, {'id': [1]}), context)
+    assert again['success']
+    assert not again.get('duplicate', False)
+    cancel = {'action': 'cancel', 'job_id': job_ids[0], 'data': {'id': [1]}}
+    assert lambda_function.lambda_handler(cancel, context)['success']
+    assert not lambda_function.lambda_handler(cancel, context)['success']
+    assert get_ids(job for job in query_all(context, 100)[0] if job['lambda_function_arn'] == LAMBDA_ARN) == [2]
+    # the remaining job can still be cancelled by its own id
+    assert lambda_function.lambda_handler({'action': 'cancel', 'job_id': job_ids[1], 'data': {'id': [2]}},
+                                          context)['success']
+    assert LAMBDA_ARN not in [target['Arn'] for target in client.targets['AUTO_2031-1-1--10-5'].values()]
+
+
+@pytest.mark.parametrize('strategy', ['concurrent', 'concatenator', 'dispatcher'])
+def test_cancel_from_another_container(scheduler, context, strategy):
+    client = scheduler(strategy)
+    job_ids = schedule(context, [make_event(5, {'id': [1]}), make_event(5, {'id': [2]})])
+    lambda_function._eventbridge = lambda_function.EventBridge(
+        client, job_store=lambda_function._eventbridge.get_job_store() if strategy == 'dispatcher' else None)
+    response = lambda_function.lambda_handler({'action': 'cancel', 'job_id': job_ids[1], 'data': {'id': [2]}}, context)
+    assert response['success']
+    assert get_ids(query_all(context, 100)[0]) == [1]
+
+
+@pytest.mark.parametrize('strategy', ['concurrent', 'concatenator', 'dispatcher'])
+def test_reschedule(scheduler, context, strategy):
+    scheduler(strategy)
+    job_ids = schedule(context, [make_event(5, {'id': [1]}), make_event(5, {'id': [2]})])
+    response = lambda_function.lambda_handler({'action': 'reschedule', 'job_id': job_ids[0],
+                                               'datetime_utc': '2031-01-01 10:30:00'}, context)
+    assert response['success']
+    assert response['previous_job_id'] == job_ids[0]
+    assert response['job_id'].startswith('AUTO_2031-1-1--10-30/')
+    jobs = query_all(context, 100)[0]
+    assert [(job['datetime_utc'], job['data']) for job in jobs] == [
+        ('2031-01-01 10:05:00', {'id': [2]}), ('2031-01-01 10:30:00', {'id': [1]})]
+
+
+def test_job_actions_need_a_job_id(scheduler, context):
+    scheduler('concurrent')
+    assert not lambda_function.lambda_handler({'action': 'cancel'}, context)['success']
+    response = lambda_function.lambda_handler({'action': 'reschedule', 'job_id': 'AUTO_2031-1-1--10-5/x',
+                                               'datetime_utc': 'tomorrow'}, context)
+    assert not response['success']
+
+
+def test_cancel_of_a_job_whose_target_is_replaced_by_another_container(scheduler, context):
+    client = scheduler('concatenator')
+    job_ids = schedule(context, [make_event(5, {'id': [1]}), make_event(5, {'id': [2]})])
+    writer = lambda_function._eventbridge
+    lambda_function._eventbridge = lambda_function.EventBridge(client)
+    assert lambda_function.lambda_handler({'action': 'cancel', 'job_id': job_ids[0], 'data': {'id': [1]}},
+                                          context)['success']
+    # the container that wrote the jobs still has the old target id of the remaining job in its index
+    lambda_function._eventbridge = writer
+    assert lambda_function.lambda_handler({'action': 'cancel', 'job_id': job_ids[1]}, context)['success']
+    assert not client.targets.get('AUTO_2031-1-1--10-5')
+
+
+@pytest.mark.parametrize('strategy', ['concurrent', 'concatenator+t_minus', 'dispatcher'])
+def test_query_pagination(scheduler, context, strategy):
+    scheduler(strategy)
+    schedule(context, [make_event(minute, {'id': [minute]}, LAMBDA_ARN if minute % 3 else OTHER_LAMBDA_ARN)
+                       for minute in range(0, 60, 2)])
+    full = query_all(context, 1000)
+    assert len(full) == 1
+    assert get_ids(full[0]) == list(range(0, 60, 2))
+
+    pages = query_all(context, 4)
+    assert len(pages) > 1
+    jobs = [job for page in pages for job in page]
+    assert get_ids(jobs) == get_ids(full[0])
+    assert [job['datetime_utc'] for job in jobs] == sorted(job['datetime_utc'] for job in jobs)
+    # a page ends at a rule, the jobs of a rule are never split
+    rule_names = [job['rule_name'] for job in jobs]
+    assert len(rule_names) == len(set(rule_names)) or strategy != 'concurrent'
+    for page, next_page in zip(pages, pages[1:]):
+        assert page[-1]['rule_name'] != next_page[0]['rule_name']
+
+
+def test_query_by_lambda(scheduler, context):
+    scheduler('concurrent')
+    schedule(context, [make_event(minute, {'id': [minute]}, LAMBDA_ARN if minute % 3 else OTHER_LAMBDA_ARN)
+                       for minute in range(0, 30, 2)])
+    jobs = query_all(context, 1000, lambda_function=OTHER_LAMBDA_ARN)[0]
+    assert get_ids(jobs) == [0, 6, 12, 18, 24]
+    assert all(job['lambda_function_arn'] == OTHER_LAMBDA_ARN for job in jobs)
+
+
+def test_query_validates_the_window(scheduler, context):
+    scheduler('concurrent')
+    assert not lambda_function.lambda_handler({'action': 'query'}, context)['success']
+    assert not lambda_function.lambda_handler({'action': 'query', 'to_datetime_utc': 'x'}, context)['success']
+    assert not lambda_function.lambda_handler({'action': 'query', **WINDOW, 'next_token': 'junk'}, context)['success']
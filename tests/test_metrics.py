@@ -0,0 +1,53 @@
+import json
+
+import lambda_function
+from conftest import make_event
+from metrics import Metrics, to_metric_name
+
+
+def test_to_metric_name():
+    assert to_metric_name('list_targets_by_rule') == 'ListTargetsByRule'
+    assert to_metric_name('PutTargets') == 'PutTargets'
+
+
+def test_to_emf_declares_every_metric():
+    metrics = Metrics()
+    metrics.record_call('PutTargets', 0.02)
+    metrics.record_call('PutTargets', 0.3, throttled=True)
+    metrics.record_phase('cleanup', 0.5)
+    metrics.record_cache('rule_index', hit=True)
+    metrics.record_cache('rule_index', hit=False)
+    metrics.increment('write_conflicts')
+    record = metrics.to_emf('Namespace', dimensions={'FunctionName': 'scheduler'}, properties={'RequestId': 'r'})
+
+    directive, = record['_aws']['CloudWatchMetrics']
+    assert directive['Namespace'] == 'Namespace'
+    assert directive['Dimensions'] == [['FunctionName']]
+    assert all(definition['Name'] in record for definition in directive['Metrics'])
+    assert record['FunctionName'] == 'scheduler'
+    assert record['RequestId'] == 'r'
+    assert record['ApiCalls'] == 2
+    assert record['PutTargetsThrottles'] == 1
+    assert record['CleanupTime'] == 500
+    assert record['RuleIndexCacheHitRate'] == 50
+    assert record['WriteConflicts'] == 1
+    assert record['ApiLatencyHistograms']['PutTargets']['buckets'] == {'<=25ms': 1, '<=500ms': 1}
+
+
+def test_emit_prints_one_json_line(capsys):
+    metrics = Metrics()
+    metrics.increment('jobs_scheduled', 3)
+    metrics.emit('Namespace')
+    output = capsys.readouterr().out
+    assert output.count('\n') == 1
+    assert json.loads(output)['JobsScheduled'] == 3
+
+
+def test_handler_emits_the_metrics_of_the_invocation(scheduler, context, capsys):
+    scheduler('concurrent')
+    lambda_function.EMIT_METRICS = True
+    assert lambda_function.lambda_handler(make_event(5, {'id': [1]}), context)['success']
+    records = [json.loads(line) for line in capsys.readouterr().out.splitlines() if '"_aws"' in line]
+    assert len(records) == 1
+    assert records[0]['PutTargetsCalls'] == 1
+    assert records[0]['_aws']['CloudWatchMetrics'][0]['Namespace'] == lambda_function.METRICS_NAMESPACE
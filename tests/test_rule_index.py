@@ -0,0 +1,144 @@
+import datetime
+import lambda_function
+import pytest
+import rule_index
+from bulk_executor import BulkExecutor
+from conftest import make_event
+from rule_index import RuleIndex, read_snapshot
+
+
+def at(minute):
+    return datetime.datetime(2031, 1, 1, 10, minute, tzinfo=datetime.timezone.utc)
+
+
+def names(entries):
+    return [entry['rule']['Name'] for entry in entries]
+
+
+def test_rules_are_ordered_by_date():
+    index = RuleIndex()
+    for name, minute in [('c', 30), ('a', 10), ('b', 20), ('b2', 20), ('d', 40)]:
+        index.add_rule({'Name': name}, at(minute))
+    assert index.rule_names() == ['a', 'b', 'b2', 'c', 'd']
+    assert names(index.between(at(20), at(30))) == ['b', 'b2', 'c']  # both ends are inclusive
+    assert names(index.between(at(21), at(29))) == []
+    assert names(index.before(at(30))) == ['a', 'b', 'b2']  # exclusive
+    # naive datetimes are presumed to be in UTC
+    assert names(index.between(datetime.datetime(2031, 1, 1, 10, 10), datetime.datetime(2031, 1, 1, 10, 10))) == ['a']
+
+
+def test_a_rescheduled_rule_moves_with_its_job_keys():
+    index = RuleIndex()
+    index.add_rule({'Name': 'a'}, at(10))
+    index.add_rule({'Name': 'b'}, at(20))
+    index.add_job_keys('a', {'key': 'a-target-key'})
+    index.add_rule({'Name': 'a', 'ScheduleExpression': 'moved'}, at(30))
+    assert index.rule_names() == ['b', 'a']
+    assert index.get('a')['rule']['ScheduleExpression'] == 'moved'
+    assert index.find_job('key') == ('a', 'a-target-key')
+
+    index.remove_rule('a')
+    assert index.rule_names() == ['b']
+    assert index.find_job('key') is None
+    assert 'a' not in index
+
+
+def test_targets_are_cached_until_they_are_unknown():
+    index = RuleIndex()
+    index.add_rule({'Name': 'a'}, at(10), targets=[])
+    index.upsert_targets('a', [{'Id': 't1'}, {'Id': 't2'}])
+    assert index.get('a')['target_count'] == 2
+    index.set_targets('a', None)
+    assert index.get_targets('a') is None
+    index.upsert_targets('a', [{'Id': 't3'}])  # unknown targets stay unknown
+    assert index.get('a')['target_count'] is None
+
+
+def test_load_keeps_the_job_keys_of_the_remaining_rules():
+    index = RuleIndex()
+    index.add_rule({'Name': 'a'}, at(10))
+    index.add_rule({'Name': 'b'}, at(20))
+    index.add_job_keys('a', {'key-a': 't'})
+    index.add_job_keys('b', {'key-b': 't'})
+    index.load([({'Name': 'b'}, at(20)), ({'Name': 'c'}, at(5))])
+    assert index.rule_names() == ['c', 'b']
+    assert index.find_job('key-a') is None
+    assert index.find_job('key-b') == ('b', 't')
+
+
+@pytest.mark.parametrize('strategy,targets_known', [('concurrent', True), ('concatenator', True),
+                                                     ('concurrent', False), ('dispatcher', False)])
+def test_a_rule_deleted_by_another_container_is_created_again(scheduler, context, strategy, targets_known):
+    client = scheduler(strategy)
+    first = lambda_function.lambda_handler(make_event(5, {'id': [1]}), context)
+    assert first['success']
+    # another container deletes the rule, e.g. cancelling its only job
+    assert lambda_function.EventBridge(client).delete_rule('AUTO_2031-1-1--10-5')
+    assert not client.rules
+    if not targets_known:
+        lambda_function._eventbridge.rule_index.set_targets('AUTO_2031-1-1--10-5', None)
+
+    response = lambda_function.lambda_handler(make_event(5, {'id': [2]}), context)
+    assert response['success'], response
+    assert 'AUTO_2031-1-1--10-5' in client.rules
+    assert client.targets['AUTO_2031-1-1--10-5']
+
+
+def test_snapshot_roundtrip(tmp_path):
+    index = RuleIndex()
+    index.load([({'Name': 'b', 'ScheduleExpression': 'cron-b'}, at(20)), ({'Name': 'a'}, at(10))])
+    index.add_job_keys('b', {'key': 'b-target-key'})
+    path = str(tmp_path / 'index.snapshot')
+    assert index.save_snapshot(path, 'AUTO_') == index.revision
+
+    snapshot = read_snapshot(path)
+    assert snapshot['rule_prefix'] == 'AUTO_'
+    restored = RuleIndex()
+    restored.load_snapshot(snapshot)
+    assert restored.loaded
+    assert restored.rule_names() == ['a', 'b']
+    assert restored.get('b')['rule']['ScheduleExpression'] == 'cron-b'
+    assert restored.get('b')['date'] == at(20)
+    assert restored.find_job('key') == ('b', 'b-target-key')
+    assert restored.get_targets('b') is None  # the targets aren't saved
+
+
+def test_snapshot_of_another_schema_version_or_corrupt_is_ignored(tmp_path, monkeypatch):
+    index = RuleIndex()
+    index.load([({'Name': 'a'}, at(10))])
+    path = str(tmp_path / 'index.snapshot')
+    assert read_snapshot(path) is None  # missing
+
+    monkeypatch.setattr(rule_index, 'SNAPSHOT_SCHEMA_VERSION', rule_index.SNAPSHOT_SCHEMA_VERSION - 1)
+    index.save_snapshot(path, 'AUTO_')
+    monkeypatch.undo()
+    assert read_snapshot(path) is None
+
+    index.save_snapshot(path, 'AUTO_')
+    with open(path, 'rb') as f:
+        data = bytearray(f.read())
+    data[-1] ^= 0xff
+    with open(path, 'wb') as f:
+        f.write(data)
+    assert read_snapshot(path) is None
+
+
+def test_snapshot_is_saved_on_change_and_restored_by_a_new_container(scheduler, context, tmp_path):
+    client = scheduler('concurrent')
+    path = str(tmp_path / 'index.snapshot')
+    lambda_function._eventbridge.snapshot_path = path
+    response = lambda_function.lambda_handler([make_event(5, {'id': [1]}), make_event(6, {'id': [2]})], context)
+    assert response['success']
+    assert read_snapshot(path) is not None
+    assert not lambda_function._eventbridge.save_rule_index_snapshot()  # unchanged since the handler saved it
+    # another container adds a rule after the snapshot
+    client.put_rule(Name='AUTO_2031-1-1--10-7', ScheduleExpression='cron(7 10 1 1 ? 2031)')
+
+    client.calls.clear()
+    eventbridge = lambda_function.EventBridge(client, executor=BulkExecutor(max_rate=1e6), snapshot_path=path)
+    index = eventbridge.get_rule_index()
+    assert index.rule_names() == ['AUTO_2031-1-1--10-5', 'AUTO_2031-1-1--10-6', 'AUTO_2031-1-1--10-7']
+    job_key = response['results'][0]['job_id'].split('/')[1]
+    assert index.find_job(job_key)[0] == 'AUTO_2031-1-1--10-5'
+    assert client.calls['ListRules'] == 1
+    assert not eventbridge.save_rule_index_snapshot()  # restored, nothing to save
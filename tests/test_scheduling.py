@@ -0,0 +1,160 @@
+import json
+import lambda_function
+import pytest
+from bulk_executor import BulkExecutor
+from conftest import LAMBDA_ARN, OTHER_LAMBDA_ARN, make_event
+from input_concatenators import EventBridgeInputConcatenator, EventBridgeSingleArrayInput
+
+
+def get_inputs(client):
+    """returns {rule name: [data of every target]}"""
+    return {rule_name: [json.loads(target.get('Input', '{}')) for target in targets.values()]
+            for rule_name, targets in client.targets.items()}
+
+
+@pytest.mark.parametrize('strategy', ['concurrent', 'concatenator', 'concatenator+t_minus', 'dispatcher'])
+def test_batch_is_scheduled(scheduler, context, strategy):
+    client = scheduler(strategy)
+    events = [make_event(minute, {'id': [minute]}, LAMBDA_ARN if minute % 2 else OTHER_LAMBDA_ARN)
+              for minute in range(12)]
+    response = lambda_function.lambda_handler(events, context)
+    assert response['success']
+    assert len(response['results']) == len(events)
+    assert all(result['job_id'] for result in response['results'])
+    assert len({result['job_id'] for result in response['results']}) == len(events)
+    assert client.rules
+
+
+def test_batch_reports_invalid_events(scheduler, context):
+    scheduler('concurrent')
+    response = lambda_function.lambda_handler([make_event(5, {'id': [1]}), {'lambda_function': LAMBDA_ARN}], context)
+    assert not response['success']
+    assert response['results'][0]['success']
+    assert not response['results'][1]['success']
+
+
+def test_concatenator_merges_the_jobs_of_a_lambda(scheduler, context):
+    client = scheduler('concatenator')
+    response = lambda_function.lambda_handler([make_event(5, {'id': [i]}) for i in range(3)], context)
+    assert response['success']
+    assert get_inputs(client) == {'AUTO_2031-1-1--10-5': [{'id': [0, 1, 2]}]}
+
+
+def test_spill_over_skips_the_full_shard_rules(scheduler, context):
+    client = scheduler('concurrent')
+    # another container has filled the rule of the minute and its first shard rule
+    for rule_name in ('AUTO_2031-1-1--10-5', 'AUTO_2031-1-1--10-5-s1'):
+        client.put_rule(Name=rule_name, ScheduleExpression='cron(5 10 1 1 ? 2031)')
+        client.put_targets(Rule=rule_name, Targets=[{'Id': f'other-{i}', 'Arn': LAMBDA_ARN, 'Input': '{}'}
+                                                    for i in range(5)])
+    response = lambda_function.lambda_handler([make_event(5, {'id': [i]}) for i in range(7)], context)
+    assert response['success']
+    assert {result['rule_name'] for result in response['results']} == {'AUTO_2031-1-1--10-5-s2',
+                                                                       'AUTO_2031-1-1--10-5-s3'}
+    assert len(client.targets['AUTO_2031-1-1--10-5-s2']) == 5
+    assert len(client.targets['AUTO_2031-1-1--10-5-s3']) == 2
+    assert all(len(client.targets[rule_name]) == 5 for rule_name in ('AUTO_2031-1-1--10-5', 'AUTO_2031-1-1--10-5-s1'))
+
+
+def test_spill_over_of_many_minutes_does_not_deadlock(scheduler, context):
+    client = scheduler('concurrent')
+    lambda_function._eventbridge.executor = BulkExecutor(max_workers=2, max_rate=1e6)
+    for minute in range(10):
+        for suffix in ('', '-s1'):
+            client.put_rule(Name=f'AUTO_2031-1-1--10-{minute}{suffix}', ScheduleExpression=f'cron({minute} 10 1 1 ? 2031)')
+            client.put_targets(Rule=f'AUTO_2031-1-1--10-{minute}{suffix}',
+                               Targets=[{'Id': f'other-{i}', 'Arn': LAMBDA_ARN, 'Input': '{}'} for i in range(5)])
+    response = lambda_function.lambda_handler([make_event(minute, {'id': [minute]}) for minute in range(10)], context)
+    assert response['success']
+    assert all(result['rule_name'].endswith('-s2') for result in response['results'])
+
+
+@pytest.mark.parametrize('strategy', ['concurrent', 'concatenator+t_minus'])
+def test_an_oversized_job_fails_alone(scheduler, context, strategy):
+    client = scheduler(strategy)
+    events = [make_event(5, {'id': [1]}), make_event(5, {'id': ['x' * lambda_function.MAX_TARGET_INPUT_SIZE]}),
+              make_event(5, {'id': [2]})]
+    response = lambda_function.lambda_handler(events, context)
+    assert [result['success'] for result in response['results']] == [True, False, True]
+    assert 'max. allowed' in str(response['results'][1]['exception'])
+    assert all(len(target['Input']) <= lambda_function.MAX_TARGET_INPUT_SIZE
+               for targets in client.targets.values() for target in targets.values())
+
+
+@pytest.mark.parametrize('strategy', ['concurrent', 'concatenator+t_minus', 'dispatcher'])
+def test_scheduling_again_is_a_no_op(scheduler, context, strategy):
+    client = scheduler(strategy)
+    first = lambda_function.lambda_handler([make_event(5, {'id': [1]}), make_event(6, {'id': [2]})], context)
+    puts = client.calls['PutTargets']
+    again = lambda_function.lambda_handler([make_event(5, {'id': [1]}), make_event(6, {'id': [2]})], context)
+    assert again['success']
+    assert all(result['duplicate'] for result in again['results'])
+    assert [result['job_id'] for result in again['results']] == [result['job_id'] for result in first['results']]
+    assert client.calls['PutTargets'] == puts
+
+
+@pytest.mark.parametrize('strategy', ['concurrent', 'concatenator', 'dispatcher'])
+def test_repeats_within_a_batch_are_scheduled_once(scheduler, context, strategy):
+    scheduler(strategy)
+    response = lambda_function.lambda_handler(
+        [make_event(5, {'id': [1]}), make_event(5, {'id': [2]}), make_event(5, {'id': [1]})], context)
+    assert response['success']
+    assert [result.get('duplicate', False) for result in response['results']] == [False, False, True]
+    assert response['results'][2]['job_id'] == response['results'][0]['job_id']
+
+
+def test_idempotency_key_overrides_the_data(scheduler, context):
+    scheduler('concurrent')
+    first = lambda_function.lambda_handler(make_event(5, {'id': [1]}, idempotency_key='order-1'), context)
+    again = lambda_function.lambda_handler(make_event(5, {'id': [2]}, idempotency_key='order-1'), context)
+    assert again['duplicate']
+    assert again['job_id'] == first['job_id']
+
+
+def test_write_conflict_check_writes_an_overwritten_job_again(scheduler, context):
+    client = scheduler('concatenator')
+    lambda_function.WRITE_CONFLICT_CHECK_ENABLED = True
+    eventbridge = lambda_function._eventbridge
+    eventbridge.executor = BulkExecutor(max_rate=1e6, max_retries=1, base_delay=0.001)
+    assert lambda_function.lambda_handler(make_event(5, {'id': [1]}), context)['success']
+    put_rule_targets = eventbridge.put_rule_targets
+    raced = []
+
+    def put_then_overwrite(rule_name, targets):
+        # another container writes the target it read before this write, merging job 3 into it
+        stale_targets = [dict(target) for target in client.targets[rule_name].values()]
+        response = put_rule_targets(rule_name, targets)
+        if not raced:
+            raced.append(True)
+            stale_targets[0]['Input'] = json.dumps({'id': [1, 3]})
+            client.put_targets(Rule=rule_name, Targets=stale_targets)
+        return response
+    eventbridge.put_rule_targets = put_then_overwrite
+
+    assert lambda_function.lambda_handler(make_event(5, {'id': [2]}), context)['success']
+    assert get_inputs(client) == {'AUTO_2031-1-1--10-5': [{'id': [1, 3, 2]}]}
+    assert lambda_function._metrics.counters['write_conflicts'] == 1
+
+
+def test_write_conflict_check_needs_contains_inputs(scheduler, context, monkeypatch):
+    client = scheduler('concatenator')
+    lambda_function.WRITE_CONFLICT_CHECK_ENABLED = True
+    monkeypatch.setattr(EventBridgeSingleArrayInput, 'contains_inputs', EventBridgeInputConcatenator.contains_inputs)
+    sleeps = []
+    monkeypatch.setattr(lambda_function.time, 'sleep', sleeps.append)
+    assert lambda_function.lambda_handler(make_event(5, {'id': [1]}), context)['success']
+    lists = client.calls['ListTargetsByRule']
+    assert lambda_function.lambda_handler(make_event(5, {'id': [2]}), context)['success']
+    assert sleeps == []
+    assert client.calls['ListTargetsByRule'] == lists + 1  # the inputs are listed fresh, and not read back
+
+
+def test_write_conflict_check_reads_back_after_a_short_delay(scheduler, context, monkeypatch):
+    scheduler('concatenator')
+    lambda_function.WRITE_CONFLICT_CHECK_ENABLED = True
+    sleeps = []
+    monkeypatch.setattr(lambda_function.time, 'sleep', sleeps.append)
+    assert lambda_function.lambda_handler(make_event(5, {'id': [1]}), context)['success']
+    assert lambda_function.lambda_handler(make_event(5, {'id': [2]}), context)['success']
+    assert len(sleeps) == 1
+    assert lambda_function.WRITE_CONFLICT_BACKOFF_SECONDS / 2 <= sleeps[0] <= lambda_function.WRITE_CONFLICT_BACKOFF_SECONDS
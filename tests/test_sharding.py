@@ -0,0 +1,111 @@
+import benchmarks
+import datetime
+import json
+import lambda_function
+import pytest
+from conftest import LAMBDA_ARN, make_event
+from eventbridge_emulator import FakeEventBridgeClient, FakeLambdaClient
+from job_stores import SQLiteJobStore
+from lambda_invoker import LambdaInvoker
+from sharding import ShardedScheduler
+
+EU_LAMBDA_ARN = 'arn:aws:lambda:eu-west-1:123456789012:function:e'
+
+
+@pytest.fixture
+def shards(scheduler):
+    """configure(strategy, placement) points the lambda handler to a ShardedScheduler of two shards in us-east-1
+    and one in eu-west-1, sharing a job store. returns {name: FakeEventBridgeClient}"""
+    def configure(strategy, placement='CONSISTENT_HASH'):
+        scheduler(strategy)
+        clients = {'use1a': FakeEventBridgeClient(), 'use1b': FakeEventBridgeClient(),
+                   'euw1': FakeEventBridgeClient(region_name='eu-west-1')}
+        job_store = SQLiteJobStore(':memory:')
+        invoker = LambdaInvoker(FakeLambdaClient())
+        lambda_function._eventbridge = ShardedScheduler(
+            {name: lambda_function.EventBridge(client, job_store=job_store, invoker=invoker, snapshot_path='')
+             for name, client in clients.items()}, placement=placement)
+        lambda_function._eventbridge.scheduler_function_arn = benchmarks.SCHEDULER_FUNCTION_ARN
+        lambda_function.SHARDS_ENABLED = True
+        return clients
+    return configure
+
+
+@pytest.mark.parametrize('placement', ['CONSISTENT_HASH', 'LEAST_LOADED'])
+def test_jobs_are_placed_in_their_region(shards, context, placement):
+    clients = shards('concurrent', placement)
+    events = [make_event(minute, {'id': [minute]}) for minute in range(40)] + [make_event(0, {'id': ['e']}, EU_LAMBDA_ARN)]
+    response = lambda_function.lambda_handler(events, context)
+    assert response['success']
+    assert {result['shard'] for result in response['results'][:40]} == {'use1a', 'use1b'}
+    assert response['results'][40]['shard'] == 'euw1'
+    assert all(result['job_id'].startswith(result['shard'] + ':') for result in response['results'])
+    assert sum(len(client.rules) for client in clients.values()) == 41
+
+    again = lambda_function.lambda_handler([make_event(minute, {'id': [minute]}) for minute in range(40)], context)
+    assert all(result['duplicate'] for result in again['results'])
+
+
+def test_job_actions_go_to_the_owning_shard(shards, context):
+    shards('concatenator')
+    job_ids = [result['job_id'] for result in lambda_function.lambda_handler(
+        [make_event(minute, {'id': [minute]}) for minute in range(10)], context)['results']]
+
+    cancelled = lambda_function.lambda_handler({'action': 'cancel', 'job_id': job_ids[3]}, context)
+    assert cancelled['success']
+    assert cancelled['shard'] == job_ids[3].split(':')[0]
+    rescheduled = lambda_function.lambda_handler({'action': 'reschedule', 'job_id': job_ids[4],
+                                                  'datetime_utc': '2031-01-01 12:00:00'}, context)
+    assert rescheduled['success']
+    assert rescheduled['job_id'].split(':')[0] == job_ids[4].split(':')[0]
+    unknown = lambda_function.lambda_handler({'action': 'cancel', 'job_id': 'nope:AUTO_2031-1-1--10-5/x'}, context)
+    assert not unknown['success']
+
+    jobs = []
+    next_token = None
+    while True:
+        response = lambda_function.lambda_handler({'action': 'query', 'from_datetime_utc': '2031-01-01 10:00:00',
+                                                   'to_datetime_utc': '2031-01-01 13:00:00', 'limit': 3,
+                                                   'next_token': next_token}, context)
+        jobs.extend(response['jobs'])
+        next_token = response['next_token']
+        if not next_token:
+            break
+    assert sorted(value for job in jobs for value in job['data']['id']) == [0, 1, 2, 4, 5, 6, 7, 8, 9]
+    assert [job['datetime_utc'] for job in jobs] == sorted(job['datetime_utc'] for job in jobs)
+
+
+def test_maintenance_runs_on_every_shard(shards, context):
+    clients = shards('concurrent')
+    lambda_function.MAINTENANCE_RULE_ENABLED = True
+    lambda_function._maintenance_rule_installed = False
+    assert lambda_function.lambda_handler(make_event(5, {'id': [1]}), context)['success']
+    # installed once, on the shard in the region of the scheduler
+    assert [name for name, client in clients.items()
+            if lambda_function.prefix_the_rule_name(lambda_function.MAINTENANCE_RULE_NAME) in client.rules] == ['use1a']
+    response = lambda_function.lambda_handler({'action': 'maintenance'}, context)
+    assert response['success']
+    assert sorted(response['shards']) == ['euw1', 'use1a', 'use1b']
+
+
+def test_dispatch_rules_pass_their_shard(shards, context):
+    clients = shards('dispatcher')
+    date = datetime.datetime(2031, 1, 1, 10, 5, tzinfo=datetime.timezone.utc)
+    # the same bucket on two shards, their jobs are kept apart in the shared job store
+    for name in ('use1a', 'use1b'):
+        lambda_function._eventbridge.shards[name].create_rules_from_events(
+            [{'datetime_utc': date, 'lambda_function': LAMBDA_ARN, 'data': {'id': [name]}}])
+    for name in ('use1a', 'use1b'):
+        target = next(iter(clients[name].targets['AUTO_2031-1-1--10-5'].values()))
+        assert json.loads(target['Input']) == {'action': 'dispatch', 'bucket': 'AUTO_2031-1-1--10-5', 'shard': name}
+        response = lambda_function.lambda_handler(json.loads(target['Input']), context)
+        assert response == {'success': True, 'dispatched': 1, 'failed': 0}
+    invocations = lambda_function._eventbridge.shards['use1a'].get_lambda_invoker().client.invocations
+    assert sorted(data['id'][0] for _, data in invocations) == ['use1a', 'use1b']
+
+
+def test_dispatch_of_a_shard_needs_shards(scheduler, context):
+    scheduler('dispatcher')
+    with pytest.raises(lambda_function.LambdaSchedulerException):
+        lambda_function.lambda_handler({'action': 'dispatch', 'bucket': 'AUTO_2031-1-1--10-5', 'shard': 'use1a'},
+                                       context)
@@ -0,0 +1,46 @@
+import json
+import lambda_function
+from conftest import make_event
+
+
+def make_sqs_event(bodies):
+    """bodies is {message id: body}, the bodies that aren't strings are json encoded."""
+    return {'Records': [{'messageId': message_id, 'eventSource': 'aws:sqs',
+                         'body': body if isinstance(body, str) else json.dumps(body)}
+                        for message_id, body in bodies.items()]}
+
+
+def test_batch_item_failures(scheduler, context):
+    client = scheduler('concurrent')
+    response = lambda_function.lambda_handler(make_sqs_event({
+        'single': make_event(5, {'id': [1]}),
+        'list': [make_event(6, {'id': [2]}), make_event(7, {'id': [3]})],
+        'invalid': make_event(8, {'id': [4]}, lambda_function_arn='not-an-arn'),
+        'partly-invalid': [make_event(9, {'id': [5]}), {'data': {'id': [6]}}],
+        'undecodable': '{"datetime_utc":',
+    }), context)
+    assert sorted(item['itemIdentifier'] for item in response['batchItemFailures']) == [
+        'invalid', 'partly-invalid', 'undecodable']
+    assert sorted(client.rules) == ['AUTO_2031-1-1--10-5', 'AUTO_2031-1-1--10-6', 'AUTO_2031-1-1--10-7',
+                                    'AUTO_2031-1-1--10-9']
+
+
+def test_redelivered_message_is_a_no_op(scheduler, context):
+    client = scheduler('concatenator')
+    event = make_sqs_event({'m1': [make_event(5, {'id': [1]}), make_event(5, {'id': [2]})]})
+    assert lambda_function.lambda_handler(event, context) == {'batchItemFailures': []}
+    puts = client.calls['PutTargets']
+    assert lambda_function.lambda_handler(event, context) == {'batchItemFailures': []}
+    assert client.calls['PutTargets'] == puts
+    assert [json.loads(target['Input']) for target in client.targets['AUTO_2031-1-1--10-5'].values()] == [
+        {'id': [1, 2]}]
+
+
+def test_failed_writes_are_reported(scheduler, context):
+    client = scheduler('concurrent')
+
+    def put_targets(**kwargs):
+        raise Exception('PutTargets is down')
+    client.put_targets = put_targets
+    response = lambda_function.lambda_handler(make_sqs_event({'m1': make_event(5, {'id': [1]})}), context)
+    assert response == {'batchItemFailures': [{'itemIdentifier': 'm1'}]}
@@ -0,0 +1,35 @@
+import datetime
+
+import lambda_function
+import pytest
+from conftest import make_event
+from utils import as_utc, parse_datetime
+
+UTC = datetime.timezone.utc
+
+
+@pytest.mark.parametrize('value', ['2031-01-01 10:05:00', '2031-01-01T10:05:00', '2031-01-01T10:05:00Z',
+                                   '2031-01-01T10:05:00z', '2031-01-01T10:05:00+00:00',
+                                   '2031-01-01T12:05:00+02:00', '2031-01-01T05:05:00-05:00'])
+def test_parse_datetime_iso_formats(value):
+    assert as_utc(parse_datetime(value)) == datetime.datetime(2031, 1, 1, 10, 5, tzinfo=UTC)
+
+
+@pytest.mark.parametrize('value', ['Jan 1 2031 10:05', '01/01/2031 10:05:00', '1 January 2031, 10:05:00 UTC'])
+def test_parse_datetime_falls_back_to_dateutil(value):
+    assert as_utc(parse_datetime(value)) == datetime.datetime(2031, 1, 1, 10, 5, tzinfo=UTC)
+
+
+def test_as_utc():
+    assert as_utc(datetime.datetime(2031, 1, 1, 10, 5)).tzinfo == UTC
+    date = datetime.datetime(2031, 1, 1, 12, 5, tzinfo=datetime.timezone(datetime.timedelta(hours=2)))
+    assert as_utc(date) == datetime.datetime(2031, 1, 1, 10, 5, tzinfo=UTC)
+    assert as_utc(date).tzinfo == UTC
+
+
+def test_a_datetime_with_an_offset_is_scheduled_in_utc(scheduler, context):
+    scheduler('concurrent')
+    response = lambda_function.lambda_handler(
+        make_event(5, {'id': [1]}, datetime_utc='2031-01-01T12:05:00+02:00'), context)
+    assert response['success']
+    assert response['rule_name'] == 'AUTO_2031-1-1--10-5'
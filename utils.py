@@ -1,3 +1,4 @@
+import datetime
 import importlib
 
 def get_class_by_name_and_module(module_name, class_name):
@@ -5,4 +6,29 @@ def get_class_by_name_and_module(module_name, class_name):
     m = importlib.import_module(module_name)
     # get the class, will raise AttributeError if class cannot be found
     c = getattr(m, class_name)
-    return c
\ No newline at end of file
+    return c
+
+def as_utc(date):
+    """naive datetimes are presumed to be in UTC, aware datetimes are converted to UTC."""
+    if date.tzinfo is None:
+        return date.replace(tzinfo=datetime.timezone.utc)
+    return date.astimezone(datetime.timezone.utc)
+
+
+def get_boto3_error_code(exception):
+    """returns the error code of a botocore ClientError, e.g. 'ResourceNotFoundException'."""
+    return getattr(exception, 'response', {}).get('Error', {}).get('Code')
+
+
+def parse_datetime(value):
+    """parses the documented 'YYYY-MM-DD HH:MM:SS' and the other ISO 8601 datetimes with the
+    strict and fast datetime.fromisoformat. other formats fall back to dateutil's parser."""
+    if isinstance(value, str):
+        try:
+            if value.endswith(('Z', 'z')):
+                return datetime.datetime.fromisoformat(value[:-1] + '+00:00')
+            return datetime.datetime.fromisoformat(value)
+        except ValueError:
+            pass
+    from dateutil.parser import parse  # deferred, only the non-ISO formats need it
+    return parse(value)